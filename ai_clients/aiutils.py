@@ -1,4 +1,9 @@
-from typing import List, Dict
+from typing import List, Dict, AsyncIterator, Optional
+from openai import AsyncOpenAI
+
+import metrics
+from .base_client import StreamDelta
+from .retry import call_with_retry
 
 def prepare_openai_history(
     system_instruction_content: str, 
@@ -11,6 +16,10 @@ def prepare_openai_history(
     - Устанавливает системную инструкцию.
     - Конвертирует историю из формата Gemini ('model' -> 'assistant').
     - Добавляет текущий запрос пользователя.
+
+    Порядок сообщений не меняется между запросами (системный промпт, резюме, буфер, новый запрос),
+    поэтому при блочном буфере (database.get_history_for_context) начало запроса совпадает
+    с предыдущим и попадает в кэш промптов провайдера.
     
     :param system_instruction_content: Текст системного промпта.
     :param chat_history: История сообщений в "универсальном" формате.
@@ -18,8 +27,8 @@ def prepare_openai_history(
     :return: Список сообщений, готовый для отправки в API.
     """
     
-    # Системная инструкция всегда идет первой
-    messages = [{"role": "system", "content": system_instruction_content}]
+    # Системная инструкция всегда идет первой (пустую не отправляем)
+    messages = [{"role": "system", "content": system_instruction_content}] if system_instruction_content else []
 
     # Конвертируем основную историю
     for msg in chat_history:
@@ -35,4 +44,57 @@ def prepare_openai_history(
     # В конце добавляем текущий запрос пользователя
     messages.append({"role": "user", "content": user_prompt})
     
-    return messages
\ No newline at end of file
+    return messages
+
+
+def record_prompt_cache(provider: str, prompt_tokens: Optional[int], cached_tokens: Optional[int]) -> None:
+    """
+    Учитывает в метриках входные токены запроса и сколько из них провайдер взял из кэша промптов.
+    Доля попаданий - ai_cached_prompt_tokens_total / ai_prompt_tokens_total.
+    """
+    if not prompt_tokens:
+        return
+    metrics.increment("ai_prompt_tokens_total", value=prompt_tokens, provider=provider)
+    metrics.increment("ai_cached_prompt_tokens_total", value=cached_tokens or 0, provider=provider)
+
+
+def record_openai_prompt_cache(provider: str, usage) -> None:
+    """record_prompt_cache для usage OpenAI-совместимых API (prompt_tokens_details.cached_tokens)."""
+    if not usage:
+        return
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached_tokens = getattr(details, "cached_tokens", None) if details else None
+    if cached_tokens is None:
+        # [Dev-Ассистент]: DeepSeek отдает попадания в кэш отдельным полем.
+        cached_tokens = getattr(usage, "prompt_cache_hit_tokens", None)
+    record_prompt_cache(provider, usage.prompt_tokens, cached_tokens)
+
+
+async def stream_openai_chat(client: AsyncOpenAI, provider: str, **request) -> AsyncIterator[StreamDelta]:
+    """
+    Выполняет chat.completions.create со stream=True и переводит чанки OpenAI-совместимого API в StreamDelta.
+
+    include_usage просит API прислать последним чанком usage - без него поток не сообщает расход токенов.
+    Повторяется только открытие потока (ai_clients.retry): после первых чанков повтор задублировал бы текст.
+    Ошибки не перехватываются: их обрабатывает конкретный клиент, как и в get_text_response.
+
+    :param client: Общий SDK-клиент AsyncOpenAI.
+    :param provider: Имя провайдера для логов и метрик повторов.
+    :param request: Параметры запроса (model, messages, extra_headers и т.д.).
+    """
+    stream = await call_with_retry(
+        lambda: client.chat.completions.create(
+            stream=True,
+            stream_options={"include_usage": True},
+            **request
+        ),
+        provider=provider
+    )
+    async for chunk in stream:
+        if chunk.choices:
+            content = chunk.choices[0].delta.content
+            if content:
+                yield StreamDelta(content)
+        if chunk.usage:
+            record_openai_prompt_cache(provider, chunk.usage)
+            yield StreamDelta("", chunk.usage.total_tokens)
@@ -0,0 +1,88 @@
+# ai_clients/audio.py
+# [Dev-Ассистент]: Распознавание голосовых сообщений.
+#
+# Голосовое Telegram - это OGG/Opus, и Whisper принимает его как есть: байты уходят без декодирования и
+# перекодирования. Только если провайдер отверг файл (UnsupportedAudioError), звук перекладывается в контейнер
+# WebM без перекодирования (ffmpeg -c:a copy). ffmpeg работает отдельным процессом, и одновременно их не больше
+# AUDIO_REMUX_MAX_PROCESSES. Отказ запоминается на AUDIO_DIRECT_RETRY_SECONDS, чтобы следующие голосовые
+# не отправлялись заведомо впустую.
+
+import asyncio
+import logging
+import time
+from typing import Optional
+
+import config
+import metrics
+
+from .base_client import UnsupportedAudioError
+
+logger = logging.getLogger(__name__)
+
+_remux_slots = asyncio.Semaphore(config.AUDIO_REMUX_MAX_PROCESSES)
+_direct_rejected_at: Optional[float] = None
+
+
+class AudioConversionError(Exception):
+    """Не удалось переупаковать аудио (нет ffmpeg, битый файл, таймаут). Текст - для пользователя."""
+
+
+async def remux_to_webm(data: bytes) -> bytes:
+    """
+    Перекладывает первую звуковую дорожку OGG/Opus в WebM без перекодирования.
+
+    :param data: Байты голосового сообщения.
+    :return: Байты WebM.
+    :raises AudioConversionError: Если ffmpeg не установлен, не справился или не уложился в AUDIO_REMUX_TIMEOUT_SECONDS.
+    """
+    async with _remux_slots:
+        try:
+            process = await asyncio.create_subprocess_exec(
+                "ffmpeg", "-hide_banner", "-loglevel", "error",
+                "-i", "pipe:0", "-map", "0:a:0", "-c:a", "copy", "-f", "webm", "pipe:1",
+                stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+            )
+        except FileNotFoundError:
+            raise AudioConversionError("для распознавания этого аудио на сервере должна быть установлена утилита ffmpeg.")
+        try:
+            output, errors = await asyncio.wait_for(process.communicate(data), timeout=config.AUDIO_REMUX_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            raise AudioConversionError("обработка аудио заняла слишком много времени.")
+    if process.returncode != 0 or not output:
+        logger.error(f"ffmpeg не смог переупаковать аудио (код {process.returncode}): {errors.decode(errors='replace').strip()}")
+        raise AudioConversionError("не удалось прочитать аудиофайл.")
+    return output
+
+
+async def transcribe_voice(client, data: bytes) -> Optional[str]:
+    """
+    Распознает голосовое сообщение: сначала исходный OGG, при отказе провайдера - WebM после remux_to_webm.
+
+    :param client: Клиент с методом transcribe_audio(audio_bytes, filename) (GPTClient).
+    :param data: Байты голосового сообщения (OGG/Opus).
+    :return: Распознанный текст или None, если распознать не удалось.
+    :raises AudioConversionError: Если понадобилась переупаковка, и она не удалась.
+    """
+    global _direct_rejected_at
+    if _direct_rejected_at is None or time.monotonic() - _direct_rejected_at >= config.AUDIO_DIRECT_RETRY_SECONDS:
+        try:
+            text = await client.transcribe_audio(bytes(data), filename="voice.ogg")
+            metrics.increment("voice_transcriptions_total", path="direct")
+            _direct_rejected_at = None
+            return text
+        except UnsupportedAudioError as e:
+            logger.warning(f"{e} Переупаковываем в WebM; следующие {config.AUDIO_DIRECT_RETRY_SECONDS} с - сразу.")
+            _direct_rejected_at = time.monotonic()
+
+    started_at = time.monotonic()
+    webm_bytes = await remux_to_webm(bytes(data))
+    metrics.observe("voice_remux_seconds", time.monotonic() - started_at)
+    try:
+        text = await client.transcribe_audio(webm_bytes, filename="voice.webm")
+    except UnsupportedAudioError as e:
+        logger.error(f"{e} Распознать голосовое не удалось.")
+        return None
+    metrics.increment("voice_transcriptions_total", path="remuxed")
+    return text
@@ -1,8 +1,32 @@
 # ai_clients/base_client.py
 
 from abc import ABC, abstractmethod
-from typing import List, Dict, Tuple
-from PIL.Image import Image
+from typing import List, Dict, Tuple, AsyncIterator, NamedTuple
+
+from .images import PreparedImage
+
+
+class AIClientError(Exception):
+    """
+    Запрос к AI-провайдеру не удался (уже после повторов, см. ai_clients.retry).
+    Текст исключения предназначен для пользователя.
+    """
+
+
+class UnsupportedAudioError(AIClientError):
+    """Провайдер распознавания речи не принял формат аудиофайла (см. ai_clients.audio.transcribe_voice)."""
+
+
+class StreamDelta(NamedTuple):
+    """
+    Очередной фрагмент потокового ответа.
+
+    text - новый кусок текста (не весь ответ целиком), может быть пустым.
+    total_tokens - итог по токенам; ненулевой приходит один раз, обычно в самом конце потока.
+    """
+    text: str
+    total_tokens: int = 0
+
 
 class BaseAIClient(ABC):
     """
@@ -11,25 +35,40 @@ class BaseAIClient(ABC):
     """
 
     @abstractmethod
-    async def get_text_response(self, chat_history: List[Dict], user_prompt: str) -> Tuple[str, int]:
+    async def get_text_response(self, chat_history: List[Dict], user_prompt: str, system_instruction: str = "") -> Tuple[str, int]:
         """
         Получает текстовый ответ от AI.
 
         :param chat_history: История диалога в унифицированном формате.
         :param user_prompt: Новый запрос от пользователя.
+        :param system_instruction: Системный промпт (персонаж). Передается в каждый вызов,
+                                   т.к. один экземпляр клиента обслуживает всех пользователей.
         :return: Кортеж (текст_ответа: str, потрачено_токенов: int).
+        :raises AIClientError: Если провайдер не ответил (временные сбои уже повторены).
         """
         pass
 
     @abstractmethod
-    async def get_image_response(self, chat_history: List[Dict], text_prompt: str, image: Image) -> Tuple[str, int]:
+    async def get_image_response(self, chat_history: List[Dict], text_prompt: str, image: PreparedImage, system_instruction: str = "") -> Tuple[str, int]:
         """
         Получает текстовый ответ от AI на основе ИСТОРИИ, изображения и текста.
 
         :param chat_history: История диалога в унифицированном формате.
         :param text_prompt: Текстовый запрос к изображению.
-        :param image: Объект изображения PIL.Image.
+        :param image: Изображение, подготовленное ai_clients.images.prepare_image.
+        :param system_instruction: Системный промпт (персонаж).
         :return: Кортеж (текст_ответа: str, потрачено_токенов: int).
+        :raises AIClientError: Если провайдер не ответил (временные сбои уже повторены).
         """
         pass
-    
\ No newline at end of file
+
+    async def stream_text_response(self, chat_history: List[Dict], user_prompt: str, system_instruction: str = "") -> AsyncIterator[StreamDelta]:
+        """
+        Потоковый вариант get_text_response: отдает ответ по мере генерации.
+
+        Склейка всех StreamDelta.text дает тот же текст, что вернул бы get_text_response,
+        а ненулевой StreamDelta.total_tokens - то же количество токенов.
+        Реализация по умолчанию для клиентов без поддержки потока: один фрагмент с готовым ответом.
+        """
+        response_text, tokens_spent = await self.get_text_response(chat_history, user_prompt, system_instruction)
+        yield StreamDelta(response_text, tokens_spent)
@@ -1,51 +1,70 @@
 # ai_clients/deepseek_client.py (НОВЫЙ ФАЙЛ)
 
 import logging
-from typing import List, Dict, Tuple
-from PIL.Image import Image
-from openai import AsyncOpenAI, Timeout  # Используем асинхронный клиент OpenAI
-from .base_client import BaseAIClient
-from .aiutils import prepare_openai_history
+from typing import List, Dict, Tuple, AsyncIterator
+from openai import AsyncOpenAI  # Используем асинхронный клиент OpenAI
+from .base_client import BaseAIClient, StreamDelta, AIClientError
+from .images import PreparedImage
+from .aiutils import prepare_openai_history, stream_openai_chat, record_openai_prompt_cache
+from .rate_limiter import get_rate_limiter, estimate_tokens
+from .retry import call_with_retry
+import config
 logger = logging.getLogger(__name__)
 
 class DeepSeekClient(BaseAIClient):
-    def __init__(self, api_key: str, system_instruction: str, model_name: str):
+    def __init__(self, client: AsyncOpenAI, model_name: str):
         # API DeepSeek совместимо с OpenAI, поэтому мы используем их клиент,
-        # но указываем свой base_url и ключ.
-        self._client = AsyncOpenAI(
-            api_key=api_key,
-            base_url="https://api.deepseek.com/v1",
-            # Устанавливаем таймаут
-            timeout=Timeout(60.0)
-        )
+        # но со своим base_url и ключом (общий SDK-клиент выдает ai_clients.factory).
+        self._client = client
         self._model_name = model_name
-        self._system_instruction_content = system_instruction
+        self._limiter = get_rate_limiter("deepseek", client.api_key)
         logger.info(f"Клиент DeepSeek инициализирован с моделью: '{model_name}'.")
 
-    async def get_text_response(self, chat_history: List[Dict], user_prompt: str) -> Tuple[str, int]:
+    async def get_text_response(self, chat_history: List[Dict], user_prompt: str, system_instruction: str = "") -> Tuple[str, int]:
         
         messages = prepare_openai_history(
-            system_instruction_content=self._system_instruction_content,
+            system_instruction_content=system_instruction,
             chat_history=chat_history,
             user_prompt=user_prompt
         )
 
         try:
-            response = await self._client.chat.completions.create(
-                model=self._model_name,
-                messages=messages
-            )
-            
-            response_text = response.choices[0].message.content
-            tokens_spent = response.usage.total_tokens
+            async with self._limiter.reserve(estimate_tokens(messages, config.AI_RATE_LIMIT_OUTPUT_TOKENS_ESTIMATE)) as reservation:
+                response = await call_with_retry(
+                    lambda: self._client.chat.completions.create(
+                        model=self._model_name,
+                        messages=messages
+                    ),
+                    provider="deepseek"
+                )
+                
+                response_text = response.choices[0].message.content
+                record_openai_prompt_cache("deepseek", response.usage)
+                tokens_spent = response.usage.total_tokens
+                reservation.settle(tokens_spent)
             
             return response_text, tokens_spent
             
         except Exception as e:
             logger.error(f"Ошибка от DeepSeek API: {e}", exc_info=True)
-            return f"Произошла ошибка при обращении к DeepSeek: {e}", 0
+            raise AIClientError(f"Произошла ошибка при обращении к DeepSeek: {e}") from e
+
+    async def stream_text_response(self, chat_history: List[Dict], user_prompt: str, system_instruction: str = "") -> AsyncIterator[StreamDelta]:
+        messages = prepare_openai_history(
+            system_instruction_content=system_instruction,
+            chat_history=chat_history,
+            user_prompt=user_prompt
+        )
+        try:
+            async with self._limiter.reserve(estimate_tokens(messages, config.AI_RATE_LIMIT_OUTPUT_TOKENS_ESTIMATE)) as reservation:
+                async for delta in stream_openai_chat(self._client, "deepseek", model=self._model_name, messages=messages):
+                    reservation.settle(delta.total_tokens)
+                    yield delta
+        except Exception as e:
+            logger.error(f"Ошибка от DeepSeek API (поток): {e}", exc_info=True)
+            raise AIClientError(f"Произошла ошибка при обращении к DeepSeek: {e}") from e
 
-    async def get_image_response(self, text_prompt: str, image: Image) -> Tuple[str, int]:
+    async def get_image_response(self, chat_history: List[Dict], text_prompt: str, image: PreparedImage, system_instruction: str = "") -> Tuple[str, int]:
         # Модель deepseek-chat не поддерживает обработку изображений.
         # Возвращаем понятный ответ и 0 токенов.
         logger.warning("Попытка использовать обработку изображений с DeepSeek, которая не поддерживается.")
@@ -1,19 +1,30 @@
 # ai_clients/factory.py (ИСПРАВЛЕННАЯ ВЕРСИЯ)
 
 import os
-from typing import NamedTuple
-from .base_client import BaseAIClient
-from .gemini_client import GeminiClient
+import logging
+from typing import Dict, List, NamedTuple, Optional, Tuple
+from openai import AsyncOpenAI, Timeout
+from .base_client import BaseAIClient, AIClientError
+from .health import ProviderHealth, MonitoredClient
+from .hedging import HedgedClient
+from .gemini_client import GeminiClient, configure_gemini
 from .deepseek_client import DeepSeekClient
 from .gpt_client import GPTClient
 from .openrouter_client import OpenRouterClient
+from .yandexart_client import close_operation_poller
 from constants import *
 import config
+import metrics
 
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+# [Dev-Ассистент]: Необязательный адрес OpenAI-совместимого сервера (прокси или локальная заглушка для проверки).
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL")
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
+DEEPSEEK_API_BASE_URL = "https://api.deepseek.com/v1"
+
+logger = logging.getLogger(__name__)
 
 class AIClientCapabilities(NamedTuple):
     """Описывает возможности и ограничения конкретного AI клиента."""
@@ -21,18 +32,146 @@ class AIClientCapabilities(NamedTuple):
     supports_vision: bool = False
     file_char_limit: int = 0
 
-def get_ai_client_with_caps(provider_identifier: str, system_instruction: str) -> AIClientCapabilities:
+# --- Реестр клиентов ---
+# [Dev-Ассистент]: Раньше каждый запрос создавал новый AsyncOpenAI со своим пулом httpx: каждый вызов LLM платил
+# [Dev-Ассистент]: за DNS + TCP + TLS, а пулы никто не закрывал. Теперь на процесс один SDK-клиент на пару
+# [Dev-Ассистент]: (base_url, API-ключ) и один экземпляр AI-клиента на провайдера. Системная инструкция
+# [Dev-Ассистент]: передается в каждый вызов get_text_response/get_image_response.
+_sdk_clients: Dict[Tuple[str, str], AsyncOpenAI] = {}
+_capabilities: Dict[str, AIClientCapabilities] = {}
+# [Dev-Ассистент]: Здоровье провайдеров (автоматы) переживает close_ai_clients - это статистика, а не ресурс.
+_health: Dict[str, ProviderHealth] = {}
+
+def _get_sdk_client(api_key: str, base_url: Optional[str] = None) -> AsyncOpenAI:
+    """Возвращает общий на процесс AsyncOpenAI (с долгоживущим пулом соединений) для base_url и ключа."""
+    key = (base_url or "", api_key)
+    client = _sdk_clients.get(key)
+    if client is None:
+        # [Dev-Ассистент]: max_retries=0 - повторами управляет ai_clients.retry, иначе попытки SDK и наши перемножаются.
+        client = AsyncOpenAI(api_key=api_key, base_url=base_url, timeout=Timeout(60.0), max_retries=0)
+        _sdk_clients[key] = client
+    return client
+
+def init_ai_clients() -> None:
+    """Настраивает глобальные SDK один раз при старте бота (вызывается в post_init)."""
+    if GEMINI_API_KEY:
+        configure_gemini(GEMINI_API_KEY)
+
+async def close_ai_clients() -> None:
+    """Закрывает пулы HTTP-соединений всех SDK-клиентов (вызывается в post_shutdown)."""
+    clients = list(_sdk_clients.values())
+    _sdk_clients.clear()
+    _capabilities.clear()
+    for client in clients:
+        try:
+            await client.close()
+        except Exception as e:
+            logger.warning(f"Ошибка при закрытии AI клиента: {e}")
+    # [Dev-Ассистент]: Общая сессия и опросчик операций YandexArt.
+    await close_operation_poller()
+
+def get_ai_client_with_caps(provider_identifier: str) -> AIClientCapabilities:
     """
-    Фабрика, которая создает AI клиент и возвращает его вместе с его возможностями.
+    Фабрика, которая возвращает AI клиент (общий для всех запросов к провайдеру) вместе с его возможностями.
     """
     provider_identifier = provider_identifier.lower()
+    caps = _capabilities.get(provider_identifier)
+    if caps is None:
+        caps = _create_client_with_caps(provider_identifier)
+        # [Dev-Ассистент]: Обертка пишет исход и длительность запросов в ProviderHealth провайдера.
+        caps = caps._replace(client=MonitoredClient(caps.client, get_provider_health(provider_identifier)))
+        _capabilities[provider_identifier] = caps
+    return caps
+
+def get_provider_health(provider_identifier: str) -> ProviderHealth:
+    """Возвращает статистику здоровья и автомат провайдера."""
+    provider_identifier = provider_identifier.lower()
+    health = _health.get(provider_identifier)
+    if health is None:
+        health = ProviderHealth(provider_identifier)
+        _health[provider_identifier] = health
+    return health
+
+def _fallback_candidates(
+    provider_identifier: str,
+    allowed_providers: List[str],
+    require_vision: bool = False,
+    min_file_chars: int = 0
+) -> List[Tuple[str, AIClientCapabilities]]:
+    """
+    Запасные модели для provider_identifier: из config.AI_PROVIDER_FALLBACKS (или allowed_providers, если список
+    не задан), доступные тарифу, с незакрытым для запросов автоматом и нужными возможностями.
+    Сначала модели с известной латентностью (по возрастанию p95), затем - по порядку из конфига.
+    """
+    candidates = []
+    fallbacks = config.AI_PROVIDER_FALLBACKS.get(provider_identifier, allowed_providers)
+    for order, fallback in enumerate(fallbacks):
+        if fallback == provider_identifier or fallback not in allowed_providers:
+            continue
+        health = get_provider_health(fallback)
+        if not health.is_available():
+            continue
+        try:
+            caps = get_ai_client_with_caps(fallback)
+        except ValueError:
+            continue  # Нет API-ключа
+        if (require_vision and not caps.supports_vision) or (min_file_chars and caps.file_char_limit < min_file_chars):
+            continue
+        p95 = health.p95_latency()
+        candidates.append((p95 is None, p95 or 0.0, order, fallback, caps))
+    return [(fallback, caps) for *_, fallback, caps in sorted(candidates, key=lambda candidate: candidate[:3])]
+
+def route_ai_client(
+    provider_identifier: str,
+    allowed_providers: List[str],
+    require_vision: bool = False,
+    min_file_chars: int = 0
+) -> Tuple[str, AIClientCapabilities]:
+    """
+    Выбирает клиент для запроса с учетом здоровья провайдеров.
+
+    Если автомат выбранного провайдера пропускает запросы - возвращается он. Иначе - самая быстрая
+    подходящая запасная модель тарифа (см. _fallback_candidates).
+
+    :param provider_identifier: Модель, выбранная пользователем.
+    :param allowed_providers: available_providers тарифа пользователя.
+    :param require_vision: Нужна ли поддержка изображений.
+    :param min_file_chars: Размер документа, который должна принять модель (0 - документа нет).
+    :return: Кортеж (фактический провайдер, его AIClientCapabilities).
+    :raises AIClientError: Если выбранный провайдер и все запасные недоступны.
+    """
+    if get_provider_health(provider_identifier).allow_request():
+        return provider_identifier, get_ai_client_with_caps(provider_identifier)
+
+    candidates = _fallback_candidates(provider_identifier, allowed_providers, require_vision, min_file_chars)
+    if not candidates:
+        metrics.increment("ai_fallback_total", provider=provider_identifier, fallback="none")
+        raise AIClientError("😔 Выбранная модель временно недоступна, а подходящей замены нет. Попробуйте через минуту.")
+
+    fallback, caps = candidates[0]
+    get_provider_health(fallback).allow_request()
+    metrics.increment("ai_fallback_total", provider=provider_identifier, fallback=fallback)
+    logger.info(f"Автомат провайдера {provider_identifier} открыт, запрос направлен в {fallback}.")
+    return fallback, caps
+
+def hedge_ai_client(provider_identifier: str, caps: AIClientCapabilities, allowed_providers: List[str]) -> BaseAIClient:
+    """
+    Оборачивает клиент выбранной модели в HedgedClient со второй моделью тарифа (ai_clients.hedging).
+    Если подходящей второй модели нет, возвращает клиент как есть.
+    """
+    candidates = _fallback_candidates(provider_identifier, allowed_providers)
+    if not candidates:
+        return caps.client
+    secondary_provider, secondary_caps = candidates[0]
+    return HedgedClient((provider_identifier, caps.client), (secondary_provider, secondary_caps.client))
 
+def _create_client_with_caps(provider_identifier: str) -> AIClientCapabilities:
     # --- Маршрутизация к Gemini ---
     if provider_identifier == GEMINI_STANDARD:
         if not GEMINI_API_KEY: raise ValueError("API ключ для Gemini не найден.")
         
         model_name = config.GEMINI_MODEL
-        client = GeminiClient(api_key=GEMINI_API_KEY, system_instruction=system_instruction, model_name=model_name, vision_model_name=model_name)
+        client = GeminiClient(api_key=GEMINI_API_KEY, model_name=model_name, vision_model_name=model_name)
         
         return AIClientCapabilities(
             client=client,
@@ -44,7 +183,7 @@ def get_ai_client_with_caps(provider_identifier: str, system_instruction: str) -
     elif provider_identifier == GPT_2:
         if not OPENAI_API_KEY: raise ValueError("API ключ для OpenAI не найден.")
         # [Dev-Ассистент]: Мы создаем тот же GPTClient, но передаем ему новое имя модели из конфига.
-        client = GPTClient(api_key=OPENAI_API_KEY, system_instruction=system_instruction, model_name=config.GPT_2_MODEL)
+        client = GPTClient(client=_get_sdk_client(OPENAI_API_KEY, OPENAI_BASE_URL), model_name=config.GPT_2_MODEL)
         return AIClientCapabilities(
             client=client,
             supports_vision=True, # [Dev-Ассистент]: gpt-4o-mini тоже поддерживает vision.
@@ -54,7 +193,7 @@ def get_ai_client_with_caps(provider_identifier: str, system_instruction: str) -
     # --- Маршрутизация к DeepSeek ---
     elif provider_identifier == DEEPSEEK_CHAT:
         if not DEEPSEEK_API_KEY: raise ValueError("API ключ для DeepSeek не найден.")
-        client = DeepSeekClient(api_key=DEEPSEEK_API_KEY, system_instruction=system_instruction, model_name=config.DEEPSEEK_CHAT_MODEL)
+        client = DeepSeekClient(client=_get_sdk_client(DEEPSEEK_API_KEY, DEEPSEEK_API_BASE_URL), model_name=config.DEEPSEEK_CHAT_MODEL)
         return AIClientCapabilities(
             client=client,
             supports_vision=False,
@@ -64,15 +203,14 @@ def get_ai_client_with_caps(provider_identifier: str, system_instruction: str) -
     # --- Маршрутизация к OpenRouter DEEPSEEK---
     elif provider_identifier == OPENROUTER_DEEPSEEK:
         if not OPENROUTER_API_KEY: raise ValueError("API ключ для OpenRouter не найден.")
-        client = OpenRouterClient(api_key=OPENROUTER_API_KEY, system_instruction=system_instruction, model_name=config.DEEPSEEK_CHAT_MODEL)
+        client = OpenRouterClient(client=_get_sdk_client(OPENROUTER_API_KEY, config.OPENROUTER_API_BASE_URL), model_name=config.DEEPSEEK_CHAT_MODEL)
         return AIClientCapabilities(client=client)
     
     # --- Маршрутизация к OpenRouter GEMINI 2.0 flash exper---
     elif provider_identifier == OPENROUTER_GEMINI_2_FLASH:
         if not OPENROUTER_API_KEY: raise ValueError("API ключ для OpenRouter не найден.")
         client = OpenRouterClient(
-            api_key=OPENROUTER_API_KEY, 
-            system_instruction=system_instruction, 
+            client=_get_sdk_client(OPENROUTER_API_KEY, config.OPENROUTER_API_BASE_URL),
             model_name=config.GEMINI_2_FLASH_EXP_MODEL # Используем переменную из config
         )
         return AIClientCapabilities(
@@ -85,7 +223,7 @@ def get_ai_client_with_caps(provider_identifier: str, system_instruction: str) -
     elif provider_identifier == GPT_1:
         if not OPENAI_API_KEY: raise ValueError("API ключ для OpenAI не найден.")
         # <<< ИСПРАВЛЕНИЕ: Убраны кавычки, теперь это ссылка на переменную из config >>>
-        client = GPTClient(api_key=OPENAI_API_KEY, system_instruction=system_instruction, model_name=config.GPT_1_MODEL)
+        client = GPTClient(client=_get_sdk_client(OPENAI_API_KEY, OPENAI_BASE_URL), model_name=config.GPT_1_MODEL)
         return AIClientCapabilities(
             client=client,
             supports_vision=True, # <-- Меняем False на True
@@ -96,8 +234,8 @@ def get_ai_client_with_caps(provider_identifier: str, system_instruction: str) -
     elif provider_identifier == GPT_3_5_TURBO:
         if not OPENAI_API_KEY: raise ValueError("API ключ для OpenAI не найден.")
         # <<< ИСПРАВЛЕНИЕ: Убраны кавычки и здесь >>>
-        client = GPTClient(api_key=OPENAI_API_KEY, system_instruction=system_instruction, model_name=config.GPT_3_5_TURBO_MODEL)
+        client = GPTClient(client=_get_sdk_client(OPENAI_API_KEY, OPENAI_BASE_URL), model_name=config.GPT_3_5_TURBO_MODEL)
         return AIClientCapabilities(client=client)
         
     else:
-        raise ValueError(f"Неизвестный или неподдерживаемый идентификатор провайдера: '{provider_identifier}'")
\ No newline at end of file
+        raise ValueError(f"Неизвестный или неподдерживаемый идентификатор провайдера: '{provider_identifier}'")
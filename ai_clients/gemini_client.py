@@ -1,28 +1,51 @@
 # ai_clients/gemini_client.py
 
+import hashlib
 import logging
-from typing import List, Dict, Tuple
-from PIL.Image import Image
+from typing import List, Dict, Tuple, AsyncIterator, Optional
+from cachetools import LRUCache
 
 import google.generativeai as genai
 from google.generativeai.types import GenerationConfig, generation_types
 from google.api_core.exceptions import ResourceExhausted
 
-from .base_client import BaseAIClient
+from .aiutils import record_prompt_cache
+from .base_client import BaseAIClient, StreamDelta, AIClientError
+from .images import PreparedImage
+from .rate_limiter import get_rate_limiter, estimate_tokens
+from .retry import call_with_retry
+import config
 
 logger = logging.getLogger(__name__)
 
+# [Dev-Ассистент]: genai.configure - глобальная настройка всего SDK, поэтому выполняется один раз на процесс.
+_configured_api_key: Optional[str] = None
+
+
+def configure_gemini(api_key: str) -> None:
+    """Настраивает SDK Gemini ключом api_key (повторный вызов с тем же ключом ничего не делает)."""
+    global _configured_api_key
+    if _configured_api_key == api_key:
+        return
+    if _configured_api_key is not None:
+        logger.warning("SDK Gemini перенастраивается другим API-ключом: ключ общий для всех моделей Gemini.")
+    genai.configure(api_key=api_key)
+    _configured_api_key = api_key
+
+
 class GeminiClient(BaseAIClient):
     
-    def __init__(self, api_key: str, system_instruction: str, model_name: str, vision_model_name: str):
+    def __init__(self, api_key: str, model_name: str, vision_model_name: str):
         try:
-            genai.configure(api_key=api_key)
+            configure_gemini(api_key)
         except Exception as e:
             logger.error(f"Ошибка конфигурации Gemini API: {e}")
             raise
 
-        self._system_instruction = system_instruction
+        self._model_name = model_name
+        self._vision_model_name = vision_model_name
         self._generation_config = GenerationConfig(temperature=0.9, top_p=1, top_k=1, max_output_tokens=2048)
+        self._limiter = get_rate_limiter("gemini", api_key)
         
         # <<< ИЗМЕНЕНИЕ 1: Смягчаем настройки безопасности >>>
         self._safety_settings = [
@@ -33,34 +56,62 @@ class GeminiClient(BaseAIClient):
             {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_ONLY_HIGH"},
         ]
         
-        self._text_model = self._create_model(model_name)
-        self._vision_model = self._create_model(vision_model_name)
-        
+        # [Dev-Ассистент]: Настройки генерации и безопасности входят в ключ кэша моделей (_create_model).
+        self._settings_key = repr((self._generation_config, self._safety_settings))
+        self._models = LRUCache(maxsize=config.GEMINI_MODEL_CACHE_MAX_SIZE)
+
         logger.info(f"Клиент Gemini инициализирован с моделями: текст='{model_name}', vision='{vision_model_name}'.")
 
-    def _create_model(self, model_name: str) -> genai.GenerativeModel:
-        return genai.GenerativeModel(
-            model_name=model_name,
-            generation_config=self._generation_config,
-            system_instruction=self._system_instruction,
-            safety_settings=self._safety_settings
-        )
+    def _create_model(self, model_name: str, system_instruction: str) -> genai.GenerativeModel:
+        """
+        Возвращает GenerativeModel под модель и системную инструкцию из LRU-кэша.
+        В Gemini системная инструкция - часть объекта модели, а у персонажей их немного, поэтому
+        объекты переиспользуются между запросами, а не собираются заново на каждый вызов.
+        """
+        key = (model_name, hashlib.sha256(system_instruction.encode()).hexdigest(), self._settings_key)
+        model = self._models.get(key)
+        if model is None:
+            model = genai.GenerativeModel(
+                model_name=model_name,
+                generation_config=self._generation_config,
+                system_instruction=system_instruction or None,
+                safety_settings=self._safety_settings
+            )
+            self._models[key] = model
+        return model
+
+    def _estimate_tokens(self, contents: List[Dict], system_instruction: str) -> int:
+        """Оценка токенов запроса для лимитера: история, системная инструкция и максимум ответа."""
+        return estimate_tokens([system_instruction, contents], self._generation_config.max_output_tokens)
+
+    def _empty_text_response_message(self, response) -> str:
+        """Объясняет пользователю, почему Gemini не вернул текст (фильтры безопасности или другая причина)."""
+        finish_reason = response.candidates[0].finish_reason if response.candidates else "UNKNOWN"
+        if finish_reason == generation_types.FinishReason.SAFETY:
+            logger.warning(f"Запрос заблокирован фильтрами безопасности Gemini. Рейтинги: {response.prompt_feedback.safety_ratings}")
+            return "К сожалению, ваш запрос или содержимое файла было заблокировано внутренними фильтрами безопасности Gemini. Пожалуйста, попробуйте переформулировать его."
+        logger.warning(f"Gemini вернул пустой ответ. Причина: {finish_reason.name if hasattr(finish_reason, 'name') else finish_reason}")
+        return f"ИИ не смог сгенерировать ответ (причина: {finish_reason.name if hasattr(finish_reason, 'name') else finish_reason}). Попробуйте еще раз."
 
-    async def get_text_response(self, chat_history: List[Dict], user_prompt: str) -> Tuple[str, int]:
+    def _record_prompt_cache(self, response) -> None:
+        # [Dev-Ассистент]: Неявный кэш Gemini сообщает попадания в usage_metadata.cached_content_token_count.
+        usage = response.usage_metadata
+        if usage:
+            record_prompt_cache("gemini", usage.prompt_token_count, getattr(usage, "cached_content_token_count", 0))
+
+    async def get_text_response(self, chat_history: List[Dict], user_prompt: str, system_instruction: str = "") -> Tuple[str, int]:
         full_history = chat_history + [{"role": "user", "parts": [user_prompt]}]
         try:
-            response = await self._text_model.generate_content_async(full_history)
+            text_model = self._create_model(self._model_name, system_instruction)
+            async with self._limiter.reserve(self._estimate_tokens(full_history, system_instruction)) as reservation:
+                response = await call_with_retry(lambda: text_model.generate_content_async(full_history), provider="gemini")
+                reservation.settle(response.usage_metadata.total_token_count if response.usage_metadata else 0)
+            self._record_prompt_cache(response)
 
             # <<< ИЗМЕНЕНИЕ 2: Проверяем, не заблокирован ли ответ ПЕРЕД тем, как его читать >>>
             if not response.parts:
                 # Ответ пустой. Проверяем причину.
-                finish_reason = response.candidates[0].finish_reason if response.candidates else "UNKNOWN"
-                if finish_reason == generation_types.FinishReason.SAFETY:
-                    logger.warning(f"Запрос заблокирован фильтрами безопасности Gemini. Рейтинги: {response.prompt_feedback.safety_ratings}")
-                    return "К сожалению, ваш запрос или содержимое файла было заблокировано внутренними фильтрами безопасности Gemini. Пожалуйста, попробуйте переформулировать его.", 0
-                else:
-                    logger.warning(f"Gemini вернул пустой ответ. Причина: {finish_reason.name if hasattr(finish_reason, 'name') else finish_reason}")
-                    return f"ИИ не смог сгенерировать ответ (причина: {finish_reason.name if hasattr(finish_reason, 'name') else finish_reason}). Попробуйте еще раз.", 0
+                return self._empty_text_response_message(response), 0
             
             # Если все в порядке, возвращаем текст
             return response.text, response.usage_metadata.total_token_count
@@ -68,15 +119,53 @@ class GeminiClient(BaseAIClient):
         except Exception as e:
             logger.error(f"Ошибка от Gemini (текст): {e}", exc_info=True)
             # Перебрасываем ошибку выше, чтобы ее обработал main.py и сообщил пользователю
-            raise
+            raise AIClientError(f"Произошла ошибка при обращении к Gemini: {e}") from e
+
+    async def stream_text_response(self, chat_history: List[Dict], user_prompt: str, system_instruction: str = "") -> AsyncIterator[StreamDelta]:
+        full_history = chat_history + [{"role": "user", "parts": [user_prompt]}]
+        try:
+            text_model = self._create_model(self._model_name, system_instruction)
+            async with self._limiter.reserve(self._estimate_tokens(full_history, system_instruction)) as reservation:
+                response = await call_with_retry(
+                    lambda: text_model.generate_content_async(full_history, stream=True),
+                    provider="gemini"
+                )
+
+                has_text = False
+                async for chunk in response:
+                    # [Dev-Ассистент]: Чанк без parts - это блокировка или служебный хвост потока, текста в нем нет.
+                    if chunk.parts and chunk.text:
+                        has_text = True
+                        yield StreamDelta(chunk.text)
+
+                if not has_text:
+                    yield StreamDelta(self._empty_text_response_message(response))
+                    return
+                # [Dev-Ассистент]: После чтения потока usage_metadata содержит итог по всему ответу.
+                reservation.settle(response.usage_metadata.total_token_count)
+                self._record_prompt_cache(response)
+                yield StreamDelta("", response.usage_metadata.total_token_count)
+
+        except Exception as e:
+            logger.error(f"Ошибка от Gemini (текст, поток): {e}", exc_info=True)
+            # Как и в get_text_response, ошибку обрабатывает main.py
+            raise AIClientError(f"Произошла ошибка при обращении к Gemini: {e}") from e
 
-    async def get_image_response(self, chat_history: List[Dict], text_prompt: str, image: Image) -> Tuple[str, int]:
+    async def get_image_response(self, chat_history: List[Dict], text_prompt: str, image: PreparedImage, system_instruction: str = "") -> Tuple[str, int]:
+        # [Dev-Ассистент]: Байты изображения уходят inline как есть - genai не перекодирует их в WebP.
         full_request_content = chat_history + [
-            {"role": "user", "parts": [text_prompt, image]}
+            {"role": "user", "parts": [text_prompt, {"mime_type": image.mime_type, "data": image.data}]}
         ]
+        estimated_tokens = self._estimate_tokens(chat_history + [{"role": "user", "parts": [text_prompt, image]}], system_instruction)
 
         try:
-            response = await self._vision_model.generate_content_async(full_request_content)
+            vision_model = self._create_model(self._vision_model_name, system_instruction)
+            async with self._limiter.reserve(estimated_tokens) as reservation:
+                response = await call_with_retry(
+                    lambda: vision_model.generate_content_async(full_request_content),
+                    provider="gemini"
+                )
+                reservation.settle(response.usage_metadata.total_token_count if response.usage_metadata else 0)
             
             if not response.parts:
                 finish_reason = response.candidates[0].finish_reason if response.candidates else "UNKNOWN"
@@ -90,4 +179,4 @@ class GeminiClient(BaseAIClient):
             return response.text, response.usage_metadata.total_token_count
         except Exception as e:
             logger.error(f"Ошибка от Gemini (vision): {e}", exc_info=True)
-            raise
\ No newline at end of file
+            raise AIClientError(f"Произошла ошибка при обращении к Gemini Vision: {e}") from e
\ No newline at end of file
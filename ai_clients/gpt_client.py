@@ -1,62 +1,215 @@
 # ai_clients/gpt_client.py
 
 import logging
-from typing import List, Dict, Tuple
-from PIL.Image import Image
+from contextvars import ContextVar
+from typing import List, Dict, Tuple, AsyncIterator, Optional
 # [Dev-Ассистент]: openai.PermissionDeniedError импортируем для лучшей обработки ошибок
-from openai import AsyncOpenAI, Timeout, PermissionDeniedError
-import base64
+from openai import AsyncOpenAI, APIError, PermissionDeniedError, BadRequestError, NotFoundError
 import tiktoken
-from io import BytesIO
 
-from .base_client import BaseAIClient
-from .aiutils import prepare_openai_history
+from .base_client import BaseAIClient, StreamDelta, AIClientError, UnsupportedAudioError
+from .images import PreparedImage
+from .aiutils import prepare_openai_history, stream_openai_chat, record_openai_prompt_cache, record_prompt_cache
+from .rate_limiter import get_rate_limiter, estimate_tokens
+from .retry import call_with_retry, RetryPolicy
+import config
 logger = logging.getLogger(__name__)
 
-def _pil_to_base64(image: Image) -> str:
-    """Конвертирует объект PIL Image в строку Base64."""
-    buffered = BytesIO()
-    if image.mode == 'RGBA':
-        image = image.convert('RGB')
-    image.save(buffered, format="JPEG")
-    img_bytes = buffered.getvalue()
-    return base64.b64encode(img_bytes).decode('utf-8')
+class ResponseChain:
+    """
+    Цепочка Responses API одного диалога на время одного запроса.
+
+    previous_response_id/previous_model - сохраненный в dialogs последний ответ (None - цепочки нет,
+    нужна полная история). После ответа в responses лежит id нового ответа по имени модели.
+    generation - поколение цепочки в dialogs на начало хода (клиенту не нужно, его проверяет сохранение хода).
+    """
+
+    def __init__(self, previous_response_id: Optional[str] = None, previous_model: Optional[str] = None, generation: int = 0):
+        self.previous_response_id = previous_response_id
+        self.previous_model = previous_model
+        self.generation = generation
+        self.responses: Dict[str, str] = {}
+
+
+# [Dev-Ассистент]: Цепочка текущего запроса. Выставляется в main.process_ai_request только для текстовых запросов,
+# [Dev-Ассистент]: поэтому клиенту не нужен отдельный параметр (и обертки health/hedging о ней не знают).
+_response_chain: ContextVar[Optional[ResponseChain]] = ContextVar("openai_response_chain", default=None)
+
+
+def use_response_chain(chain: Optional[ResponseChain]) -> None:
+    """Включает для текстовых запросов текущей задачи режим Responses API с цепочкой chain (None - выключает)."""
+    _response_chain.set(chain)
+
+
+def _is_unsupported_audio_error(error: BadRequestError) -> bool:
+    # [Dev-Ассистент]: 400 "Invalid file format" / "could not be decoded or its format is not supported".
+    message = str(error).lower()
+    return "format" in message or "could not be decoded" in message
+
+
+def _stream_event_error(event) -> APIError:
+    # [Dev-Ассистент]: Как ошибки потока в самом SDK - APIError с кодом: по коду retry.is_transient отличает
+    # [Dev-Ассистент]: сбой провайдера (его учитывает автомат в ai_clients.health) от отказа в запросе.
+    error = event.response.error if event.type == "response.failed" else event
+    code = getattr(error, "code", None)
+    message = getattr(error, "message", None) or f"Responses API: {event.type}"
+    return APIError(message, request=None, body={"code": code, "message": message})
+
+
+def _is_broken_chain_error(error: Exception) -> bool:
+    # [Dev-Ассистент]: Сохраненный ответ удален или истек срок его хранения у OpenAI.
+    return isinstance(error, (NotFoundError, BadRequestError)) and "previous_response" in str(error)
 
 
 class GPTClient(BaseAIClient):
-    def __init__(self, api_key: str, system_instruction: str, model_name: str):
-        self._client = AsyncOpenAI(
-            api_key=api_key,
-            timeout=Timeout(60.0) 
-        )
+    def __init__(self, client: AsyncOpenAI, model_name: str):
+        # [Dev-Ассистент]: SDK-клиент (и его пул HTTP-соединений) общий на процесс - его выдает ai_clients.factory.
+        self._client = client
         self._model_name = model_name
-        self._system_instruction_content = system_instruction
+        # [Dev-Ассистент]: У чата, DALL-E и Whisper в OpenAI раздельные квоты, поэтому и лимитеры разные.
+        self._limiter = get_rate_limiter("openai", client.api_key)
+        self._images_limiter = get_rate_limiter("openai_images", client.api_key)
+        self._audio_limiter = get_rate_limiter("openai_audio", client.api_key)
         logger.info(f"Клиент OpenAI GPT инициализирован с моделью: '{model_name}'.")
 
-    async def get_text_response(self, chat_history: List[Dict], user_prompt: str) -> Tuple[str, int]:
+    @property
+    def model_name(self) -> str:
+        return self._model_name
+
+    def _responses_request(self, chain: ResponseChain, chat_history: List[Dict], user_prompt: str, system_instruction: str, chained: bool) -> Dict:
+        """
+        Параметры responses.create: при chained - только новый запрос поверх previous_response_id,
+        иначе - полная история (как в chat.completions). Системный промпт передается всегда:
+        instructions не наследуются от предыдущего ответа.
+        """
+        request = {
+            "model": self._model_name,
+            "instructions": system_instruction or None,
+            "store": True,
+            # [Dev-Ассистент]: Цепочка на сервере растет с каждым ответом - старое отрезается, если не влезает в контекст.
+            "truncation": "auto",
+        }
+        if chained:
+            request["previous_response_id"] = chain.previous_response_id
+            request["input"] = [{"role": "user", "content": user_prompt}]
+        else:
+            request["input"] = prepare_openai_history("", chat_history, user_prompt)
+        return request
+
+    def _can_chain(self, chain: ResponseChain) -> bool:
+        # [Dev-Ассистент]: Цепочку другой модели не продолжаем: после смены модели - полная история.
+        return bool(chain.previous_response_id) and chain.previous_model == self._model_name
+
+    def _record_response(self, chain: ResponseChain, response) -> int:
+        chain.responses[self._model_name] = response.id
+        usage = response.usage
+        if not usage:
+            return 0
+        details = getattr(usage, "input_tokens_details", None)
+        record_prompt_cache("openai", usage.input_tokens, getattr(details, "cached_tokens", 0) if details else 0)
+        return usage.total_tokens
+
+    async def _get_chained_text_response(self, chain: ResponseChain, chat_history: List[Dict], user_prompt: str, system_instruction: str) -> Tuple[str, int]:
+        chained = self._can_chain(chain)
+        request = self._responses_request(chain, chat_history, user_prompt, system_instruction, chained)
+        async with self._limiter.reserve(estimate_tokens([system_instruction, chat_history, user_prompt], config.AI_RATE_LIMIT_OUTPUT_TOKENS_ESTIMATE)) as reservation:
+            try:
+                response = await call_with_retry(lambda: self._client.responses.create(**request), provider="openai")
+            except Exception as e:
+                if not (chained and _is_broken_chain_error(e)):
+                    raise
+                logger.info(f"Цепочка Responses API {chain.previous_response_id} недоступна ({e}), отправляем полную историю.")
+                request = self._responses_request(chain, chat_history, user_prompt, system_instruction, chained=False)
+                response = await call_with_retry(lambda: self._client.responses.create(**request), provider="openai")
+            tokens_spent = self._record_response(chain, response)
+            reservation.settle(tokens_spent)
+        return response.output_text, tokens_spent
+
+    async def _stream_chained_text_response(self, chain: ResponseChain, chat_history: List[Dict], user_prompt: str, system_instruction: str) -> AsyncIterator[StreamDelta]:
+        chained = self._can_chain(chain)
+        request = self._responses_request(chain, chat_history, user_prompt, system_instruction, chained)
+        async with self._limiter.reserve(estimate_tokens([system_instruction, chat_history, user_prompt], config.AI_RATE_LIMIT_OUTPUT_TOKENS_ESTIMATE)) as reservation:
+            try:
+                stream = await call_with_retry(lambda: self._client.responses.create(stream=True, **request), provider="openai")
+            except Exception as e:
+                if not (chained and _is_broken_chain_error(e)):
+                    raise
+                logger.info(f"Цепочка Responses API {chain.previous_response_id} недоступна ({e}), отправляем полную историю.")
+                request = self._responses_request(chain, chat_history, user_prompt, system_instruction, chained=False)
+                stream = await call_with_retry(lambda: self._client.responses.create(stream=True, **request), provider="openai")
+            async for event in stream:
+                if event.type == "response.output_text.delta":
+                    yield StreamDelta(event.delta)
+                elif event.type in ("response.completed", "response.incomplete"):
+                    # [Dev-Ассистент]: incomplete - ответ обрезан лимитом, но текст и id у него есть.
+                    tokens_spent = self._record_response(chain, event.response)
+                    reservation.settle(tokens_spent)
+                    yield StreamDelta("", tokens_spent)
+                elif event.type in ("response.failed", "error"):
+                    raise _stream_event_error(event)
+
+    async def get_text_response(self, chat_history: List[Dict], user_prompt: str, system_instruction: str = "") -> Tuple[str, int]:
+        chain = _response_chain.get()
+        if chain is not None:
+            try:
+                return await self._get_chained_text_response(chain, chat_history, user_prompt, system_instruction)
+            except Exception as e:
+                logger.error(f"Ошибка от OpenAI Responses API: {e}", exc_info=True)
+                raise AIClientError(f"Произошла ошибка при обращении к GPT: {e}") from e
+
         messages = prepare_openai_history(
-            system_instruction_content=self._system_instruction_content,
+            system_instruction_content=system_instruction,
             chat_history=chat_history,
             user_prompt=user_prompt
         )
         try:
-            response = await self._client.chat.completions.create(
-                model=self._model_name,
-                messages=messages
-            )
-            response_text = response.choices[0].message.content
-            tokens_spent = response.usage.total_tokens if response.usage else 0
+            async with self._limiter.reserve(estimate_tokens(messages, config.AI_RATE_LIMIT_OUTPUT_TOKENS_ESTIMATE)) as reservation:
+                response = await call_with_retry(
+                    lambda: self._client.chat.completions.create(
+                        model=self._model_name,
+                        messages=messages
+                    ),
+                    provider="openai"
+                )
+                response_text = response.choices[0].message.content
+                record_openai_prompt_cache("openai", response.usage)
+                tokens_spent = response.usage.total_tokens if response.usage else 0
+                reservation.settle(tokens_spent)
             return response_text, tokens_spent
         except Exception as e:
             logger.error(f"Ошибка от OpenAI API: {e}", exc_info=True)
-            return f"Произошла ошибка при обращении к GPT: {e}", 0
+            raise AIClientError(f"Произошла ошибка при обращении к GPT: {e}") from e
+
+    async def stream_text_response(self, chat_history: List[Dict], user_prompt: str, system_instruction: str = "") -> AsyncIterator[StreamDelta]:
+        chain = _response_chain.get()
+        if chain is not None:
+            try:
+                async for delta in self._stream_chained_text_response(chain, chat_history, user_prompt, system_instruction):
+                    yield delta
+            except Exception as e:
+                logger.error(f"Ошибка от OpenAI Responses API (поток): {e}", exc_info=True)
+                raise AIClientError(f"Произошла ошибка при обращении к GPT: {e}") from e
+            return
 
-    async def get_image_response(self, chat_history: List[Dict], text_prompt: str, image: Image) -> Tuple[str, int]:
+        messages = prepare_openai_history(
+            system_instruction_content=system_instruction,
+            chat_history=chat_history,
+            user_prompt=user_prompt
+        )
+        try:
+            async with self._limiter.reserve(estimate_tokens(messages, config.AI_RATE_LIMIT_OUTPUT_TOKENS_ESTIMATE)) as reservation:
+                async for delta in stream_openai_chat(self._client, "openai", model=self._model_name, messages=messages):
+                    reservation.settle(delta.total_tokens)
+                    yield delta
+        except Exception as e:
+            logger.error(f"Ошибка от OpenAI API (поток): {e}", exc_info=True)
+            raise AIClientError(f"Произошла ошибка при обращении к GPT: {e}") from e
+
+    async def get_image_response(self, chat_history: List[Dict], text_prompt: str, image: PreparedImage, system_instruction: str = "") -> Tuple[str, int]:
         logger.info(f"Запрос к GPT Vision с моделью {self._model_name}")
-        logger.info(f"Размер изображения: {image.size}, формат: {image.format}") # Добавляем логирование размера
-        base64_image = _pil_to_base64(image)
+        logger.info(f"Размер изображения: {image.width}x{image.height}, {len(image.data)} байт, detail={image.detail}")
         messages = prepare_openai_history(
-            system_instruction_content=self._system_instruction_content,
+            system_instruction_content=system_instruction,
             chat_history=chat_history,
             user_prompt=""
         )
@@ -66,34 +219,46 @@ class GPTClient(BaseAIClient):
             "role": "user",
             "content": [
                 {"type": "text", "text": text_prompt},
-                {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}}
+                {"type": "image_url", "image_url": {"url": image.data_url(), "detail": image.detail}}
             ]
         })
         try:
-            response = await self._client.chat.completions.create(
-                model=self._model_name,
-                messages=messages,
-                max_completion_tokens=2048
-            )
-            response_text = response.choices[0].message.content
-            tokens_spent = response.usage.total_tokens if response.usage else 0
+            async with self._limiter.reserve(estimate_tokens([system_instruction, chat_history, text_prompt, image], 2048)) as reservation:
+                response = await call_with_retry(
+                    lambda: self._client.chat.completions.create(
+                        model=self._model_name,
+                        messages=messages,
+                        max_completion_tokens=2048
+                    ),
+                    provider="openai"
+                )
+                response_text = response.choices[0].message.content
+                record_openai_prompt_cache("openai", response.usage)
+                tokens_spent = response.usage.total_tokens if response.usage else 0
+                reservation.settle(tokens_spent)
             return response_text, tokens_spent
         except Exception as e:
             logger.error(f"Ошибка от OpenAI Vision API: {e}", exc_info=True)
-            return f"Произошла ошибка при обращении к GPT Vision: {e}", 0
+            raise AIClientError(f"Произошла ошибка при обращении к GPT Vision: {e}") from e
 
     # [Dev-Ассистент]: Изменена сигнатура метода generate_image для приема 'size'
     async def generate_image(self, prompt: str, size: str = "1024x1024") -> tuple[str | None, str | None]:
         logger.info(f"Запрос на генерацию изображения с моделью dall-e-3, размер: {size}") # [Dev-Ассистент]: Улучшенный лог
         try:
-            response = await self._client.images.generate(
-                model="dall-e-3",
-                prompt=prompt,
-                n=1,
-                size=size, # [Dev-Ассистент]: Используем переданный размер
-                quality="standard", # [Dev-Ассистент]: Оставляем "standard" как указано в задаче
-                response_format="url",
-            )
+            async with self._images_limiter.reserve():
+                # [Dev-Ассистент]: Генерация DALL-E 3 бывает дольше минуты - у попытки свой дедлайн.
+                response = await call_with_retry(
+                    lambda: self._client.images.generate(
+                        model="dall-e-3",
+                        prompt=prompt,
+                        n=1,
+                        size=size, # [Dev-Ассистент]: Используем переданный размер
+                        quality="standard", # [Dev-Ассистент]: Оставляем "standard" как указано в задаче
+                        response_format="url",
+                    ),
+                    provider="openai_images",
+                    policy=RetryPolicy(attempt_timeout=120, total_budget=180)
+                )
             image_url = response.data[0].url
             if not image_url:
                  return None, "Не удалось сгенерировать изображение. API не вернул URL."
@@ -131,21 +296,32 @@ class GPTClient(BaseAIClient):
             return 0 # Возвращаем 0 в случае ошибки
         
     # [Dev-Ассистент]: НОВЫЙ МЕТОД ДЛЯ ТРАНСКРИПЦИИ АУДИО
-    async def transcribe_audio(self, audio_bytes: bytes) -> str | None:
+    async def transcribe_audio(self, audio_bytes: bytes, filename: str = "voice.ogg") -> str | None:
         """
         Отправляет аудиофайл в OpenAI Whisper API для транскрипции.
-        :param audio_bytes: Аудиофайл в виде байтов (например, в формате mp3).
+        :param audio_bytes: Аудиофайл в виде байтов (ogg, webm, mp3 и другие форматы, которые принимает Whisper).
+        :param filename: Имя файла: по его расширению Whisper определяет формат.
         :return: Распознанный текст или None в случае ошибки.
+        :raises UnsupportedAudioError: Если Whisper не принял формат файла.
         """
-        logger.info("Отправка аудио в OpenAI Whisper для транскрипции...")
+        logger.info(f"Отправка аудио ({filename}, {len(audio_bytes)} байт) в OpenAI Whisper для транскрипции...")
         try:
             # Важно передавать файл как кортеж (имя_файла, байты)
-            transcript = await self._client.audio.transcriptions.create(
-                model="whisper-1",
-                file=("voice.mp3", audio_bytes)
-            )
+            async with self._audio_limiter.reserve():
+                transcript = await call_with_retry(
+                    lambda: self._client.audio.transcriptions.create(
+                        model="whisper-1",
+                        file=(filename, audio_bytes)
+                    ),
+                    provider="openai_audio"
+                )
             logger.info("Транскрипция выполнена успешно.")
             return transcript.text
+        except BadRequestError as e:
+            if _is_unsupported_audio_error(e):
+                raise UnsupportedAudioError(f"Whisper не принял файл {filename}.") from e
+            logger.error(f"Ошибка при транскрипции аудио через Whisper API: {e}", exc_info=True)
+            return None
         except Exception as e:
             logger.error(f"Ошибка при транскрипции аудио через Whisper API: {e}", exc_info=True)
-            return None
\ No newline at end of file
+            return None
@@ -0,0 +1,174 @@
+# ai_clients/health.py
+# [Dev-Ассистент]: Здоровье AI-провайдеров: скользящая доля ошибок, p95 латентности и автомат (circuit breaker).
+#
+# Автомат закрыт - запросы идут как обычно. После серии сбоев (подряд или по доле ошибок в окне) он
+# открывается: запросы к провайдеру не отправляются, factory.route_ai_client уводит их на запасную модель.
+# Через AI_CIRCUIT_OPEN_SECONDS автомат полуоткрыт: пропускается один пробный запрос, его успех закрывает
+# автомат, неудача - снова открывает. Учитываются только сбои провайдера (временные ошибки после повторов),
+# а не ошибки конкретного запроса вроде 400.
+
+import logging
+import time
+from collections import deque
+from typing import AsyncIterator, Deque, Dict, List, Optional, Tuple
+
+import config
+import metrics
+
+from .base_client import BaseAIClient, AIClientError, StreamDelta
+from .images import PreparedImage
+from .retry import is_transient
+
+logger = logging.getLogger(__name__)
+
+CIRCUIT_CLOSED = "closed"
+CIRCUIT_OPEN = "open"
+CIRCUIT_HALF_OPEN = "half_open"
+
+
+class ProviderHealth:
+    """Скользящая статистика и состояние автомата одного провайдера (идентификатор из constants)."""
+
+    def __init__(self, provider: str):
+        self.provider = provider
+        self.state = CIRCUIT_CLOSED
+        # [Dev-Ассистент]: (момент, успех, длительность) за последние AI_CIRCUIT_WINDOW_SECONDS.
+        self._outcomes: Deque[Tuple[float, bool, float]] = deque()
+        self._consecutive_failures = 0
+        self._opened_at = 0.0
+        self._probe_started_at: Optional[float] = None
+
+    def _trim(self, now: float) -> None:
+        border = now - config.AI_CIRCUIT_WINDOW_SECONDS
+        while self._outcomes and self._outcomes[0][0] < border:
+            self._outcomes.popleft()
+
+    def error_rate(self) -> float:
+        self._trim(time.monotonic())
+        if not self._outcomes:
+            return 0.0
+        return sum(1 for _, ok, _ in self._outcomes if not ok) / len(self._outcomes)
+
+    def p95_latency(self) -> Optional[float]:
+        """p95 длительности успешных запросов в окне или None, если их еще не было."""
+        self._trim(time.monotonic())
+        latencies = sorted(latency for _, ok, latency in self._outcomes if ok)
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+
+    def is_available(self) -> bool:
+        """Можно ли сейчас направить запрос к провайдеру (без резервирования пробного запроса)."""
+        now = time.monotonic()
+        if self.state == CIRCUIT_CLOSED:
+            return True
+        if self.state == CIRCUIT_OPEN:
+            return now - self._opened_at >= config.AI_CIRCUIT_OPEN_SECONDS
+        # [Dev-Ассистент]: Пробный запрос мог потеряться (задачу отменили до вызова) - не ждем его вечно.
+        return self._probe_started_at is None or now - self._probe_started_at >= config.AI_CIRCUIT_OPEN_SECONDS
+
+    def allow_request(self) -> bool:
+        """Как is_available, но в полуоткрытом состоянии занимает единственный пробный запрос."""
+        if not self.is_available():
+            return False
+        if self.state == CIRCUIT_OPEN:
+            self.state = CIRCUIT_HALF_OPEN
+            logger.info(f"Автомат провайдера {self.provider} полуоткрыт: пробный запрос.")
+        if self.state == CIRCUIT_HALF_OPEN:
+            self._probe_started_at = time.monotonic()
+        return True
+
+    def _open(self, now: float, reason: str) -> None:
+        self.state = CIRCUIT_OPEN
+        self._opened_at = now
+        self._probe_started_at = None
+        metrics.increment("ai_circuit_opened_total", provider=self.provider)
+        logger.warning(f"Автомат провайдера {self.provider} открыт на {config.AI_CIRCUIT_OPEN_SECONDS} с: {reason}.")
+
+    def record(self, ok: Optional[bool], latency: float) -> None:
+        """
+        Учитывает исход запроса. ok=None - исход не говорит о здоровье провайдера
+        (ошибка самого запроса, отмена): только освобождает пробный слот.
+        """
+        now = time.monotonic()
+        if ok is None:
+            self._probe_started_at = None
+            return
+
+        self._outcomes.append((now, ok, latency))
+        self._trim(now)
+        if ok:
+            metrics.observe("ai_provider_seconds", latency, provider=self.provider)
+        self._consecutive_failures = 0 if ok else self._consecutive_failures + 1
+
+        if self.state == CIRCUIT_HALF_OPEN:
+            if ok:
+                self.state = CIRCUIT_CLOSED
+                self._probe_started_at = None
+                self._outcomes.clear()
+                logger.info(f"Автомат провайдера {self.provider} закрыт: пробный запрос успешен.")
+            else:
+                self._open(now, "пробный запрос не удался")
+            return
+
+        if self.state == CIRCUIT_CLOSED and not ok:
+            if self._consecutive_failures >= config.AI_CIRCUIT_CONSECUTIVE_FAILURES:
+                self._open(now, f"{self._consecutive_failures} сбоев подряд")
+            elif len(self._outcomes) >= config.AI_CIRCUIT_MIN_CALLS and self.error_rate() >= config.AI_CIRCUIT_ERROR_RATE:
+                self._open(now, f"доля ошибок {self.error_rate():.0%} за {config.AI_CIRCUIT_WINDOW_SECONDS} с")
+
+
+def _is_provider_failure(error: AIClientError) -> bool:
+    # [Dev-Ассистент]: Без исходной причины (или при временной ошибке) считаем сбоем провайдера.
+    return error.__cause__ is None or is_transient(error.__cause__)
+
+
+class MonitoredClient(BaseAIClient):
+    """
+    Обертка AI-клиента, которая записывает исход и длительность текстовых/vision-запросов в ProviderHealth.
+    Остальные методы (generate_image, transcribe_audio, count_tokens) передаются клиенту как есть.
+    """
+
+    def __init__(self, client: BaseAIClient, health: ProviderHealth):
+        self._client = client
+        self._health = health
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    async def _observe(self, call):
+        started_at = time.monotonic()
+        ok = None
+        try:
+            result = await call
+            ok = True
+            return result
+        except AIClientError as e:
+            ok = False if _is_provider_failure(e) else None
+            raise
+        finally:
+            self._health.record(ok, time.monotonic() - started_at)
+
+    async def get_text_response(self, chat_history: List[Dict], user_prompt: str, system_instruction: str = "") -> Tuple[str, int]:
+        return await self._observe(self._client.get_text_response(chat_history, user_prompt, system_instruction=system_instruction))
+
+    async def get_image_response(self, chat_history: List[Dict], text_prompt: str, image: PreparedImage, system_instruction: str = "") -> Tuple[str, int]:
+        return await self._observe(self._client.get_image_response(chat_history, text_prompt, image, system_instruction=system_instruction))
+
+    async def stream_text_response(self, chat_history: List[Dict], user_prompt: str, system_instruction: str = "") -> AsyncIterator[StreamDelta]:
+        started_at = time.monotonic()
+        ok = None
+        first_delta = True
+        try:
+            async for delta in self._client.stream_text_response(chat_history, user_prompt, system_instruction=system_instruction):
+                if first_delta:
+                    # [Dev-Ассистент]: Время до первого фрагмента - порог хеджирования потоков (ai_clients.hedging).
+                    metrics.observe("ai_first_token_seconds", time.monotonic() - started_at, provider=self._health.provider)
+                    first_delta = False
+                yield delta
+            ok = True
+        except AIClientError as e:
+            ok = False if _is_provider_failure(e) else None
+            raise
+        finally:
+            self._health.record(ok, time.monotonic() - started_at)
@@ -0,0 +1,141 @@
+# ai_clients/hedging.py
+# [Dev-Ассистент]: Хеджирование коротких текстовых запросов.
+#
+# Запрос уходит в основную модель. Если она не ответила за адаптивный порог (AI_HEDGE_PERCENTILE ее латентности
+# по metrics), тот же запрос уходит во вторую модель тарифа, и побеждает первый успешный ответ; проигравший
+# отменяется. Для потока порог считается по времени до первого фрагмента, а гонка идет до первого фрагмента.
+# Дубль не бесплатный: лимитер провайдера оставляет за отмененным запросом его резерв токенов, а оценка
+# потраченных впустую токенов копится в метрике ai_hedge_wasted_tokens_total.
+
+import asyncio
+import logging
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple, TypeVar
+
+import config
+import metrics
+
+from .base_client import BaseAIClient, StreamDelta
+from .images import PreparedImage
+from .rate_limiter import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class HedgedClient(BaseAIClient):
+    """
+    Клиент на один запрос: основная и запасная модели. После вызова в answered_provider - модель,
+    чей ответ получен. Методы, кроме текстовых, передаются основному клиенту.
+    """
+
+    def __init__(self, primary: Tuple[str, BaseAIClient], secondary: Tuple[str, BaseAIClient]):
+        self._primary_provider, self._primary = primary
+        self._secondary_provider, self._secondary = secondary
+        self.answered_provider = self._primary_provider
+
+    def __getattr__(self, name):
+        return getattr(self._primary, name)
+
+    def _threshold(self, metric_name: str) -> Optional[float]:
+        latency = metrics.percentile(
+            metric_name, config.AI_HEDGE_PERCENTILE,
+            min_samples=config.AI_HEDGE_MIN_SAMPLES, provider=self._primary_provider
+        )
+        if latency is None:
+            return None
+        return max(latency, config.AI_HEDGE_MIN_DELAY_SECONDS)
+
+    async def _race(
+        self,
+        start: Callable[[BaseAIClient], Awaitable[T]],
+        threshold: Optional[float],
+        wasted_tokens: int,
+        discard: Optional[Callable[[T], Awaitable[None]]] = None
+    ) -> T:
+        """
+        Запускает start(основной); если он не завершился за threshold - еще и start(запасной).
+        Возвращает первый успешный результат. Если оба упали - пробрасывает ошибку основного.
+
+        :param wasted_tokens: Оценка токенов, которые провайдер спишет за отмененный дубль.
+        :param discard: Как освободить результат проигравшего, если он тоже успел завершиться (например, закрыть поток).
+        """
+        primary = asyncio.ensure_future(start(self._primary))
+        tasks = {primary: self._primary_provider}
+        try:
+            if threshold is not None:
+                await asyncio.wait({primary}, timeout=threshold)
+            if primary.done() or threshold is None:
+                self.answered_provider = self._primary_provider
+                return await primary
+
+            logger.info(f"Хеджирование: {self._primary_provider} молчит дольше {threshold:.1f} с, дублируем в {self._secondary_provider}.")
+            metrics.increment("ai_hedge_total", provider=self._primary_provider, outcome="fired")
+            secondary = asyncio.ensure_future(start(self._secondary))
+            tasks[secondary] = self._secondary_provider
+
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winner = None
+                for task in done:
+                    # [Dev-Ассистент]: exception() читаем у всех завершившихся, иначе asyncio ругается на "never retrieved".
+                    if not task.cancelled() and task.exception() is None and winner is None:
+                        winner = task
+                if winner is None:
+                    continue
+                self.answered_provider = tasks[winner]
+                metrics.increment(
+                    "ai_hedge_total", provider=self._primary_provider,
+                    outcome="primary_won" if winner is primary else "secondary_won"
+                )
+                for loser in tasks:
+                    if loser is winner:
+                        continue
+                    if loser.done() and not loser.cancelled() and loser.exception() is None and discard:
+                        await discard(loser.result())
+                    metrics.increment("ai_hedge_wasted_tokens_total", value=wasted_tokens, provider=tasks[loser])
+                return winner.result()
+            # [Dev-Ассистент]: Обе модели упали - отдаем ошибку основной, как без хеджирования.
+            return primary.result()
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    async def get_text_response(self, chat_history: List[Dict], user_prompt: str, system_instruction: str = "") -> Tuple[str, int]:
+        return await self._race(
+            lambda client: client.get_text_response(chat_history, user_prompt, system_instruction=system_instruction),
+            self._threshold("ai_provider_seconds"),
+            estimate_tokens([system_instruction, chat_history, user_prompt])
+        )
+
+    async def get_image_response(self, chat_history: List[Dict], text_prompt: str, image: PreparedImage, system_instruction: str = "") -> Tuple[str, int]:
+        # [Dev-Ассистент]: Запросы с изображением не дублируем - они дорогие и не относятся к коротким репликам.
+        return await self._primary.get_image_response(chat_history, text_prompt, image, system_instruction=system_instruction)
+
+    async def stream_text_response(self, chat_history: List[Dict], user_prompt: str, system_instruction: str = "") -> AsyncIterator[StreamDelta]:
+        async def open_stream(client: BaseAIClient) -> Tuple[AsyncIterator[StreamDelta], Optional[StreamDelta]]:
+            stream = client.stream_text_response(chat_history, user_prompt, system_instruction=system_instruction)
+            try:
+                return stream, await stream.__anext__()
+            except StopAsyncIteration:
+                return stream, None
+
+        async def close_stream(opened: Tuple[AsyncIterator[StreamDelta], Optional[StreamDelta]]) -> None:
+            await opened[0].aclose()
+
+        stream, first_delta = await self._race(
+            open_stream,
+            self._threshold("ai_first_token_seconds"),
+            estimate_tokens([system_instruction, chat_history, user_prompt]),
+            discard=close_stream
+        )
+        try:
+            if first_delta is None:
+                return
+            yield first_delta
+            async for delta in stream:
+                yield delta
+        finally:
+            await stream.aclose()
@@ -0,0 +1,107 @@
+# ai_clients/images.py
+# [Dev-Ассистент]: Подготовка изображений для vision-моделей.
+#
+# Из размеров фото Telegram берется наименьший, которого хватает модели (select_photo_size): лишние пиксели
+# не нужно ни скачивать, ни отправлять, модель все равно их ужмет. JPEG, который уже укладывается в предел,
+# уходит провайдеру как есть; остальное уменьшается и кодируется в JPEG в пуле потоков, а не в цикле событий.
+# Уровень детализации (detail) задается тарифом: "low" - одна плитка 512px и фиксированная цена в токенах.
+
+import asyncio
+import base64
+import math
+from io import BytesIO
+from typing import NamedTuple, Sequence
+
+from PIL import Image
+
+import config
+
+VISION_DETAIL_LOW = "low"
+VISION_DETAIL_HIGH = "high"
+VISION_DETAIL_AUTO = "auto"
+
+# [Dev-Ассистент]: Цена изображения по правилам OpenAI: база + плитки 512x512 (low - только база).
+_BASE_IMAGE_TOKENS = 85
+_TILE_IMAGE_TOKENS = 170
+_TILE_SIZE = 512
+
+
+class PreparedImage(NamedTuple):
+    """Изображение, готовое к отправке в vision-модель: закодированные байты и их размеры."""
+    data: bytes
+    mime_type: str
+    width: int
+    height: int
+    detail: str = VISION_DETAIL_AUTO
+
+    def data_url(self) -> str:
+        """data: URL для image_url OpenAI-совместимых API."""
+        return f"data:{self.mime_type};base64,{base64.b64encode(self.data).decode('ascii')}"
+
+    def estimated_tokens(self) -> int:
+        """Оценка входных токенов изображения (по правилам OpenAI; для лимитера, не для биллинга)."""
+        if self.detail == VISION_DETAIL_LOW:
+            return _BASE_IMAGE_TOKENS
+        width, height = _fit(self.width, self.height, config.VISION_HIGH_DETAIL_MAX_SIDE, config.VISION_HIGH_DETAIL_SHORT_SIDE)
+        tiles = math.ceil(width / _TILE_SIZE) * math.ceil(height / _TILE_SIZE)
+        return _BASE_IMAGE_TOKENS + _TILE_IMAGE_TOKENS * tiles
+
+
+def _fit(width: int, height: int, max_side: int, short_side: int = 0) -> tuple:
+    """Размер после уменьшения так, как это делает модель: длинная сторона <= max_side, короткая <= short_side."""
+    scale = min(1.0, max_side / max(width, height))
+    if short_side:
+        scale = min(scale, short_side / min(width, height))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def _limits(detail: str) -> tuple:
+    """(предел длинной стороны, полезная короткая сторона) для уровня детализации."""
+    if detail == VISION_DETAIL_LOW:
+        return config.VISION_LOW_DETAIL_MAX_SIDE, 0
+    return config.VISION_HIGH_DETAIL_MAX_SIDE, config.VISION_HIGH_DETAIL_SHORT_SIDE
+
+
+def select_photo_size(photo_sizes: Sequence, detail: str):
+    """
+    Выбирает из update.message.photo (telegram.PhotoSize) наименьший размер, которого модели хватает
+    при этом detail. Если все размеры меньше полезного, берется самый большой.
+    """
+    max_side, short_side = _limits(detail)
+    ordered = sorted(photo_sizes, key=lambda size: size.width * size.height)
+    for size in ordered:
+        if max(size.width, size.height) >= max_side or (short_side and min(size.width, size.height) >= short_side):
+            return size
+    return ordered[-1]
+
+
+def _prepare_sync(data: bytes, detail: str) -> PreparedImage:
+    max_side, _ = _limits(detail)
+    with Image.open(BytesIO(data)) as image:
+        width, height = image.size
+        # [Dev-Ассистент]: До короткой стороны 768 модель ужмет сама и за те же токены - ради этого не перекодируем.
+        target = _fit(width, height, max_side)
+        # [Dev-Ассистент]: Исходный JPEG в пределах длинной стороны отправляем байт в байт - без потерь качества и CPU.
+        if image.format == "JPEG" and target == (width, height):
+            return PreparedImage(data, "image/jpeg", width, height, detail)
+
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        if target != (width, height):
+            image = image.resize(target, Image.Resampling.LANCZOS)
+        buffered = BytesIO()
+        image.save(buffered, format="JPEG", quality=config.VISION_JPEG_QUALITY)
+        return PreparedImage(buffered.getvalue(), "image/jpeg", target[0], target[1], detail)
+
+
+async def prepare_image(data: bytes, detail: str = VISION_DETAIL_AUTO) -> PreparedImage:
+    """
+    Готовит скачанное изображение для vision-модели: уменьшает до полезного для detail размера
+    и кодирует в JPEG в пуле потоков (исходный JPEG подходящего размера не трогает).
+
+    :param data: Байты изображения (любой формат, который открывает Pillow).
+    :param detail: Уровень детализации тарифа (VISION_DETAIL_*).
+    :return: PreparedImage.
+    :raises PIL.UnidentifiedImageError: Если байты не являются изображением.
+    """
+    return await asyncio.to_thread(_prepare_sync, data, detail)
@@ -1,39 +1,26 @@
 # ai_clients/openrouter_client.py
 
 import logging
-from typing import List, Dict, Tuple
-from PIL.Image import Image
-from openai import AsyncOpenAI, RateLimitError, Timeout
-import base64
-from io import BytesIO
+from typing import List, Dict, Tuple, AsyncIterator
+from openai import AsyncOpenAI, RateLimitError
 
 import config 
-from .base_client import BaseAIClient
+from .base_client import BaseAIClient, StreamDelta, AIClientError
+from .images import PreparedImage
 # <<< ИЗМЕНЕНИЕ: Импортируем нашу утилиту. Убедись, что имя файла верное (aiutils). >>>
-from .aiutils import prepare_openai_history
+from .aiutils import prepare_openai_history, stream_openai_chat, record_openai_prompt_cache
+from .rate_limiter import get_rate_limiter, estimate_tokens
+from .retry import call_with_retry
 
 logger = logging.getLogger(__name__)
 
-# Функция _pil_to_base64 остается без изменений
-def _pil_to_base64(image: Image) -> str:
-    buffered = BytesIO()
-    if image.mode == 'RGBA':
-        image = image.convert('RGB')
-    image.save(buffered, format="JPEG")
-    img_bytes = buffered.getvalue()
-    return base64.b64encode(img_bytes).decode('utf-8')
-
-
 class OpenRouterClient(BaseAIClient):
-    def __init__(self, api_key: str, system_instruction: str, model_name: str):
-        self._client = AsyncOpenAI(
-            api_key=api_key,
-            base_url=config.OPENROUTER_API_BASE_URL,
-            timeout=Timeout(60.0)
-        )
+    def __init__(self, client: AsyncOpenAI, model_name: str):
+        # [Dev-Ассистент]: SDK-клиент с base_url OpenRouter общий на процесс - его выдает ai_clients.factory.
+        self._client = client
         self._model_name = model_name
-        # <<< ИЗМЕНЕНИЕ: Сохраняем только текст системной инструкции >>>
-        self._system_instruction_content = system_instruction
+        # [Dev-Ассистент]: Все модели OpenRouter с одним ключом делят одну очередь - без нее всплеск упирается в 429.
+        self._limiter = get_rate_limiter("openrouter", client.api_key)
         
         self._extra_headers = {
             "HTTP-Referer": config.OPENROUTER_SITE_URL,
@@ -42,42 +29,74 @@ class OpenRouterClient(BaseAIClient):
         
         logger.info(f"Клиент OpenRouter инициализирован с моделью: '{model_name}'.")
 
-    async def get_text_response(self, chat_history: List[Dict], user_prompt: str) -> Tuple[str, int]:
+    def _rate_limit_message(self, e: RateLimitError) -> str:
+        """Логирует Rate Limit и формирует понятное пользователю сообщение с деталями от провайдера."""
+        logger.warning(f"Достигнут Rate Limit для модели {self._model_name} через OpenRouter: {e}")
+        error_details = "Сервер временно перегружен, попробуйте позже."
+        if e.body and 'error' in e.body and e.body['error'].get('metadata', {}).get('raw'):
+            error_details = f"Ошибка от провайдера: {e.body['error']['metadata']['raw']}"
+        return f"😔 К сожалению, модель сейчас недоступна. {error_details}"
+
+    async def get_text_response(self, chat_history: List[Dict], user_prompt: str, system_instruction: str = "") -> Tuple[str, int]:
         
         # <<< ИЗМЕНЕНИЕ: Заменяем дублирующийся код на вызов нашей утилиты >>>
         messages = prepare_openai_history(
-            system_instruction_content=self._system_instruction_content,
+            system_instruction_content=system_instruction,
             chat_history=chat_history,
             user_prompt=user_prompt
         )
         
         try:
-            response = await self._client.chat.completions.create(
-                model=self._model_name, 
-                messages=messages, 
-                extra_headers=self._extra_headers
-            )
-            response_text = response.choices[0].message.content
-            tokens_spent = response.usage.total_tokens if response.usage else 0
+            async with self._limiter.reserve(estimate_tokens(messages, config.AI_RATE_LIMIT_OUTPUT_TOKENS_ESTIMATE)) as reservation:
+                response = await call_with_retry(
+                    lambda: self._client.chat.completions.create(
+                        model=self._model_name, 
+                        messages=messages, 
+                        extra_headers=self._extra_headers
+                    ),
+                    provider="openrouter"
+                )
+                response_text = response.choices[0].message.content
+                record_openai_prompt_cache("openrouter", response.usage)
+                tokens_spent = response.usage.total_tokens if response.usage else 0
+                reservation.settle(tokens_spent)
             return response_text, tokens_spent
         except RateLimitError as e:
-            logger.warning(f"Достигнут Rate Limit для модели {self._model_name} через OpenRouter: {e}")
-            error_details = "Сервер временно перегружен, попробуйте позже."
-            if e.body and 'error' in e.body and e.body['error'].get('metadata', {}).get('raw'):
-                error_details = f"Ошибка от провайдера: {e.body['error']['metadata']['raw']}"
-            return f"😔 К сожалению, модель сейчас недоступна. {error_details}", 0
+            raise AIClientError(self._rate_limit_message(e)) from e
         except Exception as e:
             logger.error(f"Ошибка от OpenRouter API: {e}", exc_info=True)
-            return f"Произошла ошибка при обращении к OpenRouter: {e}", 0
+            raise AIClientError(f"Произошла ошибка при обращении к OpenRouter: {e}") from e
+
+    async def stream_text_response(self, chat_history: List[Dict], user_prompt: str, system_instruction: str = "") -> AsyncIterator[StreamDelta]:
+        messages = prepare_openai_history(
+            system_instruction_content=system_instruction,
+            chat_history=chat_history,
+            user_prompt=user_prompt
+        )
+        try:
+            async with self._limiter.reserve(estimate_tokens(messages, config.AI_RATE_LIMIT_OUTPUT_TOKENS_ESTIMATE)) as reservation:
+                async for delta in stream_openai_chat(
+                    self._client,
+                    "openrouter",
+                    model=self._model_name,
+                    messages=messages,
+                    extra_headers=self._extra_headers
+                ):
+                    reservation.settle(delta.total_tokens)
+                    yield delta
+        except RateLimitError as e:
+            raise AIClientError(self._rate_limit_message(e)) from e
+        except Exception as e:
+            logger.error(f"Ошибка от OpenRouter API (поток): {e}", exc_info=True)
+            raise AIClientError(f"Произошла ошибка при обращении к OpenRouter: {e}") from e
 
     # Метод get_image_response также обновляем для использования утилиты
-    async def get_image_response(self, chat_history: List[Dict], text_prompt: str, image: Image) -> Tuple[str, int]:
+    async def get_image_response(self, chat_history: List[Dict], text_prompt: str, image: PreparedImage, system_instruction: str = "") -> Tuple[str, int]:
         logger.info(f"Запрос к Vision модели {self._model_name} через OpenRouter")
-        base64_image = _pil_to_base64(image)
         
         # <<< ИЗМЕНЕНИЕ: Готовим историю с помощью утилиты >>>
         messages = prepare_openai_history(
-            system_instruction_content=self._system_instruction_content,
+            system_instruction_content=system_instruction,
             chat_history=chat_history,
             user_prompt="" # Передаем пустой промпт, т.к. добавим его ниже в специальном формате
         )
@@ -89,26 +108,28 @@ class OpenRouterClient(BaseAIClient):
             "role": "user", 
             "content": [
                 {"type": "text", "text": text_prompt}, 
-                {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}}
+                {"type": "image_url", "image_url": {"url": image.data_url(), "detail": image.detail}}
             ]
         })
         
         try:
-            response = await self._client.chat.completions.create(
-                model=self._model_name, 
-                messages=messages, 
-                max_tokens=2048, 
-                extra_headers=self._extra_headers
-            )
-            response_text = response.choices[0].message.content
-            tokens_spent = response.usage.total_tokens if response.usage else 0
+            async with self._limiter.reserve(estimate_tokens([system_instruction, chat_history, text_prompt, image], 2048)) as reservation:
+                response = await call_with_retry(
+                    lambda: self._client.chat.completions.create(
+                        model=self._model_name, 
+                        messages=messages, 
+                        max_tokens=2048, 
+                        extra_headers=self._extra_headers
+                    ),
+                    provider="openrouter"
+                )
+                response_text = response.choices[0].message.content
+                record_openai_prompt_cache("openrouter", response.usage)
+                tokens_spent = response.usage.total_tokens if response.usage else 0
+                reservation.settle(tokens_spent)
             return response_text, tokens_spent
         except RateLimitError as e:
-            logger.warning(f"Достигнут Rate Limit для модели {self._model_name} через OpenRouter: {e}")
-            error_details = "Сервер временно перегружен, попробуйте позже."
-            if e.body and 'error' in e.body and e.body['error'].get('metadata', {}).get('raw'):
-                error_details = f"Ошибка от провайдера: {e.body['error']['metadata']['raw']}"
-            return f"😔 К сожалению, модель сейчас недоступна. {error_details}", 0
+            raise AIClientError(self._rate_limit_message(e)) from e
         except Exception as e:
             logger.error(f"Ошибка от OpenRouter Vision API: {e}", exc_info=True)
-            return f"Произошла ошибка при обращении к OpenRouter Vision: {e}", 0
\ No newline at end of file
+            raise AIClientError(f"Произошла ошибка при обращении к OpenRouter Vision: {e}") from e
\ No newline at end of file
@@ -0,0 +1,224 @@
+# ai_clients/rate_limiter.py
+# [Dev-Ассистент]: Ограничитель исходящих запросов к AI-провайдерам (RPM + оценка TPM) с очередью по приоритету тарифа.
+#
+# Каждый лимитер - два "ведра токенов": запросы в минуту и токены в минуту. Запрос резервирует 1 запрос и
+# оценку токенов, после ответа резерв поправляется по фактическому usage. Если ведра пусты, ожидающие стоят
+# в куче по приоритету (VIP/Gold раньше Free), внутри одного приоритета - по порядку прихода.
+# Лимитер один на пару (название лимита, API-ключ): модели с общим ключом делят общую квоту.
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Tuple
+
+import config
+
+from .images import PreparedImage
+
+logger = logging.getLogger(__name__)
+
+# [Dev-Ассистент]: Грубая оценка для резерва: кириллица в токенайзерах OpenAI - примерно 3 символа на токен.
+CHARS_PER_TOKEN_ESTIMATE = 3
+# [Dev-Ассистент]: Изображение во входе vision-модели - фиксированная оценка (detail=auto для JPEG до 2048px).
+IMAGE_TOKENS_ESTIMATE = 1000
+
+# [Dev-Ассистент]: Приоритет запросов текущей задачи (больше - раньше). Обработчик выставляет его из тарифа пользователя
+# [Dev-Ассистент]: перед запросами к AI (main.process_ai_request, handle_message, handle_voice_message);
+# [Dev-Ассистент]: задачи, созданные из обработчика, его наследуют.
+BACKGROUND_PRIORITY = 0  # [Dev-Ассистент]: Фоновые задачи (суммаризация): наравне с Free, после платных тарифов
+_request_priority: ContextVar[int] = ContextVar("ai_request_priority", default=BACKGROUND_PRIORITY)
+
+
+def set_request_priority(priority: int) -> None:
+    """Задает приоритет запросов к AI для текущей задачи asyncio (обычно - уровень тарифа пользователя)."""
+    _request_priority.set(priority)
+
+
+def estimate_tokens(messages: Iterable, output_tokens: int = 0) -> int:
+    """
+    Оценивает, сколько токенов займет запрос, до его отправки.
+
+    :param messages: Сообщения в формате OpenAI ('content') или Gemini ('parts'), либо строки и PreparedImage.
+    :param output_tokens: Ожидаемый размер ответа (для TPM провайдеры учитывают и его).
+    :return: Оценка общего количества токенов.
+    """
+    chars = 0
+    images = 0
+    image_tokens = 0
+    pending = list(messages)
+    while pending:
+        item = pending.pop()
+        if isinstance(item, str):
+            chars += len(item)
+        elif isinstance(item, PreparedImage):
+            image_tokens += item.estimated_tokens()
+        elif isinstance(item, dict):
+            if "type" in item and item["type"] == "image_url":
+                images += 1
+            pending.extend(item[key] for key in ("content", "parts", "text") if key in item)
+        elif isinstance(item, (list, tuple)):
+            pending.extend(item)
+        elif item is not None:
+            # [Dev-Ассистент]: PIL.Image в parts Gemini.
+            images += 1
+    return chars // CHARS_PER_TOKEN_ESTIMATE + images * IMAGE_TOKENS_ESTIMATE + image_tokens + output_tokens
+
+
+class _TokenBucket:
+    """Ведро токенов: емкость capacity, пополняется равномерно со скоростью capacity в минуту."""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._rate_per_second = capacity / 60.0
+        self._available = float(capacity)
+        self._updated_at = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._available = min(self.capacity, self._available + (now - self._updated_at) * self._rate_per_second)
+        self._updated_at = now
+
+    def seconds_until(self, amount: int) -> float:
+        self._refill()
+        missing = amount - self._available
+        return max(0.0, missing / self._rate_per_second)
+
+    def take(self, amount: int) -> None:
+        self._refill()
+        self._available -= amount
+
+    def give_back(self, amount: int) -> None:
+        # [Dev-Ассистент]: amount может быть отрицательным (ответ оказался больше оценки) - тогда ведро уходит в минус
+        # [Dev-Ассистент]: и следующие запросы подождут, пока перерасход не "отработается".
+        self._refill()
+        self._available = min(self.capacity, self._available + amount)
+
+
+class RateLimitReservation:
+    """Резерв одного запроса. Клиент сообщает фактический расход через settle()."""
+
+    def __init__(self, estimated_tokens: int):
+        self.estimated_tokens = estimated_tokens
+        self.actual_tokens: Optional[int] = None
+
+    def settle(self, actual_tokens: int) -> None:
+        """Запоминает фактическое количество токенов из usage ответа (0 - неизвестно, резерв не трогаем)."""
+        if actual_tokens:
+            self.actual_tokens = actual_tokens
+
+
+class RateLimiter:
+    """Асинхронный лимитер запросов/токенов в минуту с приоритетной очередью ожидающих."""
+
+    def __init__(self, name: str, requests_per_minute: Optional[int], tokens_per_minute: Optional[int]):
+        self.name = name
+        self._requests = _TokenBucket(requests_per_minute) if requests_per_minute else None
+        self._tokens = _TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        # [Dev-Ассистент]: Элементы кучи: [-приоритет, порядковый номер, токены, future].
+        self._waiters: List[list] = []
+        self._sequence = itertools.count()
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    def _seconds_until_available(self, tokens: int) -> float:
+        delay = 0.0
+        if self._requests:
+            delay = self._requests.seconds_until(1)
+        if self._tokens:
+            delay = max(delay, self._tokens.seconds_until(tokens))
+        return delay
+
+    def _take(self, tokens: int) -> None:
+        if self._requests:
+            self._requests.take(1)
+        if self._tokens:
+            self._tokens.take(tokens)
+
+    def _give_back(self, requests: int, tokens: int) -> None:
+        if self._requests and requests:
+            self._requests.give_back(requests)
+        if self._tokens and tokens:
+            self._tokens.give_back(tokens)
+
+    def _dispatch(self) -> None:
+        """Пропускает ожидающих по порядку кучи, пока хватает квоты; иначе ставит таймер до ее пополнения."""
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        while self._waiters:
+            _, _, tokens, future = self._waiters[0]
+            if future.done():  # Ожидание отменено
+                heapq.heappop(self._waiters)
+                continue
+            delay = self._seconds_until_available(tokens)
+            if delay > 0:
+                self._timer = asyncio.get_running_loop().call_later(delay, self._dispatch)
+                return
+            heapq.heappop(self._waiters)
+            self._take(tokens)
+            future.set_result(None)
+
+    async def _acquire(self, tokens: int) -> int:
+        if self._tokens:
+            # [Dev-Ассистент]: Запрос больше минутной квоты иначе не дождался бы своей очереди никогда.
+            tokens = min(tokens, self._tokens.capacity)
+        if not self._waiters and self._seconds_until_available(tokens) == 0:
+            self._take(tokens)
+            return tokens
+
+        priority = _request_priority.get()
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, [-priority, next(self._sequence), tokens, future])
+        self._dispatch()
+        logger.info(f"Лимитер '{self.name}': запрос ждет квоту (приоритет {priority}, в очереди {len(self._waiters)}).")
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # [Dev-Ассистент]: Квоту уже выдали, но запрос отменен - возвращаем ее следующим.
+                self._give_back(1, tokens)
+            else:
+                future.cancel()
+            self._dispatch()
+            raise
+        return tokens
+
+    @asynccontextmanager
+    async def reserve(self, estimated_tokens: int = 0) -> AsyncIterator[RateLimitReservation]:
+        """
+        Ждет квоту на один запрос и оценку токенов. После выхода из блока резерв
+        поправляется по reservation.settle(фактические_токены).
+        """
+        if not self._requests and not self._tokens:
+            yield RateLimitReservation(estimated_tokens)
+            return
+
+        reservation = RateLimitReservation(await self._acquire(estimated_tokens))
+        try:
+            yield reservation
+        finally:
+            if self._tokens and reservation.actual_tokens is not None:
+                self._give_back(0, reservation.estimated_tokens - reservation.actual_tokens)
+            if self._waiters:
+                self._dispatch()
+
+
+# --- Реестр лимитеров ---
+_limiters: Dict[Tuple[str, str], RateLimiter] = {}
+
+
+def get_rate_limiter(limit_name: str, api_key: str) -> RateLimiter:
+    """
+    Возвращает общий на процесс лимитер для квоты limit_name (ключ config.AI_RATE_LIMITS) и API-ключа.
+    Квота без настроек в конфиге не ограничивается.
+    """
+    key = (limit_name, api_key or "")
+    limiter = _limiters.get(key)
+    if limiter is None:
+        limits = config.AI_RATE_LIMITS.get(limit_name, {})
+        limiter = RateLimiter(limit_name, limits.get("rpm"), limits.get("tpm"))
+        _limiters[key] = limiter
+    return limiter
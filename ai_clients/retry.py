@@ -0,0 +1,159 @@
+# ai_clients/retry.py
+# [Dev-Ассистент]: Единая политика повторов для всех AI-клиентов.
+#
+# Повторяем только временные сбои: 408/409/429/5xx, обрывы соединения и таймаут попытки. Пауза - экспоненциальная
+# с полным джиттером, но не меньше Retry-After от провайдера. У каждой попытки свой дедлайн, у всех вместе -
+# общий бюджет времени: если следующая пауза в него не влезает, сразу отдаем ошибку. Встроенные повторы
+# SDK OpenAI отключены (max_retries=0 в factory), чтобы попытки не умножались.
+
+import asyncio
+import email.utils
+import logging
+import random
+import time
+from typing import Awaitable, Callable, NamedTuple, Optional, TypeVar
+
+import aiohttp
+import openai
+from google.api_core import exceptions as google_exceptions
+
+import config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+RETRYABLE_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+# [Dev-Ассистент]: Коды ошибок, пришедших событием посреди потока (у них нет HTTP-статуса), которые означают сбой
+# [Dev-Ассистент]: на стороне провайдера. Остальные коды (invalid_prompt, invalid_image, ...) - отказ в самом запросе.
+TRANSIENT_STREAM_ERROR_CODES = {None, "server_error", "rate_limit_exceeded", "vector_store_timeout"}
+
+
+class RetryPolicy(NamedTuple):
+    """Параметры повторов. Значения по умолчанию - из config.AI_RETRY_*."""
+    max_attempts: int = config.AI_RETRY_MAX_ATTEMPTS
+    base_delay: float = config.AI_RETRY_BASE_DELAY_SECONDS
+    max_delay: float = config.AI_RETRY_MAX_DELAY_SECONDS
+    attempt_timeout: float = config.AI_RETRY_ATTEMPT_TIMEOUT_SECONDS
+    total_budget: float = config.AI_RETRY_TOTAL_BUDGET_SECONDS
+
+
+DEFAULT_RETRY_POLICY = RetryPolicy()
+
+
+class ProviderHTTPError(Exception):
+    """Ответ провайдера с неуспешным HTTP-статусом (для клиентов на aiohttp, у которых нет своих исключений)."""
+
+    def __init__(self, status: int, body: str = "", retry_after: Optional[str] = None):
+        super().__init__(f"HTTP {status}: {body}")
+        self.status = status
+        self.body = body
+        self.retry_after = retry_after
+
+
+def _status_of(error: BaseException) -> Optional[int]:
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code
+    if isinstance(error, google_exceptions.GoogleAPICallError):
+        return error.code
+    if isinstance(error, (ProviderHTTPError, aiohttp.ClientResponseError)):
+        return error.status
+    return None
+
+
+def is_transient(error: BaseException) -> bool:
+    """Можно ли повторить запрос после такой ошибки."""
+    if isinstance(error, (asyncio.TimeoutError, openai.APIConnectionError, aiohttp.ClientConnectionError)):
+        return True
+    if isinstance(error, openai.RateLimitError) and getattr(error, "code", None) == "insufficient_quota":
+        # [Dev-Ассистент]: 429 "закончились деньги на счете" - повтор не поможет.
+        return False
+    if isinstance(error, openai.APIError) and not isinstance(error, (openai.APIStatusError, openai.APIResponseValidationError)):
+        return error.code in TRANSIENT_STREAM_ERROR_CODES
+    return _status_of(error) in RETRYABLE_STATUSES
+
+
+def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+def retry_after_seconds(error: BaseException) -> Optional[float]:
+    """Достает Retry-After (retry-after-ms у OpenAI) из ошибки, если провайдер его прислал."""
+    if isinstance(error, ProviderHTTPError):
+        return _parse_retry_after(error.retry_after)
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms:
+        try:
+            return max(0.0, float(retry_after_ms) / 1000)
+        except ValueError:
+            pass
+    return _parse_retry_after(headers.get("retry-after"))
+
+
+def _reason(error: BaseException) -> str:
+    status = _status_of(error)
+    return str(status) if status else type(error).__name__
+
+
+async def call_with_retry(
+    operation: Callable[[], Awaitable[T]],
+    provider: str,
+    policy: RetryPolicy = DEFAULT_RETRY_POLICY
+) -> T:
+    """
+    Выполняет operation() с повторами временных ошибок по policy.
+
+    :param operation: Фабрика корутины одной попытки (вызывается заново на каждую попытку).
+    :param provider: Имя провайдера для логов и метрик (ai_requests_total, ai_retries_total, ai_request_seconds).
+    :param policy: Параметры повторов.
+    :return: Результат успешной попытки. После последней неудачной попытки пробрасывается ее исключение.
+    """
+    loop = asyncio.get_running_loop()
+    started_at = loop.time()
+    deadline = started_at + policy.total_budget
+    attempt = 0
+    while True:
+        attempt += 1
+        attempt_started_at = loop.time()
+        timeout = min(policy.attempt_timeout, max(deadline - attempt_started_at, 0.0))
+        try:
+            result = await asyncio.wait_for(operation(), timeout=timeout)
+        except Exception as e:
+            elapsed = loop.time() - started_at
+            if attempt >= policy.max_attempts or not is_transient(e):
+                metrics.increment("ai_requests_total", provider=provider, outcome="error")
+                if attempt > 1:
+                    logger.warning(f"{provider}: запрос не удался после {attempt} попыток за {elapsed:.1f} с: {e!r}")
+                raise
+
+            backoff = random.uniform(0, min(policy.max_delay, policy.base_delay * 2 ** (attempt - 1)))
+            server_delay = retry_after_seconds(e)
+            delay = max(backoff, server_delay or 0.0)
+            if loop.time() + delay >= deadline:
+                metrics.increment("ai_requests_total", provider=provider, outcome="error")
+                logger.warning(f"{provider}: пауза {delay:.1f} с перед повтором не укладывается в бюджет {policy.total_budget:g} с: {e!r}")
+                raise
+
+            metrics.increment("ai_retries_total", provider=provider, reason=_reason(e))
+            logger.info(f"{provider}: временная ошибка ({_reason(e)}), попытка {attempt + 1}/{policy.max_attempts} через {delay:.2f} с.")
+            await asyncio.sleep(delay)
+            continue
+
+        metrics.increment("ai_requests_total", provider=provider, outcome="ok")
+        metrics.observe("ai_request_seconds", loop.time() - attempt_started_at, provider=provider)
+        return result
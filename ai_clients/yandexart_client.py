@@ -7,13 +7,171 @@ import asyncio
 import time
 import json
 import base64
-from typing import Tuple, Dict
+from typing import Tuple, Dict, Optional
 import aiohttp
 
+import config
+import metrics
+from .rate_limiter import get_rate_limiter
+from .retry import call_with_retry, ProviderHTTPError, RetryPolicy
+
 logger = logging.getLogger(__name__)
 
 IMAGE_API_URL = "https://llm.api.cloud.yandex.net/foundationModels/v1/imageGenerationAsync"
 OPERATION_API_URL_TEMPLATE = "https://operation.api.cloud.yandex.net/operations/{}"
+# [Dev-Ассистент]: Опрос операции - короткие запросы, долго повторять один опрос незачем.
+POLL_RETRY_POLICY = RetryPolicy(attempt_timeout=15, total_budget=30)
+
+
+async def _request_json(session: aiohttp.ClientSession, method: str, url: str, headers: Dict[str, str], payload: Dict | None = None) -> Dict:
+    """Один HTTP-запрос к API Yandex; неуспешный статус превращается в ProviderHTTPError (для ai_clients.retry)."""
+    async with session.request(method, url, headers=headers, json=payload) as resp:
+        if resp.status != 200:
+            raise ProviderHTTPError(resp.status, await resp.text(), resp.headers.get("Retry-After"))
+        return await resp.json()
+
+
+class _PendingOperation:
+    """Операция YandexArt, которую ждет generate_image."""
+
+    def __init__(self, operation_id: str, headers: Dict[str, str], future: asyncio.Future):
+        self.operation_id = operation_id
+        self.headers = headers
+        self.future = future
+        self.started_at = time.monotonic()
+        self.next_poll_at = self.started_at + _first_poll_delay()
+        self.interval = config.YANDEXART_POLL_MIN_INTERVAL_SECONDS
+
+
+def _first_poll_delay() -> float:
+    # [Dev-Ассистент]: Раньше типичного времени генерации опрашивать бесполезно - операция почти наверняка не готова.
+    typical = metrics.percentile("yandexart_operation_seconds", 0.5, min_samples=config.YANDEXART_POLL_MIN_SAMPLES)
+    return typical if typical is not None else config.YANDEXART_POLL_FIRST_DELAY_SECONDS
+
+
+class YandexArtOperationPoller:
+    """
+    Один на процесс опросчик операций YandexArt с общей HTTP-сессией.
+
+    Все незавершенные операции опрашиваются общими циклами: цикл просыпается к ближайшему сроку и
+    опрашивает разом все операции, чей срок наступит в пределах YANDEXART_POLL_BATCH_WINDOW_SECONDS.
+    Первый опрос - через медиану наблюдаемого времени генерации, дальше интервал растет в 1.5 раза
+    до YANDEXART_POLL_MAX_INTERVAL_SECONDS. Результат операции (или ошибка) приходит в future вызывающего.
+    """
+
+    def __init__(self):
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._operations: Dict[str, _PendingOperation] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup = asyncio.Event()
+
+    def session(self) -> aiohttp.ClientSession:
+        """Общая сессия (пул соединений) для всех запросов к API YandexArt."""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession()
+        return self._session
+
+    async def wait(self, operation_id: str, headers: Dict[str, str]) -> Dict:
+        """
+        Ждет завершения операции и возвращает ее JSON (done=true).
+
+        :raises ProviderHTTPError: Если опрос вернул неуспешный статус (после повторов).
+        :raises asyncio.TimeoutError: Если операция не завершилась за YANDEXART_OPERATION_TIMEOUT_SECONDS.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._operations[operation_id] = _PendingOperation(operation_id, headers, future)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        self._wakeup.set()
+        try:
+            return await future
+        finally:
+            self._operations.pop(operation_id, None)
+
+    async def _run(self) -> None:
+        while True:
+            # [Dev-Ассистент]: Завершенные операции вызывающий снимает сам, но уже после нас - здесь их пропускаем.
+            pending = [op for op in self._operations.values() if not op.future.done()]
+            if not pending:
+                return
+            self._wakeup.clear()
+            delay = min(op.next_poll_at for op in pending) - time.monotonic()
+            if delay > 0:
+                try:
+                    # [Dev-Ассистент]: Новая операция может потребовать опроса раньше текущего срока.
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                    continue
+                except asyncio.TimeoutError:
+                    pass
+
+            border = time.monotonic() + config.YANDEXART_POLL_BATCH_WINDOW_SECONDS
+            due = [op for op in pending if op.next_poll_at <= border]
+            await asyncio.gather(*(self._poll(op) for op in due))
+
+    async def _poll(self, op: _PendingOperation) -> None:
+        operation_url = OPERATION_API_URL_TEMPLATE.format(op.operation_id)
+        try:
+            op_data = await call_with_retry(
+                lambda: _request_json(self.session(), "GET", operation_url, op.headers),
+                provider="yandexart",
+                policy=POLL_RETRY_POLICY
+            )
+        except Exception as e:
+            metrics.increment("yandexart_polls_total", outcome="error")
+            if not op.future.done():
+                op.future.set_exception(e)
+            return
+
+        now = time.monotonic()
+        if op_data.get("done"):
+            metrics.increment("yandexart_polls_total", outcome="done")
+            metrics.observe("yandexart_operation_seconds", now - op.started_at)
+            if not op.future.done():
+                op.future.set_result(op_data)
+            return
+
+        metrics.increment("yandexart_polls_total", outcome="pending")
+        if now - op.started_at >= config.YANDEXART_OPERATION_TIMEOUT_SECONDS:
+            if not op.future.done():
+                op.future.set_exception(asyncio.TimeoutError())
+            return
+        op.next_poll_at = now + op.interval
+        op.interval = min(op.interval * 1.5, config.YANDEXART_POLL_MAX_INTERVAL_SECONDS)
+
+    async def close(self) -> None:
+        """Останавливает опрос и закрывает сессию (вызывается из factory.close_ai_clients)."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for op in self._operations.values():
+            if not op.future.done():
+                op.future.cancel()
+        self._operations.clear()
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+_poller: Optional[YandexArtOperationPoller] = None
+
+
+def get_operation_poller() -> YandexArtOperationPoller:
+    """Общий на процесс опросчик операций YandexArt."""
+    global _poller
+    if _poller is None:
+        _poller = YandexArtOperationPoller()
+    return _poller
+
+
+async def close_operation_poller() -> None:
+    global _poller
+    if _poller is not None:
+        await _poller.close()
+        _poller = None
 
 
 class YandexArtClient:
@@ -25,6 +183,8 @@ class YandexArtClient:
 
         self._folder_id = folder_id
         self._api_key = api_key
+        # [Dev-Ассистент]: Клиент создается на каждый запрос, но лимитер общий (реестр по API-ключу).
+        self._limiter = get_rate_limiter("yandexart", api_key)
 
     # [Dev-Ассистент]: Добавляем параметр `size`
     async def generate_image(self, prompt: str, size: str = "1:1") -> Tuple[bytes | None, str | None]:
@@ -55,60 +215,55 @@ class YandexArtClient:
             }
         }
 
+        poller = get_operation_poller()
         try:
-            async with aiohttp.ClientSession() as session:
-                # --- ЭТАП 1: ЗАПУСК ГЕНЕРАЦИИ ---
-                logger.info(f"Отправка запроса на генерацию в YandexArt (размер: {size})...") # [Dev-Ассистент]: Улучшенный лог
-                async with session.post(IMAGE_API_URL, headers=headers, json=payload) as resp:
-                    if resp.status != 200:
-                        error_body = await resp.text()
-                        logger.error(
-                            f"Ошибка при запуске генерации YandexArt ({resp.status}): {error_body}"
-                        )
-                        return None, f"Ошибка от Yandex ({resp.status}): {error_body}"
-
-                    operation_data = await resp.json()
-                    operation_id = operation_data.get("id")
-                    if not operation_id:
-                        return None, "API не вернул ID операции."
-
-                # --- ЭТАП 2: ОЖИДАНИЕ РЕЗУЛЬТАТА ---
-                logger.info(f"Начало опроса операции: {operation_id}")
-
-                # [Dev-Ассистент]: Исправление: Увеличиваем начальную задержку.
-                await asyncio.sleep(7) 
-
-                for _ in range(60): # Оставляем цикл на ~2 минуты
-                    operation_url = OPERATION_API_URL_TEMPLATE.format(operation_id) # [Dev-Ассистент]: Убедимся, что url каждый раз генерируется
-                    async with session.get(operation_url, headers=headers) as op_resp:
-                        if op_resp.status != 200:
-                            error_body = await op_resp.text()
-                            logger.error(
-                                f"Ошибка при проверке статуса операции YandexArt ({op_resp.status}): {error_body}"
-                            )
-                            if op_resp.status == 404:
-                                return None, f"Ошибка от Yandex (404): Операция не найдена. Возможно, она была удалена или еще не создана."
-                            return None, f"Ошибка от Yandex ({op_resp.status}): {error_body}"
-                        
-                        op_data = await op_resp.json()
-                        if op_data.get("done"):
-                            logger.info("Генерация завершена успешно.")
-                            if 'error' in op_data:
-                                error_details = op_data['error']
-                                logger.error(f"Операция завершилась с ошибкой: {error_details}")
-                                return None, f"Ошибка от Yandex: {error_details.get('message', 'Неизвестная ошибка')}"
-                            
-                            image_base64 = op_data.get("response", {}).get("image")
-                            if not image_base64:
-                                return None, "Операция завершена, но не содержит изображения."
-
-                            image_bytes = base64.b64decode(image_base64)
-                            return image_bytes, None
-                    
-                    await asyncio.sleep(2)
+            # --- ЭТАП 1: ЗАПУСК ГЕНЕРАЦИИ ---
+            logger.info(f"Отправка запроса на генерацию в YandexArt (размер: {size})...") # [Dev-Ассистент]: Улучшенный лог
+            # [Dev-Ассистент]: Квоту расходует только запуск генерации, опрос операции не лимитируем.
+            try:
+                async with self._limiter.reserve():
+                    operation_data = await call_with_retry(
+                        lambda: _request_json(poller.session(), "POST", IMAGE_API_URL, headers, payload),
+                        provider="yandexart"
+                    )
+            except ProviderHTTPError as e:
+                logger.error(
+                    f"Ошибка при запуске генерации YandexArt ({e.status}): {e.body}"
+                )
+                return None, f"Ошибка от Yandex ({e.status}): {e.body}"
 
+            operation_id = operation_data.get("id")
+            if not operation_id:
+                return None, "API не вернул ID операции."
+
+            # --- ЭТАП 2: ОЖИДАНИЕ РЕЗУЛЬТАТА ---
+            # [Dev-Ассистент]: Операцию опрашивает общий опросчик вместе со всеми остальными (YandexArtOperationPoller).
+            logger.info(f"Операция YandexArt {operation_id} передана опросчику.")
+            try:
+                op_data = await poller.wait(operation_id, headers)
+            except ProviderHTTPError as e:
+                logger.error(
+                    f"Ошибка при проверке статуса операции YandexArt ({e.status}): {e.body}"
+                )
+                if e.status == 404:
+                    return None, f"Ошибка от Yandex (404): Операция не найдена. Возможно, она была удалена или еще не создана."
+                return None, f"Ошибка от Yandex ({e.status}): {e.body}"
+            except asyncio.TimeoutError:
                 return None, "Время ожидания генерации истекло."
 
+            logger.info("Генерация завершена успешно.")
+            if 'error' in op_data:
+                error_details = op_data['error']
+                logger.error(f"Операция завершилась с ошибкой: {error_details}")
+                return None, f"Ошибка от Yandex: {error_details.get('message', 'Неизвестная ошибка')}"
+
+            image_base64 = op_data.get("response", {}).get("image")
+            if not image_base64:
+                return None, "Операция завершена, но не содержит изображения."
+
+            image_bytes = base64.b64decode(image_base64)
+            return image_bytes, None
+
         except aiohttp.ClientConnectorError as e:
             logger.error(f"Ошибка соединения с YandexArt: {e}")
             return None, f"Не удалось подключиться к серверам Yandex. Ошибка: {e}"
@@ -0,0 +1,152 @@
+# benchmarks/bench_history_context.py
+# [Dev-Ассистент]: Бенчмарк database.get_history_for_context на большой таблице chat_history.
+#
+# Сравнивает старую схему (два запроса: резюме + активный буфер) с текущей (один UNION ALL запрос)
+# на отдельном файле БД. Рабочую базу data/gemini_bot.db не трогает.
+#
+# Пример (десятки миллионов строк, файл займет несколько ГБ):
+#   python benchmarks/bench_history_context.py --db /tmp/bench_history.db --rows 20000000 --dialogs 200000
+# Повторный запуск на том же файле пропускает наполнение, если строк уже достаточно.
+
+import argparse
+import asyncio
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database as db  # noqa: E402
+
+CHARACTER_NAMES = ["Базовый AI", "Психолог-консультант", "Мастер квестов: Пиратская сага", "Технический гуру", "Учитель математики"]
+BATCH_SIZE = 50_000
+
+
+def _populate(db_file: str, rows: int, dialogs: int) -> None:
+    con = sqlite3.connect(db_file)
+    existing = con.execute("SELECT COUNT(*) FROM chat_history").fetchone()[0]
+    if existing >= rows:
+        print(f"В {db_file} уже {existing} строк chat_history, наполнение пропущено.")
+        con.close()
+        return
+
+    users = max(1, dialogs // len(CHARACTER_NAMES))
+    con.executemany(
+        "INSERT OR IGNORE INTO users (id, telegram_id, full_name) VALUES (?, ?, ?)",
+        ((user_id, 10_000_000 + user_id, f"bench {user_id}") for user_id in range(1, users + 1))
+    )
+    con.executemany(
+        "INSERT OR IGNORE INTO dialogs (user_id, character_name) VALUES (?, ?)",
+        ((user_id, character_name) for user_id in range(1, users + 1) for character_name in CHARACTER_NAMES)
+    )
+    con.commit()
+    dialog_ids = [row[0] for row in con.execute("SELECT id FROM dialogs ORDER BY id")]
+
+    rnd = random.Random(42)
+    filler = "Пример сообщения из диалога для бенчмарка. " * 5
+    started = time.perf_counter()
+    # [Dev-Ассистент]: Сообщения разных диалогов перемешаны, как в рабочей базе: строки одного диалога
+    # [Dev-Ассистент]: разбросаны по страницам, и без индекса пришлось бы читать всю таблицу.
+    inserted = existing
+    while inserted < rows:
+        batch = []
+        for _ in range(min(BATCH_SIZE, rows - inserted)):
+            dialog_id = dialog_ids[rnd.randrange(len(dialog_ids))]
+            role = 'user' if rnd.random() < 0.5 else 'model'
+            is_summary = 1 if rnd.random() < 0.01 else 0
+            batch.append((dialog_id, role, filler, 60, is_summary))
+        con.executemany(
+            "INSERT INTO chat_history (dialog_id, role, content, token_count, is_summary) VALUES (?, ?, ?, ?, ?)",
+            batch
+        )
+        con.commit()
+        inserted += len(batch)
+        print(f"\rНаполнение: {inserted}/{rows} строк ({time.perf_counter() - started:.0f} с)", end="", flush=True)
+    print()
+    con.execute("ANALYZE")
+    con.commit()
+    con.close()
+
+
+async def _legacy_two_queries(user_id: int, character_name: str, active_buffer_count: int) -> list:
+    """Старая реализация get_history_for_context: два отдельных запроса (перенесена на dialog_id)."""
+    messages = []
+    dialog_id = await db._get_dialog_id(user_id, character_name)
+    latest_summary = await db.db_request(
+        "SELECT role, content FROM chat_history WHERE dialog_id = ? AND is_summary = 1 ORDER BY id DESC LIMIT 1",
+        (dialog_id,), fetch_one=True
+    )
+    if latest_summary:
+        messages.append({"role": latest_summary['role'], "parts": [latest_summary['content']]})
+    buffer_rows = await db.db_request(
+        "SELECT role, content FROM chat_history WHERE dialog_id = ? AND is_summary = 0 ORDER BY id DESC LIMIT ?",
+        (dialog_id, active_buffer_count), fetch_all=True
+    )
+    messages.extend({"role": row['role'], "parts": [row['content']]} for row in reversed(buffer_rows or []))
+    return messages
+
+
+def _report(name: str, samples: list) -> None:
+    samples_ms = sorted(sample * 1000 for sample in samples)
+    p = lambda q: samples_ms[min(len(samples_ms) - 1, int(len(samples_ms) * q))]
+    print(
+        f"{name:<28} n={len(samples_ms):<6} mean={statistics.mean(samples_ms):7.3f} мс  "
+        f"p50={p(0.50):7.3f} мс  p95={p(0.95):7.3f} мс  p99={p(0.99):7.3f} мс"
+    )
+
+
+async def _measure(iterations: int, dialogs: int, active_buffer_count: int) -> None:
+    await db.init_db_pool()
+    try:
+        plan = await db.db_request(
+            "EXPLAIN QUERY PLAN SELECT id FROM chat_history WHERE dialog_id = ? AND is_summary = 0 ORDER BY id DESC LIMIT ?",
+            (1, active_buffer_count), fetch_all=True
+        )
+        print("План запроса активного буфера:", "; ".join(row['detail'] for row in plan or []))
+
+        users = max(1, dialogs // len(CHARACTER_NAMES))
+        rnd = random.Random(7)
+        targets = [(rnd.randint(1, users), rnd.choice(CHARACTER_NAMES)) for _ in range(iterations)]
+
+        # [Dev-Ассистент]: Прогрев страничного кэша/mmap, чтобы сравнивать запросы, а не холодный диск.
+        for user_id, character_name in targets[: min(200, len(targets))]:
+            await db.get_history_for_context(user_id, character_name, active_buffer_count)
+
+        for name, func in (("legacy (2 запроса)", _legacy_two_queries), ("get_history_for_context", db.get_history_for_context)):
+            samples = []
+            for user_id, character_name in targets:
+                started = time.perf_counter()
+                await func(user_id, character_name, active_buffer_count)
+                samples.append(time.perf_counter() - started)
+            _report(name, samples)
+    finally:
+        await db.close_db_pool()
+
+
+async def _prepare_schema() -> None:
+    # [Dev-Ассистент]: init_db_pool применяет миграции схемы; наполняем уже готовую базу обычным sqlite3.
+    await db.init_db_pool()
+    await db.close_db_pool()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Бенчмарк получения контекста диалога из chat_history.")
+    parser.add_argument("--db", default=os.path.join("data", "bench_history.db"), help="Файл БД для бенчмарка (не рабочая база!)")
+    parser.add_argument("--rows", type=int, default=2_000_000, help="Сколько строк должно быть в chat_history")
+    parser.add_argument("--dialogs", type=int, default=50_000, help="Количество диалогов (пользователь + персонаж)")
+    parser.add_argument("--buffer", type=int, default=100, help="Размер активного буфера (как у Pro/VIP)")
+    parser.add_argument("--iterations", type=int, default=2000, help="Количество замеров на каждый вариант")
+    args = parser.parse_args()
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.db)), exist_ok=True)
+    db.DB_FILE = args.db
+    asyncio.run(_prepare_schema())
+    _populate(args.db, args.rows, args.dialogs)
+    asyncio.run(_measure(args.iterations, args.dialogs, args.buffer))
+
+
+if __name__ == "__main__":
+    main()
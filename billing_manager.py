@@ -2,7 +2,7 @@
 
 import logging
 import html
-from typing import Dict, Any
+from typing import Any, Awaitable, Callable, Dict, Optional
 
 from telegram import Update
 from telegram.ext import ContextTypes
@@ -51,23 +51,38 @@ async def get_item_cost(item_type: str, item_identifier: str) -> int:
 
     return int(cost_usd * config.USD_TO_AGM_RATE)
 
-async def perform_deduction(
-    user_id: int, 
-    item_type: str, # Например, 'dalle3_image_gen', 'yandexart_image_gen'
-    item_identifier: str, # Например, '1024x1024'
-    update: Update, 
-    context: ContextTypes.DEFAULT_TYPE
-) -> bool:
+async def _send_insufficient_funds_message(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    user_balance: int,
+    cost_agm: int,
+    display_name_resolution: str
+) -> None:
+    await context.bot.send_message(
+        chat_id=update.effective_chat.id,
+        text=(
+            f"😔 <b>Недостаточно AGMcoin для выполнения операции.</b>\n\n"
+            f"Ваш баланс: <code>{user_balance}</code> AGMcoin.\n"
+            f"Требуется: <code>{cost_agm}</code> AGMcoin для разрешения "
+            f"<code>{display_name_resolution}</code>.\n\n" # [Dev-Ассистент]: Используем display_name_resolution
+            f"Пополните баланс в разделе ⚙️ Профиль -> 👛 Кошелек."
+        ),
+        parse_mode='HTML'
+    )
+
+async def _charge(
+    user_id: int,
+    item_type: str,
+    item_identifier: str,
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    debit: Callable[[int, str, str], Awaitable[Any]]
+) -> Any:
     """
-    Выполняет попытку списания средств за услугу.
-    Отправляет пользователю уведомление, если средств недостаточно.
-    
-    :param user_id: ID пользователя в БД.
-    :param item_type: Тип услуги (например, 'dalle3_image_gen', 'yandexart_image_gen').
-    :param item_identifier: Идентификатор конкретной услуги (например, '1024x1024').
-    :param update: Объект Update из Telegram.
-    :param context: Объект ContextTypes.DEFAULT_TYPE из Telegram.
-    :return: True, если списание успешно (или средств достаточно), False в противном случае.
+    Общая часть списаний: стоимость, проверка баланса и сообщения пользователю.
+    Само списание выполняет debit(cost_agm, transaction_type, description) и возвращает
+    непустой результат при успехе (False/None - средств не хватило).
+    :return: Результат debit или None, если списание не состоялось.
     """
     try:
         cost_agm = await get_item_cost(item_type, item_identifier)
@@ -84,7 +99,7 @@ async def perform_deduction(
             chat_id=update.effective_chat.id,
             text=f"Ошибка в определении стоимости услуги: {e}"
         )
-        return False
+        return None
 
     user_account_data = await db.get_user_by_id(user_id)
     if not user_account_data:
@@ -93,23 +108,13 @@ async def perform_deduction(
             chat_id=update.effective_chat.id,
             text="Произошла ошибка при получении данных вашего профиля."
         )
-        return False
+        return None
         
     user_balance = user_account_data.get('balance', 0)
 
     if user_balance < cost_agm:
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id,
-            text=(
-                f"😔 <b>Недостаточно AGMcoin для выполнения операции.</b>\n\n"
-                f"Ваш баланс: <code>{user_balance}</code> AGMcoin.\n"
-                f"Требуется: <code>{cost_agm}</code> AGMcoin для разрешения "
-                f"<code>{display_name_resolution}</code>.\n\n" # [Dev-Ассистент]: Используем display_name_resolution
-                f"Пополните баланс в разделе ⚙️ Профиль -> 👛 Кошелек."
-            ),
-            parse_mode='HTML'
-        )
-        return False
+        await _send_insufficient_funds_message(update, context, user_balance, cost_agm, display_name_resolution)
+        return None
 
     # [Dev-Ассистент]: Определяем тип транзакции для записи в БД
     transaction_type_for_db = TRANSACTION_TYPE_IMAGE_GEN_COST 
@@ -118,19 +123,69 @@ async def perform_deduction(
 
     description = f"Оплата {item_type.replace('_', ' ')}: {item_identifier} ({cost_agm} AGMcoin)"
     
-    success = await db.update_user_balance(
-        user_id, 
-        -cost_agm, 
-        transaction_type_for_db, # [Dev-Ассистент]: Используем новый, специфичный тип транзакции
-        description=description
-    )
+    # [Dev-Ассистент]: debit проверяет баланс и списывает одним UPDATE в БД (allow_negative=False).
+    # [Dev-Ассистент]: Проверка выше лишь дает понятное сообщение; два параллельных списания в минус не уведут.
+    success = await debit(cost_agm, transaction_type_for_db, description)
     
     if not success:
+        fresh_account_data = await db.get_user_by_id(user_id)
+        fresh_balance = fresh_account_data.get('balance', 0) if fresh_account_data else 0
+        if fresh_balance < cost_agm:
+            await _send_insufficient_funds_message(update, context, fresh_balance, cost_agm, display_name_resolution)
+            return None
         logger.error(f"Не удалось списать {cost_agm} AGMcoin с user_id={user_id} за {item_type}:{item_identifier}")
         await context.bot.send_message(
             chat_id=update.effective_chat.id,
             text="Произошла ошибка при списании средств. Пожалуйста, попробуйте позже."
         )
-        return False
+        return None
         
-    return True
\ No newline at end of file
+    return success
+
+async def perform_deduction(
+    user_id: int, 
+    item_type: str, # Например, 'dalle3_image_gen', 'yandexart_image_gen'
+    item_identifier: str, # Например, '1024x1024'
+    update: Update, 
+    context: ContextTypes.DEFAULT_TYPE
+) -> bool:
+    """
+    Выполняет попытку списания средств за услугу.
+    Отправляет пользователю уведомление, если средств недостаточно.
+    
+    :param user_id: ID пользователя в БД.
+    :param item_type: Тип услуги (например, 'dalle3_image_gen', 'yandexart_image_gen').
+    :param item_identifier: Идентификатор конкретной услуги (например, '1024x1024').
+    :param update: Объект Update из Telegram.
+    :param context: Объект ContextTypes.DEFAULT_TYPE из Telegram.
+    :return: True, если списание успешно (или средств достаточно), False в противном случае.
+    """
+    async def debit(cost_agm: int, transaction_type: str, description: str) -> bool:
+        return await db.update_user_balance(user_id, -cost_agm, transaction_type, description=description, allow_negative=False)
+
+    return bool(await _charge(user_id, item_type, item_identifier, update, context, debit))
+
+async def create_paid_image_job(
+    user_id: int,
+    item_type: str,
+    item_identifier: str,
+    provider: str,
+    prompt: str,
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE
+) -> Optional[int]:
+    """
+    Как perform_deduction, но вместе со списанием (в той же транзакции БД) создает задание генерации
+    изображения (см. image_jobs.py) - оплата не потеряется, даже если бот перезапустится до генерации.
+
+    :param provider: Генератор (IMAGE_GEN_DALL_E_3 / IMAGE_GEN_YANDEXART).
+    :param prompt: Текст запроса на изображение.
+    :return: ID задания или None, если списание не состоялось (сообщение пользователю уже отправлено).
+    """
+    async def debit(cost_agm: int, transaction_type: str, description: str) -> Optional[int]:
+        return await db.create_image_job(
+            user_id, update.effective_chat.id, provider, prompt, item_identifier,
+            cost_agm, transaction_type, description
+        )
+
+    return await _charge(user_id, item_type, item_identifier, update, context, debit)
\ No newline at end of file
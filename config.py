@@ -1,15 +1,19 @@
 # ПАГИНАЦИЯ, РЕФЛЕКТОРИНГ
 
+import os
+
 from constants import (
     GEMINI_STANDARD, GPT_1, GPT_2,
     OPENROUTER_DEEPSEEK, OPENROUTER_GEMINI_2_FLASH,
     DALL_E_3_SIZE_1024X1024,DALL_E_3_SIZE_1024X1792,
     DALL_E_3_SIZE_1792X1024,YANDEXART_SIZE_1024X1024,
-    YANDEXART_SIZE_1024X1792, YANDEXART_SIZE_1792X1024
+    YANDEXART_SIZE_1024X1792, YANDEXART_SIZE_1792X1024,
+    IMAGE_GEN_DALL_E_3, IMAGE_GEN_YANDEXART
 )
 
 # --- Настройки AI моделей ---
 GEMINI_MODEL = "gemini-1.5-flash-latest"
+GEMINI_MODEL_CACHE_MAX_SIZE = 256 # [Dev-Ассистент]: Сколько объектов GenerativeModel (модель + системная инструкция) держать в памяти
 DEEPSEEK_CHAT_MODEL = "deepseek/deepseek-chat-v3-0324:free"
 GPT_1_MODEL = "gpt-4.1-nano"
 GPT_2_MODEL = "o4-mini-2025-04-16"
@@ -27,10 +31,10 @@ ALL_TEXT_MODELS_FOR_SELECTION = [
         "provider_id": GPT_1, 
         "display_name": "GPT-4.1-nano (быстрый, vision)"
     },
-    #{
-    #   "provider_id": GEMINI_STANDARD,
-    #    "display_name": "Gemini 1.5 Flash (vision)"
-    #},
+    {
+        "provider_id": GEMINI_STANDARD,
+        "display_name": "Gemini 1.5 Flash (vision)"
+    },
     {
         "provider_id": OPENROUTER_DEEPSEEK, 
         "display_name": "DeepSeek (OpenRouter)"
@@ -53,10 +57,13 @@ SUBSCRIPTION_TIERS = {
             OPENROUTER_DEEPSEEK
         ],
         "can_use_vision": True,
+        "vision_detail": "low", # [Dev-Ассистент]: Детализация изображений для vision-моделей (low/auto/high, ai_clients.images)
         # [Dev-Ассистент]: НОВЫЕ НАСТРОЙКИ КОНТЕКСТА
         "active_buffer_message_count": 10, # [Dev-Ассистент]: Количество сообщений в активном буфере
+        "context_block_size": 1, # [Dev-Ассистент]: Шаг сдвига начала буфера (1 - по сообщению; больше - стабильный префикс для кэша промптов)
         "summarization_token_trigger": 10000, # [Dev-Ассистент]: Порог токенов для запуска суммаризации
         "max_llm_input_tokens": 10000, # [Dev-Ассистент]: Максимальный лимит токенов для LLM-запроса
+        "hedge_requests": False, # [Dev-Ассистент]: Дублировать медленный запрос на вторую модель (ai_clients.hedging)
     },
     'lite': {
         "name": "Lite",
@@ -68,10 +75,13 @@ SUBSCRIPTION_TIERS = {
             OPENROUTER_DEEPSEEK
         ],
         "can_use_vision": True,
+        "vision_detail": "auto", # [Dev-Ассистент]: Детализация изображений для vision-моделей (low/auto/high, ai_clients.images)
         # [Dev-Ассистент]: НОВЫЕ НАСТРОЙКИ КОНТЕКСТА
         "active_buffer_message_count": 30, # [Dev-Ассистент]: Количество сообщений в активном буфере
+        "context_block_size": 10, # [Dev-Ассистент]: Шаг сдвига начала буфера (1 - по сообщению; больше - стабильный префикс для кэша промптов)
         "summarization_token_trigger": 15000, # [Dev-Ассистент]: Порог токенов для запуска суммаризации
         "max_llm_input_tokens": 15000, # [Dev-Ассистент]: Максимальный лимит токенов для LLM-запроса
+        "hedge_requests": True, # [Dev-Ассистент]: Дублировать медленный запрос на вторую модель (ai_clients.hedging)
     },
     'pro': {
         "name": "Pro",
@@ -81,12 +91,16 @@ SUBSCRIPTION_TIERS = {
             GPT_2,
             GPT_1,
             OPENROUTER_DEEPSEEK,
+            GEMINI_STANDARD,
         ],
         "can_use_vision": True,
+        "vision_detail": "high", # [Dev-Ассистент]: Детализация изображений для vision-моделей (low/auto/high, ai_clients.images)
         # [Dev-Ассистент]: НОВЫЕ НАСТРОЙКИ КОНТЕКСТА
         "active_buffer_message_count": 100, # [Dev-Ассистент]: Количество сообщений в активном буфере
+        "context_block_size": 20, # [Dev-Ассистент]: Шаг сдвига начала буфера (1 - по сообщению; больше - стабильный префикс для кэша промптов)
         "summarization_token_trigger": 50000, # [Dev-Ассистент]: Порог токенов для запуска суммаризации
         "max_llm_input_tokens": 100000, # [Dev-Ассистент]: Максимальный лимит токенов для LLM-запроса
+        "hedge_requests": True, # [Dev-Ассистент]: Дублировать медленный запрос на вторую модель (ai_clients.hedging)
     },
     'gold': {
         "name": "Gold",
@@ -96,12 +110,16 @@ SUBSCRIPTION_TIERS = {
             GPT_2,
             GPT_1,
             OPENROUTER_DEEPSEEK,
+            GEMINI_STANDARD,
         ],
         "can_use_vision": True,
+        "vision_detail": "high", # [Dev-Ассистент]: Детализация изображений для vision-моделей (low/auto/high, ai_clients.images)
         # [Dev-Ассистент]: НОВЫЕ НАСТРОЙКИ КОНТЕКСТА
         "active_buffer_message_count": 100, # [Dev-Ассистент]: Количество сообщений в активном буфере
+        "context_block_size": 20, # [Dev-Ассистент]: Шаг сдвига начала буфера (1 - по сообщению; больше - стабильный префикс для кэша промптов)
         "summarization_token_trigger": 50000, # [Dev-Ассистент]: Порог токенов для запуска суммаризации
         "max_llm_input_tokens": 100000, # [Dev-Ассистент]: Максимальный лимит токенов для LLM-запроса
+        "hedge_requests": True, # [Dev-Ассистент]: Дублировать медленный запрос на вторую модель (ai_clients.hedging)
     },
     'vip': {
         "name": "VIP",
@@ -111,12 +129,16 @@ SUBSCRIPTION_TIERS = {
             GPT_2,
             GPT_1,
             OPENROUTER_DEEPSEEK,
+            GEMINI_STANDARD,
         ],
         "can_use_vision": True,
+        "vision_detail": "high", # [Dev-Ассистент]: Детализация изображений для vision-моделей (low/auto/high, ai_clients.images)
         # [Dev-Ассистент]: НОВЫЕ НАСТРОЙКИ КОНТЕКСТА
         "active_buffer_message_count": 100, # [Dev-Ассистент]: Количество сообщений в активном буфере
+        "context_block_size": 20, # [Dev-Ассистент]: Шаг сдвига начала буфера (1 - по сообщению; больше - стабильный префикс для кэша промптов)
         "summarization_token_trigger": 50000, # [Dev-Ассистент]: Порог токенов для запуска суммаризации
         "max_llm_input_tokens": 100000, # [Dev-Ассистент]: Максимальный лимит токенов для LLM-запроса
+        "hedge_requests": True, # [Dev-Ассистент]: Дублировать медленный запрос на вторую модель (ai_clients.hedging)
     }
 
 }
@@ -140,6 +162,10 @@ POST_PROCESSING_MEDIUM_THRESHOLD = 600 # Ответ между SHORT и MEDIUM -
 POST_PROCESSING_LONG_THRESHOLD = 1000  # Ответ между MEDIUM и LONG - длинный (кнопки "Сократи", "Перефразируй").
 # Все, что ВЫШЕ LONG_THRESHOLD, также считается длинным.
 
+# [Dev-Ассистент]: Потоковый вывод ответа: как часто редактировать сообщение-превью, с.
+# [Dev-Ассистент]: Telegram ограничивает частоту правок (около 1 в секунду на чат, 20 в минуту в группах).
+STREAM_EDIT_INTERVAL_SECONDS = 1.5
+
 # --- Настройки меню и контента ---
 CHARACTERS_PER_PAGE = 8      # Количество кнопок с персонажами на одной странице
 ABSOLUTE_MAX_FILE_CHARS = 30000 # Максимальное кол-во символов в .txt файле с промптом
@@ -155,11 +181,45 @@ FILE_PROCESSING_LIMITS = {
     OPENROUTER_DEEPSEEK: 15000,
     OPENROUTER_GEMINI_2_FLASH: 30000,
 }
+# --- Изображения для vision-моделей (ai_clients.images) ---
+# [Dev-Ассистент]: Модели все равно ужимают картинку: low - до 512px, high - длинная сторона до 2048, короткая до 768.
+VISION_LOW_DETAIL_MAX_SIDE = 512
+VISION_HIGH_DETAIL_MAX_SIDE = 2048
+VISION_HIGH_DETAIL_SHORT_SIDE = 768
+VISION_JPEG_QUALITY = 85                # Качество JPEG, если изображение пришлось уменьшить/перекодировать
+
 # --- Настройки генерации изображений ---
+# [Dev-Ассистент]: Голосовые (ai_clients.audio): OGG/Opus уходит в Whisper как есть. Если Whisper его не принял,
+# [Dev-Ассистент]: звук перекладывается в WebM процессом ffmpeg без перекодирования.
+AUDIO_REMUX_MAX_PROCESSES = 2        # Одновременных процессов ffmpeg
+AUDIO_REMUX_TIMEOUT_SECONDS = 30
+AUDIO_DIRECT_RETRY_SECONDS = 3600    # Столько после отказа голосовые сразу переупаковываются, потом снова пробуем OGG
+
+# [Dev-Ассистент]: Кэш файлов Telegram и производных от них (file_cache.py): повторно пересланные голосовые,
+# [Dev-Ассистент]: документы и фото не скачиваются и не обрабатываются заново. 0 - кэш выключен.
+FILE_CACHE_DIR = os.path.join("data", "file_cache")
+FILE_CACHE_MAX_BYTES = 512 * 1024 * 1024      # Суммарный размер на диске, сверх него вытесняются давно не использованные
+FILE_CACHE_MAX_ITEM_BYTES = 20 * 1024 * 1024  # Записи крупнее не сохраняются (ботам Telegram и так отдает до 20 МБ)
+
 # [Dev-Ассистент]: Лимит на количество символов в промпте для YandexArt.
 # [Dev-Ассистент]: Мы вынесли его сюда, чтобы легко менять в одном месте.
 YANDEXART_PROMPT_LIMIT = 500
 
+# [Dev-Ассистент]: Опрос операций YandexArt (ai_clients.yandexart_client.YandexArtOperationPoller).
+YANDEXART_POLL_FIRST_DELAY_SECONDS = 7.0     # Первый опрос, пока нет статистики времени генерации
+YANDEXART_POLL_MIN_SAMPLES = 10              # После стольких генераций первый опрос - по их медиане
+YANDEXART_POLL_MIN_INTERVAL_SECONDS = 1.0    # Интервал после первого неготового ответа (растет в 1.5 раза)
+YANDEXART_POLL_MAX_INTERVAL_SECONDS = 5.0
+YANDEXART_POLL_BATCH_WINDOW_SECONDS = 0.5    # Операции со сроками в пределах окна опрашиваются одним циклом
+YANDEXART_OPERATION_TIMEOUT_SECONDS = 130    # Сколько ждать операцию целиком
+
+# [Dev-Ассистент]: Очередь генерации изображений (image_jobs.py): оплаченное задание сначала пишется в БД,
+# [Dev-Ассистент]: затем его выполняет один из воркеров провайдера, а картинка приходит в чат отдельным сообщением.
+IMAGE_JOB_WORKERS = {IMAGE_GEN_DALL_E_3: 2, IMAGE_GEN_YANDEXART: 2}  # Одновременных генераций на провайдера
+IMAGE_JOB_MAX_QUEUED = 20                  # Больше заданий в очереди провайдера не принимаем (и не списываем за них)
+IMAGE_JOB_MAX_ATTEMPTS = 2                 # Задание, прерванное перезапуском, повторяется, пока не исчерпает попытки
+IMAGE_JOB_RESUME_MAX_AGE_SECONDS = 3600    # Более старые незавершенные задания после перезапуска не продолжаются, а возвращаются
+
 # [Dev-Ассистент]: НОВАЯ КОНСТАНТА ДЛЯ РЕФЕРАЛЬНОЙ ПРОГРАММЫ
 REFERRAL_PERCENTAGE = 10 # % от пополнения реферала, который получает реферер. (Например, 10 означает 10%)
 
@@ -199,4 +259,78 @@ SUMMARIZATION_PROMPT = """
 
 Формат ответа: Единый, логически связный, повествовательный текст.
 """
-SUMMARIZATION_MODEL_NAME = GPT_1 # [Dev-Ассистент]: Используем GPT_1 (gpt-4.1-nano) для суммаризации
\ No newline at end of file
+SUMMARIZATION_MODEL_NAME = GPT_1 # [Dev-Ассистент]: Используем GPT_1 (gpt-4.1-nano) для суммаризации
+SUMMARIZATION_WORKERS = 2          # [Dev-Ассистент]: Сколько диалогов суммаризируется одновременно (summarizer.py)
+SUMMARIZATION_MAX_QUEUED = 500     # [Dev-Ассистент]: Больше заданий не копим: их снова запустит триггер после следующего ответа
+
+# --- Настройки базы данных ---
+# [Dev-Ассистент]: Параметры долгоживущего пула соединений SQLite (см. database._ConnectionPool).
+DB_READ_POOL_SIZE = 4                   # Количество соединений-читателей (писатель всегда один)
+DB_BUSY_TIMEOUT_MS = 10000              # Сколько ждать освобождения блокировки файла, мс
+DB_MMAP_SIZE_BYTES = 256 * 1024 * 1024  # PRAGMA mmap_size: 256 МБ файла читаются через mmap
+DB_CACHE_SIZE_KIB = 64 * 1024           # PRAGMA cache_size: 64 МБ страничного кэша на соединение
+DB_STATEMENT_CACHE_SIZE = 256           # Кэш подготовленных выражений sqlite3 на соединение
+DB_WRITE_BEHIND_FLUSH_INTERVAL_MS = 5   # Как долго копить отложенные записи перед общим коммитом, мс
+DB_WRITE_BEHIND_MAX_BATCH = 200         # Максимум строк в одной групповой транзакции
+USER_CACHE_MAX_SIZE = 10000             # Сколько строк users держать в памяти (LRU)
+USER_CACHE_TTL_SECONDS = 300            # Через сколько секунд строка из кэша перечитывается из БД
+DIALOG_CACHE_MAX_SIZE = 20000           # Сколько соответствий (пользователь, персонаж) -> dialog_id держать в памяти
+DB_BACKFILL_BATCH_SIZE = 500            # Строк в одной пачке фонового дозаполнения (db_migrations.BACKFILLS)
+DB_BACKFILL_PAUSE_MS = 50               # Пауза между пачками дозаполнения, чтобы не занимать писателя, мс
+
+# --- Ограничение исходящих запросов к AI-провайдерам ---
+# [Dev-Ассистент]: Квоты для ai_clients.rate_limiter: rpm - запросов в минуту, tpm - токенов в минуту (None - без ограничения).
+# [Dev-Ассистент]: Лимитер один на пару (квота, API-ключ). Значения должны соответствовать тарифу аккаунта у провайдера.
+AI_RATE_LIMITS = {
+    "openai": {"rpm": 500, "tpm": 200_000},         # Чат-модели (gpt-4.1-nano, o4-mini), Tier 1
+    "openai_images": {"rpm": 50, "tpm": None},      # DALL-E 3 (отдельная квота изображений)
+    "openai_audio": {"rpm": 500, "tpm": None},      # Whisper
+    "openrouter": {"rpm": 20, "tpm": None},         # Бесплатные модели (:free) OpenRouter - 20 запросов в минуту
+    "gemini": {"rpm": 2000, "tpm": 4_000_000},      # gemini-1.5-flash, платный Tier 1
+    "yandexart": {"rpm": 10, "tpm": None},
+}
+# [Dev-Ассистент]: Сколько токенов ответа закладывать в оценку запроса, если max_tokens не задан.
+AI_RATE_LIMIT_OUTPUT_TOKENS_ESTIMATE = 1024
+
+# --- Повторы запросов к AI-провайдерам ---
+# [Dev-Ассистент]: Политика ai_clients.retry: повторяются только временные сбои (429, 5xx, обрывы соединения).
+AI_RETRY_MAX_ATTEMPTS = 3               # Всего попыток, включая первую
+AI_RETRY_BASE_DELAY_SECONDS = 0.5       # База экспоненциальной паузы (0.5, 1, 2 ... с полным джиттером)
+AI_RETRY_MAX_DELAY_SECONDS = 8          # Потолок паузы, если провайдер не прислал Retry-After
+AI_RETRY_ATTEMPT_TIMEOUT_SECONDS = 60   # Дедлайн одной попытки
+AI_RETRY_TOTAL_BUDGET_SECONDS = 90      # Сколько всего можно потратить на запрос вместе с повторами
+
+# --- Автоматы (circuit breaker) AI-провайдеров ---
+# [Dev-Ассистент]: См. ai_clients.health. При открытом автомате запрос уходит на запасную модель тарифа.
+AI_CIRCUIT_WINDOW_SECONDS = 120         # Окно скользящей статистики (доля ошибок, p95 латентности)
+AI_CIRCUIT_MIN_CALLS = 5                # Минимум запросов в окне, чтобы судить по доле ошибок
+AI_CIRCUIT_ERROR_RATE = 0.5             # Доля сбоев в окне, при которой автомат открывается
+AI_CIRCUIT_CONSECUTIVE_FAILURES = 3     # Или столько сбоев подряд
+AI_CIRCUIT_OPEN_SECONDS = 30            # Сколько автомат открыт до пробного запроса
+# [Dev-Ассистент]: Запасные модели в порядке предпочтения (берутся только доступные тарифу пользователя).
+# [Dev-Ассистент]: Для провайдера без записи запасными считаются все available_providers тарифа.
+AI_PROVIDER_FALLBACKS = {
+    GPT_1: [GPT_2, OPENROUTER_DEEPSEEK],
+    GPT_2: [GPT_1, OPENROUTER_DEEPSEEK],
+    OPENROUTER_DEEPSEEK: [GPT_1, GPT_2],
+    OPENROUTER_GEMINI_2_FLASH: [GPT_1, OPENROUTER_DEEPSEEK],
+    GEMINI_STANDARD: [GPT_1, GPT_2],
+}
+
+# --- Хеджирование запросов (ai_clients.hedging) ---
+# [Dev-Ассистент]: Включается в тарифе ключом "hedge_requests". Если основная модель не ответила за
+# [Dev-Ассистент]: p90 своей латентности, тот же запрос уходит во вторую модель тарифа, побеждает первый ответ.
+AI_HEDGE_PERCENTILE = 0.9               # Квантиль латентности основной модели, после которого запрос дублируется
+AI_HEDGE_MIN_SAMPLES = 20               # Без стольких замеров порог неизвестен и запрос не дублируется
+AI_HEDGE_MIN_DELAY_SECONDS = 1.0        # Порог не ниже этого значения, даже если модель обычно отвечает быстрее
+AI_HEDGE_MAX_PROMPT_CHARS = 2000        # Дублируем только короткие реплики: длинный промпт стоит дорого дважды
+
+# --- Цепочка ответов OpenAI (Responses API) ---
+# [Dev-Ассистент]: Если включено, текстовые запросы к GPT идут через Responses API: ответы хранятся у OpenAI,
+# [Dev-Ассистент]: и следующий ход отправляет только новое сообщение с previous_response_id, а не всю историю.
+# [Dev-Ассистент]: Полная история уходит после /reset, суммаризации, смены модели или если цепочка у OpenAI пропала.
+OPENAI_RESPONSES_CHAINING = False
+
+# --- Метрики ---
+METRICS_SAMPLE_SIZE = 500               # Сколько последних значений хранить в каждой выборке (metrics.observe)
+METRICS_LOG_INTERVAL_SECONDS = 300      # Как часто писать сводку метрик в лог, с (0 - не писать)
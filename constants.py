@@ -95,4 +95,12 @@ CURRENT_YANDEXART_RESOLUTION_KEY = "current_yandexart_resolution" # Ключ д
 
 # [Dev-Ассистент]: НОВАЯ КОНСТАНТА ДЛЯ ТИПОВ ТРАНЗАКЦИЙ (для БД)
 TRANSACTION_TYPE_IMAGE_GEN_COST = "image_gen_cost"
-TRANSACTION_TYPE_YANDEXART_GEN_COST = "yandexart_gen_cost" # [Dev-Ассистент]: Новый тип транзакции для YandexArt
\ No newline at end of file
+TRANSACTION_TYPE_YANDEXART_GEN_COST = "yandexart_gen_cost" # [Dev-Ассистент]: Новый тип транзакции для YandexArt
+TRANSACTION_TYPE_IMAGE_GEN_REFUND = "image_gen_refund" # [Dev-Ассистент]: Возврат за генерацию изображения, которая не удалась
+
+# [Dev-Ассистент]: Состояния заданий генерации изображений (таблица image_jobs, см. image_jobs.py)
+IMAGE_JOB_QUEUED = "queued"
+IMAGE_JOB_RUNNING = "running"
+IMAGE_JOB_DELIVERED = "delivered"
+IMAGE_JOB_FAILED = "failed"       # Генерация или доставка не удалась, средства еще не возвращены
+IMAGE_JOB_REFUNDED = "refunded"
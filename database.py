@@ -1,10 +1,12 @@
 # database.py (ОБНОВЛЕННАЯ ВЕРСИЯ - ДОБАВЛЕН referred_by_user_id)
 
-import sqlite3
 import logging
 import os
+import asyncio
 import aiosqlite
-from typing import Any, Dict, List, Optional, Union
+from cachetools import LRUCache, TTLCache
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple, Union
 from datetime import datetime, timedelta, date
 
 logger = logging.getLogger(__name__)
@@ -12,111 +14,259 @@ DB_FILE = os.path.join('data', 'gemini_bot.db')
 
 import config
 import constants
+import db_migrations
 
-def _init_db():
-    os.makedirs(os.path.dirname(DB_FILE), exist_ok=True)
-    try:
-        async def init_db_async(): # [Dev-Ассистент]: Временная асинхронная обертка для aiosqlite
-            async with aiosqlite.connect(DB_FILE) as con:
-                await con.execute("PRAGMA foreign_keys = ON")
-                
-                # [Dev-Ассистент]: Обновляем схему chat_history
-                await con.execute("""
-                    CREATE TABLE IF NOT EXISTS users (
-                        id INTEGER PRIMARY KEY,
-                        telegram_id INTEGER UNIQUE NOT NULL,
-                        full_name TEXT,
-                        username TEXT,
-                        current_character_name TEXT DEFAULT 'Базовый AI',
-                        current_ai_provider TEXT,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        daily_requests_count INTEGER DEFAULT 0,
-                        last_request_date TEXT,
-                        subscription_tier TEXT DEFAULT 'free' NOT NULL,
-                        is_verified BOOLEAN NOT NULL DEFAULT 0,
-                        subscription_expiry_date DATETIME,
-                        output_format TEXT DEFAULT 'text' NOT NULL,
-                        balance INTEGER DEFAULT 0 NOT NULL,
-                        referred_by_user_id INTEGER DEFAULT NULL,
-                        default_dalle3_resolution TEXT DEFAULT NULL,
-                        default_yandexart_resolution TEXT DEFAULT NULL,        
-                        FOREIGN KEY (referred_by_user_id) REFERENCES users (id) ON DELETE SET NULL -- <<< [Dev-Ассистент]: СВЯЗЬ
-                    )
-                """)
-                await con.execute("CREATE INDEX IF NOT EXISTS idx_users_referred_by ON users (referred_by_user_id);")
-                # [Dev-Ассистент]: Добавляем индекс для быстрого поиска рефералов
-                await con.execute("CREATE INDEX IF NOT EXISTS idx_users_referred_by ON users (referred_by_user_id);")
-
-                await con.execute("""
-                    CREATE TABLE IF NOT EXISTS transactions (
-                        id INTEGER PRIMARY KEY,
-                        user_id INTEGER NOT NULL,
-                        amount INTEGER NOT NULL,
-                        type TEXT NOT NULL,
-                        description TEXT,
-                        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        external_id TEXT,
-                        balance_before INTEGER,
-                        balance_after INTEGER,
-                        FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
-                    )
-                """)
-
-                await con.execute("CREATE INDEX IF NOT EXISTS idx_transactions_user_id ON transactions (user_id);")
-
-                await con.execute("""
-                    CREATE TABLE IF NOT EXISTS characters (
-                        id INTEGER PRIMARY KEY,
-                        user_id INTEGER NOT NULL,
-                        name TEXT NOT NULL,
-                        prompt TEXT NOT NULL,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE,
-                        UNIQUE (user_id, name)
-                    )
-                """)
-
-                # [Dev-Ассистент]: Модифицированная таблица chat_history
-                await con.execute("""
-                    CREATE TABLE IF NOT EXISTS chat_history (
-                        id INTEGER PRIMARY KEY,
-                        user_id INTEGER NOT NULL,
-                        character_name TEXT NOT NULL,
-                        role TEXT NOT NULL CHECK(role IN ('user', 'model')),
-                        content TEXT NOT NULL,
-                        token_count INTEGER NOT NULL DEFAULT 0, -- [Dev-Ассистент]: НОВЫЙ СТОЛБЕЦ
-                        is_summary BOOLEAN NOT NULL DEFAULT 0,  -- [Dev-Ассистент]: НОВЫЙ СТОЛБЕЦ
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
-                    )
-                """)
-                await con.execute("CREATE INDEX IF NOT EXISTS idx_chat_history_user_char ON chat_history (user_id, character_name);")
-                # [Dev-Ассистент]: Добавляем индекс для is_summary, чтобы ускорить поиск резюме
-                await con.execute("CREATE INDEX IF NOT EXISTS idx_chat_history_is_summary ON chat_history (user_id, character_name, is_summary);")
-
-                await con.execute("CREATE INDEX IF NOT EXISTS idx_chat_history_user_char ON chat_history (user_id, character_name);")
-                # [Dev-Ассистент]: Добавляем индекс для is_summary, чтобы ускорить поиск резюме
-                await con.execute("CREATE INDEX IF NOT EXISTS idx_chat_history_is_summary ON chat_history (user_id, character_name, is_summary);")
-
-                await con.commit()
-                logger.info("База данных успешно инициализирована (Архитектура: Подписки, Кошелек, Рефералы, Динамический Контекст).")             
-        # Запускаем асинхронную функцию из синхронного контекста (для инициализации)
-        # Это хак, т.к. _init_db вызывается в синхронном окружении.
-        # В рабочем коде (например, в main.py) db_request всегда будет вызываться асинхронно.
-        import asyncio
+# --- Пул соединений ---
+# [Dev-Ассистент]: Раньше каждый db_request открывал новое соединение (новый поток aiosqlite,
+# [Dev-Ассистент]: открытие файла, PRAGMA и пустой страничный кэш). Теперь соединения живут
+# [Dev-Ассистент]: всё время работы бота: один писатель и небольшой пул читателей (WAL позволяет
+# [Dev-Ассистент]: читать параллельно с записью).
+
+class _ConnectionPool:
+    """
+    Долгоживущий набор соединений к SQLite.
+    - Писатель: одно соединение, доступ сериализуется через asyncio.Lock.
+    - Читатели: config.DB_READ_POOL_SIZE соединений в режиме query_only.
+    """
+
+    def __init__(self, db_file: str, read_pool_size: int):
+        self._db_file = db_file
+        self._read_pool_size = max(1, read_pool_size)
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._write_lock = asyncio.Lock()
+        self._readers: asyncio.Queue = asyncio.Queue()
+        self._all_readers: List[aiosqlite.Connection] = []
+
+    async def _connect(self, read_only: bool) -> aiosqlite.Connection:
+        # [Dev-Ассистент]: isolation_level=None - транзакциями управляем сами (BEGIN IMMEDIATE в transaction()).
+        con = await aiosqlite.connect(
+            self._db_file,
+            timeout=config.DB_BUSY_TIMEOUT_MS / 1000,
+            isolation_level=None,
+            cached_statements=config.DB_STATEMENT_CACHE_SIZE,
+        )
+        con.row_factory = aiosqlite.Row
+        await con.execute("PRAGMA foreign_keys = ON")
+        await con.execute(f"PRAGMA busy_timeout = {int(config.DB_BUSY_TIMEOUT_MS)}")
+        await con.execute(f"PRAGMA mmap_size = {int(config.DB_MMAP_SIZE_BYTES)}")
+        await con.execute(f"PRAGMA cache_size = -{int(config.DB_CACHE_SIZE_KIB)}")
+        await con.execute("PRAGMA temp_store = MEMORY")
+        if read_only:
+            await con.execute("PRAGMA query_only = ON")
+        return con
+
+    async def open(self) -> None:
+        self._writer = await self._connect(read_only=False)
+        # [Dev-Ассистент]: journal_mode хранится в самом файле БД, достаточно выставить его писателем.
+        await self._writer.execute("PRAGMA journal_mode = WAL")
+        # [Dev-Ассистент]: В режиме WAL synchronous=NORMAL безопасен и избавляет от fsync на каждый коммит.
+        await self._writer.execute("PRAGMA synchronous = NORMAL")
+        for _ in range(self._read_pool_size):
+            con = await self._connect(read_only=True)
+            self._all_readers.append(con)
+            self._readers.put_nowait(con)
+        logger.info(f"Пул соединений SQLite открыт: 1 писатель, {self._read_pool_size} читателей.")
+
+    async def close(self) -> None:
+        async with self._write_lock:
+            for con in self._all_readers:
+                await con.close()
+            self._all_readers.clear()
+            if self._writer is not None:
+                # [Dev-Ассистент]: Переносим WAL в основной файл, чтобы он не рос между перезапусками.
+                try:
+                    await self._writer.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+                except aiosqlite.Error as e:
+                    logger.warning(f"Не удалось выполнить checkpoint WAL при закрытии пула: {e}")
+                await self._writer.close()
+                self._writer = None
+        logger.info("Пул соединений SQLite закрыт.")
+
+    @asynccontextmanager
+    async def reader(self) -> AsyncIterator[aiosqlite.Connection]:
+        con = await self._readers.get()
         try:
-            loop = asyncio.get_running_loop()
-        except RuntimeError:
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-        loop.run_until_complete(init_db_async())
-
-    except sqlite3.Error as e:
-        logger.error(f"Ошибка при инициализации базы данных SQLite: {e}", exc_info=True)
-        raise
-    except Exception as e: # [Dev-Ассистент]: Общая ошибка на случай проблем с asyncio
-        logger.error(f"Непредвиденная ошибка при инициализации базы данных: {e}", exc_info=True)
+            yield con
+        finally:
+            self._readers.put_nowait(con)
+
+    @asynccontextmanager
+    async def transaction(self) -> AsyncIterator[aiosqlite.Connection]:
+        """
+        Выдает соединение-писатель внутри транзакции BEGIN IMMEDIATE.
+        COMMIT при нормальном выходе, ROLLBACK при любом исключении.
+        """
+        async with self._write_lock:
+            con = self._writer
+            await con.execute("BEGIN IMMEDIATE")
+            try:
+                yield con
+            except BaseException:
+                if con.in_transaction:
+                    await con.execute("ROLLBACK")
+                raise
+            else:
+                await con.execute("COMMIT")
+
+
+_pool: Optional[_ConnectionPool] = None
+_pool_lock = asyncio.Lock()
+
+async def init_db_pool() -> _ConnectionPool:
+    """
+    Открывает пул соединений и доводит схему БД до актуальной версии
+    (вызывается один раз при старте приложения, в post_init).
+    """
+    global _pool
+    async with _pool_lock:
+        if _pool is None:
+            os.makedirs(os.path.dirname(DB_FILE) or '.', exist_ok=True)
+            pool = _ConnectionPool(DB_FILE, config.DB_READ_POOL_SIZE)
+            await pool.open()
+            try:
+                await _run_migrations(pool)
+            except Exception:
+                await pool.close()
+                raise
+            _pool = pool
+    return _pool
+
+async def close_db_pool() -> None:
+    """Закрывает пул соединений (вызывается при остановке приложения, в post_shutdown)."""
+    global _pool
+    await stop_backfills()
+    # [Dev-Ассистент]: Сначала дописываем всё, что накопила очередь отложенной записи.
+    await _write_queue.stop()
+    async with _pool_lock:
+        if _pool is not None:
+            await _pool.close()
+            _pool = None
+
+async def _get_pool() -> _ConnectionPool:
+    # [Dev-Ассистент]: Ленивое открытие - на случай вызова до post_init (скрипты, отладка).
+    return _pool if _pool is not None else await init_db_pool()
+
+# --- Миграции схемы ---
+# [Dev-Ассистент]: Версия схемы хранится в PRAGMA user_version. Если она актуальна, старт - одно чтение PRAGMA
+# [Dev-Ассистент]: без единого DDL. Сами шаги и фоновые дозаполнения описаны в db_migrations.py.
+
+async def _run_migrations(pool: _ConnectionPool) -> None:
+    async with pool.reader() as con:
+        async with con.execute("PRAGMA user_version") as cursor:
+            current_version = (await cursor.fetchone())[0]
+    if current_version == db_migrations.SCHEMA_VERSION:
+        logger.debug(f"Схема БД актуальна (версия {current_version}).")
+        return
+    if current_version > db_migrations.SCHEMA_VERSION:
+        raise RuntimeError(
+            f"Версия схемы БД ({current_version}) новее, чем знает этот код ({db_migrations.SCHEMA_VERSION})."
+        )
+
+    for version, migration in enumerate(db_migrations.MIGRATIONS[current_version:], start=current_version + 1):
+        logger.info(f"Миграция схемы БД до версии {version}: {migration.__name__}...")
+        # [Dev-Ассистент]: Шаг и новая user_version коммитятся вместе: упавший шаг откатывается целиком
+        # [Dev-Ассистент]: и будет повторен при следующем запуске.
+        async with pool.transaction() as con:
+            await migration(con)
+            await con.execute(f"PRAGMA user_version = {version}")
+    logger.info(f"Схема БД обновлена: версия {current_version} -> {db_migrations.SCHEMA_VERSION}.")
+
+# [Dev-Ассистент]: Дозаполнения идут маленькими пачками в отдельных транзакциях с паузами, чтобы не держать
+# [Dev-Ассистент]: писателя надолго. Прогресс (последний обработанный id) сохраняется в schema_backfills.
+_backfill_tasks: List[asyncio.Task] = []
+
+async def _save_backfill_progress(con: aiosqlite.Connection, name: str, last_id: int, done: bool) -> None:
+    await con.execute(
+        "INSERT INTO schema_backfills (name, last_id, completed_at) VALUES (?, ?, CASE WHEN ? THEN CURRENT_TIMESTAMP END) "
+        "ON CONFLICT (name) DO UPDATE SET last_id = excluded.last_id, completed_at = excluded.completed_at",
+        (name, last_id, done)
+    )
+
+async def _run_backfill(backfill: db_migrations.Backfill) -> None:
+    pool = await _get_pool()
+    async with pool.reader() as con:
+        async with con.execute("SELECT last_id, completed_at FROM schema_backfills WHERE name = ?", (backfill.name,)) as cursor:
+            progress = await cursor.fetchone()
+    if progress and progress['completed_at']:
+        return
+    last_id = progress['last_id'] if progress else 0
+    if backfill.source_table:
+        async with pool.reader() as con:
+            source_exists = await db_migrations.table_exists(con, backfill.source_table)
+        if not source_exists:
+            async with pool.transaction() as con:
+                await _save_backfill_progress(con, backfill.name, last_id, done=True)
+            return
+    batch_size = config.DB_BACKFILL_BATCH_SIZE
+    processed = 0
+    logger.info(f"Фоновое дозаполнение '{backfill.name}' запущено (с id > {last_id}).")
+
+    while True:
+        async with pool.reader() as con:
+            async with con.execute(backfill.fetch_query, (last_id, batch_size)) as cursor:
+                rows = [tuple(row) for row in await cursor.fetchall()]
+        # [Dev-Ассистент]: Вычисления (например, токенайзер) - в отдельном потоке, не в цикле событий.
+        updates = await asyncio.to_thread(backfill.compute, rows) if rows and backfill.compute else rows
+        done = len(rows) < batch_size
+        if rows:
+            last_id = rows[-1][0]
+        async with pool.transaction() as con:
+            if updates:
+                if backfill.apply is not None:
+                    await backfill.apply(con, updates)
+                else:
+                    await con.executemany(backfill.update_query, updates)
+            if done and backfill.on_complete is not None:
+                await backfill.on_complete(con)
+            await _save_backfill_progress(con, backfill.name, last_id, done)
+        processed += len(updates)
+        if done:
+            break
+        await asyncio.sleep(config.DB_BACKFILL_PAUSE_MS / 1000)
+
+    logger.info(f"Фоновое дозаполнение '{backfill.name}' завершено, обработано строк: {processed}.")
+
+async def _run_backfill_safely(backfill: db_migrations.Backfill) -> None:
+    try:
+        await _run_backfill(backfill)
+    except asyncio.CancelledError:
         raise
+    except Exception as e:
+        # [Dev-Ассистент]: Прогресс сохраняется по пачкам - при следующем запуске продолжим с того же места.
+        logger.error(f"Фоновое дозаполнение '{backfill.name}' прервано с ошибкой: {e}", exc_info=True)
+
+def start_backfills() -> None:
+    """Запускает фоновые дозаполнения данных (вызывается в post_init, после init_db_pool)."""
+    if any(not task.done() for task in _backfill_tasks):
+        return
+    _backfill_tasks.clear()
+    for backfill in db_migrations.BACKFILLS:
+        _backfill_tasks.append(asyncio.create_task(_run_backfill_safely(backfill), name=f"backfill:{backfill.name}"))
+
+async def stop_backfills() -> None:
+    """Останавливает фоновые дозаполнения (текущая пачка откатывается и будет повторена при следующем запуске)."""
+    for task in _backfill_tasks:
+        task.cancel()
+    for task in _backfill_tasks:
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+    _backfill_tasks.clear()
+
+def _is_read_query(query: str) -> bool:
+    """Только чистые SELECT идут на соединения-читатели, всё остальное - через писателя."""
+    return query.lstrip().upper().startswith("SELECT")
+
+async def _run_query(con: aiosqlite.Connection, query: str, params: tuple, fetch_one: bool, fetch_all: bool) -> Any:
+    async with con.execute(query, params) as cur:
+        if fetch_one:
+            row = await cur.fetchone()
+            return dict(row) if row else None
+        if fetch_all:
+            rows = await cur.fetchall()
+            return [dict(row) for row in rows]
+        return cur.lastrowid
 
 async def db_request(
     query: str, 
@@ -125,77 +275,264 @@ async def db_request(
     fetch_all: bool = False
 ) -> any:
     """
-    Выполняет асинхронный запрос к базе данных SQLite с использованием aiosqlite
+    Выполняет асинхронный запрос к базе данных SQLite через долгоживущий пул соединений
     и ГАРАНТИРОВАННО СОХРАНЯЕТ ИЗМЕНЕНИЯ перед возвратом результата.
+    SELECT выполняются на соединениях-читателях, изменения - одной транзакцией на писателе.
     """
     try:
-        async with aiosqlite.connect(DB_FILE, timeout=10) as con:
-            await con.execute("PRAGMA foreign_keys = ON")
-            
-            con.row_factory = aiosqlite.Row
-            
-            async with con.cursor() as cur:
-                await cur.execute(query, params)
-
-                result = None
-                if fetch_one:
-                    row = await cur.fetchone()
-                    result = dict(row) if row else None
-                elif fetch_all:
-                    rows = await cur.fetchall()
-                    result = [dict(row) for row in rows]
-                else:
-                    result = cur.lastrowid
-                
-                await con.commit()
-                
-                return result
+        pool = await _get_pool()
+        if _is_read_query(query):
+            async with pool.reader() as con:
+                return await _run_query(con, query, params, fetch_one, fetch_all)
+        async with pool.transaction() as con:
+            return await _run_query(con, query, params, fetch_one, fetch_all)
 
     except aiosqlite.Error as e:
         logger.error(f"Ошибка выполнения DB запроса: {query} с параметрами {params}. Ошибка: {e}", exc_info=True)
-        # [Dev-Ассистент]: Rollback не нужен, т.к. aiosqlite.connect() как контекстный менеджер
-        # [Dev-Ассистент]: откатит изменения при исключении автоматически.
+        # [Dev-Ассистент]: Rollback уже выполнен в pool.transaction() при исключении.
         return None
 
+# --- Отложенная запись (group commit) ---
+# [Dev-Ассистент]: Записи "выстрелил и забыл" (история чата, цепочка ответов диалога) не коммитятся
+# [Dev-Ассистент]: по одной: единственный воркер копит их несколько миллисекунд (или до N строк)
+# [Dev-Ассистент]: и сохраняет одной транзакцией. Кому нужно прочитать свою запись - вызывает
+# [Dev-Ассистент]: flush_pending_writes() (или ждет future, который вернул enqueue_write).
+
+class _WriteBehindQueue:
+    """Однописательный актор, выполняющий накопленные INSERT/UPDATE одной транзакцией."""
+
+    def __init__(self, flush_interval_ms: int, max_batch: int):
+        self._flush_interval = flush_interval_ms / 1000
+        self._max_batch = max(1, max_batch)
+        self._queue: Optional[asyncio.Queue] = None
+        self._flush_requested: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._pending = 0
+
+    def _ensure_started(self) -> None:
+        if self._task is None or self._task.done():
+            self._queue = self._queue or asyncio.Queue()
+            self._flush_requested = self._flush_requested or asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    def submit(self, query: Optional[str], params: tuple = ()) -> asyncio.Future:
+        """
+        Ставит запрос в очередь. Возвращает future с lastrowid (или None при ошибке).
+        query=None - "барьер": future выполнится, когда будет сохранено всё, что стояло перед ним.
+        """
+        self._ensure_started()
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((query, params, future))
+        self._pending += 1
+        if query is None or self._queue.qsize() >= self._max_batch:
+            self._flush_requested.set()
+        return future
+
+    async def flush(self) -> None:
+        if self._pending == 0:
+            return
+        await self.submit(None)
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        await self.flush()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            batch = [await self._queue.get()]
+            try:
+                if not self._flush_requested.is_set():
+                    try:
+                        await asyncio.wait_for(self._flush_requested.wait(), timeout=self._flush_interval)
+                    except asyncio.TimeoutError:
+                        pass
+                while len(batch) < self._max_batch and not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                if self._queue.empty():
+                    self._flush_requested.clear()
+                await self._commit(batch)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Непредвиденная ошибка в очереди отложенной записи: {e}", exc_info=True)
+                self._resolve(batch, [None] * len(batch))
+
+    async def _commit(self, batch: List[tuple]) -> None:
+        results: List[Any] = [None] * len(batch)
+        writes = [(i, query, params) for i, (query, params, _) in enumerate(batch) if query is not None]
+        if writes:
+            try:
+                pool = await _get_pool()
+                async with pool.transaction() as con:
+                    for i, query, params in writes:
+                        async with con.execute(query, params) as cur:
+                            results[i] = cur.lastrowid
+                logger.debug(f"Групповой коммит: {len(writes)} записей одной транзакцией.")
+            except aiosqlite.Error as e:
+                # [Dev-Ассистент]: Одна "плохая" строка не должна терять остальные - повторяем по одной.
+                logger.warning(f"Групповой коммит ({len(writes)} записей) не удался: {e}. Повторяем по одной.")
+                for i, query, params in writes:
+                    results[i] = await db_request(query, params)
+        self._resolve(batch, results)
+
+    def _resolve(self, batch: List[tuple], results: List[Any]) -> None:
+        for (_, _, future), result in zip(batch, results):
+            self._pending -= 1
+            if not future.done():
+                future.set_result(result)
+
+
+_write_queue = _WriteBehindQueue(config.DB_WRITE_BEHIND_FLUSH_INTERVAL_MS, config.DB_WRITE_BEHIND_MAX_BATCH)
+
+def enqueue_write(query: str, params: tuple = ()) -> asyncio.Future:
+    """
+    Ставит запись в очередь группового коммита и сразу возвращает управление.
+    Возвращенный future можно подождать, чтобы получить lastrowid (None при ошибке).
+    """
+    return _write_queue.submit(query, params)
+
+async def flush_pending_writes() -> None:
+    """Дожидается сохранения всех записей, поставленных в очередь до этого вызова (read-your-writes)."""
+    await _write_queue.flush()
+
+# --- Кэш строк users ---
+# [Dev-Ассистент]: Один апдейт читает строку пользователя несколько раз (require_verification,
+# [Dev-Ассистент]: inject_user_data, process_ai_request). Держим строки в ограниченном LRU/TTL-кэше
+# [Dev-Ассистент]: по id и telegram_id. Все функции этого модуля, меняющие users, обновляют кэш
+# [Dev-Ассистент]: (через RETURNING *) или сбрасывают запись. Менять users в обход них нельзя.
+
+class _UserCache:
+    """LRU/TTL-кэш строк таблицы users с доступом по id и по telegram_id."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self._rows = TTLCache(maxsize=maxsize, ttl=ttl)             # id -> строка
+        self._ids_by_telegram = TTLCache(maxsize=maxsize, ttl=ttl)  # telegram_id -> id
+
+    def get_by_id(self, user_id: int) -> Optional[Dict]:
+        row = self._rows.get(user_id)
+        # [Dev-Ассистент]: Отдаем копию, чтобы вызывающий код не мог испортить кэш.
+        return dict(row) if row is not None else None
+
+    def get_by_telegram_id(self, telegram_id: int) -> Optional[Dict]:
+        user_id = self._ids_by_telegram.get(telegram_id)
+        return self.get_by_id(user_id) if user_id is not None else None
+
+    def put(self, row: Optional[Dict]) -> None:
+        if not row:
+            return
+        self._rows[row['id']] = dict(row)
+        self._ids_by_telegram[row['telegram_id']] = row['id']
+
+    def patch(self, user_id: int, **fields: Any) -> None:
+        row = self._rows.get(user_id)
+        if row is not None:
+            row.update(fields)
+
+    def invalidate(self, user_id: Optional[int] = None, telegram_id: Optional[int] = None) -> None:
+        if user_id is None and telegram_id is not None:
+            user_id = self._ids_by_telegram.get(telegram_id)
+        if user_id is not None:
+            row = self._rows.pop(user_id, None)
+            if row is not None:
+                self._ids_by_telegram.pop(row['telegram_id'], None)
+        if telegram_id is not None:
+            self._ids_by_telegram.pop(telegram_id, None)
+
+    def clear(self) -> None:
+        self._rows.clear()
+        self._ids_by_telegram.clear()
+
+
+_user_cache = _UserCache(config.USER_CACHE_MAX_SIZE, config.USER_CACHE_TTL_SECONDS)
+
+async def _update_user_row(query: str, params: tuple, user_id: Optional[int] = None, telegram_id: Optional[int] = None) -> Optional[Dict]:
+    """
+    Выполняет UPDATE/INSERT по таблице users с RETURNING * и кладет свежую строку в кэш.
+    Если строка не вернулась (ошибка или нет такого пользователя) - сбрасывает запись кэша.
+    """
+    row = await db_request(f"{query} RETURNING *", params, fetch_one=True)
+    if row:
+        _user_cache.put(row)
+    else:
+        _user_cache.invalidate(user_id=user_id, telegram_id=telegram_id)
+    return row
+
+def invalidate_cached_user(user_id: Optional[int] = None, telegram_id: Optional[int] = None) -> None:
+    """Сбрасывает строку пользователя из кэша (например, после ручной правки таблицы users)."""
+    _user_cache.invalidate(user_id=user_id, telegram_id=telegram_id)
+
 def _get_default_ai_provider_for_tier(tier_name: str) -> str:
     """Возвращает AI-провайдера по умолчанию для указанного тарифного плана."""
     tier_config = config.SUBSCRIPTION_TIERS.get(tier_name, config.SUBSCRIPTION_TIERS[constants.TIER_FREE])
     return tier_config.get('ai_provider', constants.GPT_1)
 
 # --- Пользователи ---
-# [Dev-Ассистент]: Обновили add_or_update_user, чтобы он принимал referer_id
-async def add_or_update_user(telegram_id: int, full_name: str, username: Optional[str], referer_id: Optional[int] = None) -> Optional[int]:
-    existing_user = await db_request("SELECT id, subscription_tier, current_ai_provider, referred_by_user_id FROM users WHERE telegram_id = ?", (telegram_id,), fetch_one=True)
+def _profile_fingerprint(full_name: Optional[str], username: Optional[str]) -> tuple:
+    """Отпечаток профиля Telegram, по которому решаем, нужно ли переписывать имя/юзернейм."""
+    return (full_name or None, username or None)
+
+async def resolve_user(telegram_id: int, full_name: str, username: Optional[str], referer_id: Optional[int] = None) -> Optional[Dict]:
+    """
+    Находит (или создает) пользователя и возвращает его полную строку из users.
+    UPDATE выполняется, только если имя/юзернейм действительно изменились
+    или нужно записать реферера, - в обычном случае это чтение из кэша без обращения к БД.
+    :param telegram_id: Telegram ID пользователя.
+    :param full_name: Полное имя из Telegram.
+    :param username: Юзернейм из Telegram.
+    :param referer_id: ID реферера в БД (записывается, только если еще не задан).
+    :return: Строка пользователя или None при ошибке.
+    """
+    existing_user = await get_user_by_telegram_id(telegram_id)
     
     if existing_user:
-        # [Dev-Ассистент]: Если пользователь существует, обновляем его имя и юзернейм.
+        # [Dev-Ассистент]: Если пользователь существует, обновляем его имя и юзернейм - но только когда они поменялись.
         # [Dev-Ассистент]: И если referer_id передан и в БД его еще нет, записываем.
-        update_params = [full_name, username, telegram_id]
-        update_query = "UPDATE users SET full_name = ?, username = ?"
-        
+        set_clauses, update_params = [], []
+        if _profile_fingerprint(full_name, username) != _profile_fingerprint(existing_user.get('full_name'), existing_user.get('username')):
+            set_clauses.append("full_name = ?, username = ?")
+            update_params.extend([full_name, username])
+
         if referer_id is not None and existing_user.get('referred_by_user_id') is None:
-            update_query += ", referred_by_user_id = ?"
-            update_params.insert(0, referer_id) # Добавляем referer_id в начало, чтобы он соответствовал ?
-            # Переставляем telegram_id в конец
-            update_params = update_params[1:] + [update_params[0]] 
+            set_clauses.append("referred_by_user_id = ?")
+            update_params.append(referer_id)
             logger.info(f"Обновлен пользователь telegram_id={telegram_id}: добавлен реферер user_id={referer_id}.")
 
-        update_query += " WHERE telegram_id = ? RETURNING id"
-        result = await db_request(update_query, tuple(update_params), fetch_one=True)
-        return result['id'] if result else None
+        if not set_clauses:
+            return existing_user
+
+        update_query = f"UPDATE users SET {', '.join(set_clauses)} WHERE telegram_id = ?"
+        return await _update_user_row(update_query, (*update_params, telegram_id), telegram_id=telegram_id)
     else:
         # [Dev-Ассистент]: Если пользователь новый, создаем его с реферером (если есть)
         default_tier = constants.TIER_FREE
         default_ai_provider = _get_default_ai_provider_for_tier(default_tier)
         
-        query = "INSERT INTO users (telegram_id, full_name, username, subscription_tier, current_ai_provider, balance, referred_by_user_id) VALUES (?, ?, ?, ?, ?, ?, ?) RETURNING id"
-        result = await db_request(query, (telegram_id, full_name, username, default_tier, default_ai_provider, 0, referer_id), fetch_one=True)
+        query = "INSERT INTO users (telegram_id, full_name, username, subscription_tier, current_ai_provider, balance, referred_by_user_id) VALUES (?, ?, ?, ?, ?, ?, ?)"
+        result = await _update_user_row(query, (telegram_id, full_name, username, default_tier, default_ai_provider, 0, referer_id), telegram_id=telegram_id)
         logger.info(f"Создан новый пользователь telegram_id={telegram_id} с тарифом '{default_tier}', AI '{default_ai_provider}', баланс: 0, реферер: {referer_id or 'None'}.")
-        return result['id'] if result else None
+        return result
+
+# [Dev-Ассистент]: Обновили add_or_update_user, чтобы он принимал referer_id
+async def add_or_update_user(telegram_id: int, full_name: str, username: Optional[str], referer_id: Optional[int] = None) -> Optional[int]:
+    """То же, что resolve_user, но возвращает только ID пользователя."""
+    user = await resolve_user(telegram_id, full_name, username, referer_id=referer_id)
+    return user['id'] if user else None
 
 
 async def get_user_by_id(user_id: int) -> Optional[Dict]:
-    return await db_request("SELECT * FROM users WHERE id = ?", (user_id,), fetch_one=True)
+    cached = _user_cache.get_by_id(user_id)
+    if cached is not None:
+        return cached
+    row = await db_request("SELECT * FROM users WHERE id = ?", (user_id,), fetch_one=True)
+    _user_cache.put(row)
+    return row
 
 # [Dev-Ассистент]: НОВАЯ ВСПОМОГАТЕЛЬНАЯ ФУНКЦИЯ: получить реферера пользователя
 async def get_referrer_for_user(user_id: int) -> Optional[Dict]:
@@ -204,19 +541,25 @@ async def get_referrer_for_user(user_id: int) -> Optional[Dict]:
     return await db_request(query, (user_id,), fetch_one=True)
 
 async def get_and_update_user_usage(user_id: int, daily_limit: int) -> Dict:
+    """
+    Проверяет дневной лимит и засчитывает запрос ОДНИМ атомарным UPDATE.
+    Новый день сбрасывает счетчик на 1; при исчерпанном лимите строка не меняется и не возвращается,
+    поэтому параллельные запросы одного пользователя не могут проскочить лимит.
+    """
     today_str = date.today().isoformat()
-    user_usage = await db_request("SELECT daily_requests_count, last_request_date FROM users WHERE id = ?", (user_id,), fetch_one=True)
-    if not user_usage:
-        return {"can_request": False, "requests_left": 0, "limit": daily_limit}
-    last_request_date_str = user_usage.get('last_request_date')
-    current_count = user_usage.get('daily_requests_count', 0)
-    if last_request_date_str != today_str:
-        await db_request("UPDATE users SET daily_requests_count = 1, last_request_date = ? WHERE id = ?", (today_str, user_id))
-        return {"can_request": True, "requests_left": daily_limit - 1, "limit": daily_limit}
-    if current_count >= daily_limit:
+    query = """
+        UPDATE users SET
+            daily_requests_count = CASE WHEN last_request_date IS ? THEN daily_requests_count + 1 ELSE 1 END,
+            last_request_date = ?
+        WHERE id = ? AND (last_request_date IS NOT ? OR daily_requests_count < ?)
+        RETURNING *
+    """
+    row = await db_request(query, (today_str, today_str, user_id, today_str, daily_limit), fetch_one=True)
+    if not row:
+        # [Dev-Ассистент]: Лимит исчерпан (или нет такого пользователя) - записи не было, кэш остается верным.
         return {"can_request": False, "requests_left": 0, "limit": daily_limit}
-    await db_request("UPDATE users SET daily_requests_count = daily_requests_count + 1 WHERE id = ?", (user_id,))
-    return {"can_request": True, "requests_left": daily_limit - (current_count + 1), "limit": daily_limit}
+    _user_cache.put(row)
+    return {"can_request": True, "requests_left": max(0, daily_limit - row['daily_requests_count']), "limit": daily_limit}
 
 async def set_user_subscription(telegram_id: int, tier: str, duration_days: int) -> None:
     expiry_date = None
@@ -227,13 +570,13 @@ async def set_user_subscription(telegram_id: int, tier: str, duration_days: int)
     new_default_ai_provider = _get_default_ai_provider_for_tier(tier)
     
     query = "UPDATE users SET subscription_tier = ?, subscription_expiry_date = ?, daily_requests_count = 0, last_request_date = ?, current_ai_provider = ? WHERE telegram_id = ?"
-    await db_request(query, (tier, expiry_date, today_str, new_default_ai_provider, telegram_id))
+    await _update_user_row(query, (tier, expiry_date, today_str, new_default_ai_provider, telegram_id), telegram_id=telegram_id)
     logger.info(f"Для пользователя telegram_id={telegram_id} установлен тариф '{tier}' до {expiry_date}, AI по умолчанию: '{new_default_ai_provider}'")
 
 async def set_user_tier_to_free(user_id: int):
     default_free_ai_provider = _get_default_ai_provider_for_tier(constants.TIER_FREE)
     query = "UPDATE users SET subscription_tier = 'free', subscription_expiry_date = NULL, current_ai_provider = ? WHERE id = ?"
-    await db_request(query, (default_free_ai_provider, user_id,))
+    await _update_user_row(query, (default_free_ai_provider, user_id,), user_id=user_id)
     logger.info(f"Подписка для user_id={user_id} сброшена до 'free'. AI установлен на '{default_free_ai_provider}'.")
 
 async def add_transaction(
@@ -267,64 +610,109 @@ async def add_transaction(
     )
     return result['id'] if result else None
 
-# [Dev-Ассистент]: НОВАЯ ФУНКЦИЯ: Обновление баланса пользователя (с записью транзакции и реферальным бонусом)
+# [Dev-Ассистент]: Изменение баланса пользователя (с записью транзакции и реферальным бонусом)
+async def _apply_ledger_entry(
+    con: aiosqlite.Connection,
+    user_id: int,
+    amount_change: int,
+    transaction_type: str,
+    description: Optional[str],
+    external_id: Optional[str],
+    allow_negative: bool
+) -> Optional[Dict]:
+    """
+    Атомарно меняет баланс (balance = balance + ?) и пишет транзакцию внутри уже открытой транзакции БД.
+    Возвращает обновленную строку users или None, если пользователя нет / не хватает средств (при allow_negative=False).
+    """
+    update_query = "UPDATE users SET balance = balance + ? WHERE id = ?"
+    params: tuple = (amount_change, user_id)
+    if not allow_negative:
+        update_query += " AND balance + ? >= 0"
+        params += (amount_change,)
+    async with con.execute(f"{update_query} RETURNING *", params) as cursor:
+        row = await cursor.fetchone()
+    if not row:
+        return None
+    user = dict(row)
+    new_balance = user['balance']
+    await con.execute(
+        """
+        INSERT INTO transactions (user_id, amount, type, description, external_id, balance_before, balance_after)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        """,
+        (user_id, amount_change, transaction_type, description, external_id, new_balance - amount_change, new_balance)
+    )
+    return user
+
 async def update_user_balance(
     user_id: int, 
     amount_change: int, 
     transaction_type: str, 
     description: Optional[str] = None, 
-    external_id: Optional[str] = None
+    external_id: Optional[str] = None,
+    allow_negative: bool = True
 ) -> bool:
     """
     Изменяет баланс пользователя и записывает транзакцию.
     Если transaction_type - 'topup', проверяет наличие реферера и начисляет ему процент.
+    Всё (баланс, транзакция, комиссия рефереру) выполняется одной транзакцией BEGIN IMMEDIATE:
+    либо применяется целиком, либо не применяется вовсе.
     :param user_id: ID пользователя.
     :param amount_change: Сумма изменения баланса (положительная для пополнения, отрицательная для списания).
     :param transaction_type: Тип транзакции.
     :param description: Описание.
-    :param external_id: Внешний ID (для платежных систем).
-    :return: True, если обновление успешно, False в противном случае.
+    :param external_id: Внешний ID (ключ идемпотентности: повтор с тем же ID не меняет баланс повторно).
+    :param allow_negative: False - не уходить в минус (списание не выполняется, если средств не хватает).
+    :return: True, если обновление успешно (или уже было применено с этим external_id), False в противном случае.
     """
-    user = await get_user_by_id(user_id)
-    if not user:
-        logger.error(f"Пользователь с ID {user_id} не найден для обновления баланса.")
-        return False
+    changed_users: List[Dict] = []
+    try:
+        pool = await _get_pool()
+        async with pool.transaction() as con:
+            if external_id is not None:
+                async with con.execute("SELECT id FROM transactions WHERE external_id = ?", (external_id,)) as cursor:
+                    if await cursor.fetchone():
+                        logger.info(f"Транзакция с external_id={external_id} уже проведена, повтор пропущен.")
+                        return True
 
-    old_balance = user.get('balance', 0)
-    new_balance = old_balance + amount_change
-
-    # Обновляем баланс в таблице users
-    update_query = "UPDATE users SET balance = ? WHERE id = ?"
-    await db_request(update_query, (new_balance, user_id))
-
-    # Добавляем запись о транзакции
-    await add_transaction(
-        user_id, 
-        amount_change, 
-        transaction_type, 
-        description, 
-        external_id,
-        old_balance,
-        new_balance
-    )
-    logger.info(f"Баланс user_id={user_id} изменен на {amount_change}. Новый баланс: {new_balance}.")
-
-    # [Dev-Ассистент]: ЛОГИКА РЕФЕРАЛЬНОГО ПРОЦЕНТА
-    if transaction_type == constants.TRANSACTION_TYPE_TOPUP and amount_change > 0:
-        referrer = await get_referrer_for_user(user_id)
-        if referrer:
-            referrer_user_id = referrer['id']
-            commission_amount = int(amount_change * config.REFERRAL_PERCENTAGE / 100) # Процент от пополнения
-            if commission_amount > 0:
-                logger.info(f"Начисление реферальной комиссии: {commission_amount} AGMcoin рефереру {referrer_user_id} от пополнения {user_id}.")
-                # Начисляем комиссию рефереру
-                await update_user_balance(
-                    referrer_user_id, 
-                    commission_amount, 
-                    constants.TRANSACTION_TYPE_REFERRAL_COMMISSION,
-                    f"Реферальная комиссия от пополнения пользователя {user.get('username', user.get('telegram_id'))} ({amount_change} AGMcoin)"
-                )
+            user = await _apply_ledger_entry(con, user_id, amount_change, transaction_type, description, external_id, allow_negative)
+            if not user:
+                if allow_negative:
+                    logger.error(f"Пользователь с ID {user_id} не найден для обновления баланса.")
+                else:
+                    logger.info(f"Недостаточно средств у user_id={user_id} для изменения баланса на {amount_change}.")
+                # [Dev-Ассистент]: Кэш мог показывать устаревший баланс - пусть следующее чтение возьмет его из БД.
+                _user_cache.invalidate(user_id=user_id)
+                return False
+            changed_users.append(user)
 
+            # [Dev-Ассистент]: ЛОГИКА РЕФЕРАЛЬНОГО ПРОЦЕНТА
+            referrer_user_id = user.get('referred_by_user_id')
+            if transaction_type == constants.TRANSACTION_TYPE_TOPUP and amount_change > 0 and referrer_user_id:
+                commission_amount = int(amount_change * config.REFERRAL_PERCENTAGE / 100) # Процент от пополнения
+                if commission_amount > 0:
+                    logger.info(f"Начисление реферальной комиссии: {commission_amount} AGMcoin рефереру {referrer_user_id} от пополнения {user_id}.")
+                    referrer = await _apply_ledger_entry(
+                        con,
+                        referrer_user_id,
+                        commission_amount,
+                        constants.TRANSACTION_TYPE_REFERRAL_COMMISSION,
+                        f"Реферальная комиссия от пополнения пользователя {user.get('username') or user.get('telegram_id')} ({amount_change} AGMcoin)",
+                        f"{external_id}:referral" if external_id is not None else None,
+                        allow_negative=True
+                    )
+                    if referrer:
+                        changed_users.append(referrer)
+    except aiosqlite.Error as e:
+        # [Dev-Ассистент]: Rollback уже выполнен в pool.transaction() - баланс не изменился.
+        logger.error(f"Ошибка при изменении баланса user_id={user_id} на {amount_change}: {e}", exc_info=True)
+        for changed_user in changed_users:
+            _user_cache.invalidate(user_id=changed_user['id'], telegram_id=changed_user['telegram_id'])
+        return False
+
+    for changed_user in changed_users:
+        _user_cache.put(changed_user)
+    logger.info(f"Баланс user_id={user_id} изменен на {amount_change}. Новый баланс: {changed_users[0]['balance']}.")
     return True
 
 # [Dev-Ассистент]: НОВАЯ ФУНКЦИЯ: Получить рефералов пользователя
@@ -340,11 +728,161 @@ async def get_user_referral_earnings(user_id: int) -> int:
     result = await db_request(query, (user_id, constants.TRANSACTION_TYPE_REFERRAL_COMMISSION), fetch_one=True)
     return result['SUM(amount)'] if result and result['SUM(amount)'] is not None else 0
 
+# --- Задания генерации изображений ---
+# [Dev-Ассистент]: Списание и запись задания - одна транзакция: после сбоя не бывает ни оплаты без задания,
+# [Dev-Ассистент]: ни задания без оплаты. Возврат и перевод задания в refunded - тоже одна транзакция,
+# [Dev-Ассистент]: поэтому повторный возврат (например, после перезапуска) второй раз денег не начислит.
+
+async def create_image_job(
+    user_id: int,
+    chat_id: int,
+    provider: str,
+    prompt: str,
+    resolution: str,
+    cost: int,
+    transaction_type: str,
+    description: Optional[str] = None
+) -> Optional[int]:
+    """
+    Списывает стоимость генерации и создает задание в состоянии queued.
+    :param cost: Стоимость в AGMcoin (при неудаче возвращается именно она).
+    :return: ID задания или None, если средств не хватает (или пользователь не найден, или ошибка БД).
+    """
+    try:
+        pool = await _get_pool()
+        async with pool.transaction() as con:
+            user = await _apply_ledger_entry(con, user_id, -cost, transaction_type, description, None, allow_negative=False)
+            if not user:
+                _user_cache.invalidate(user_id=user_id)
+                return None
+            async with con.execute(
+                """
+                INSERT INTO image_jobs (user_id, chat_id, provider, prompt, resolution, cost, status)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                """,
+                (user_id, chat_id, provider, prompt, resolution, cost, constants.IMAGE_JOB_QUEUED)
+            ) as cursor:
+                job_id = cursor.lastrowid
+    except aiosqlite.Error as e:
+        logger.error(f"Ошибка при создании задания генерации для user_id={user_id}: {e}", exc_info=True)
+        _user_cache.invalidate(user_id=user_id)
+        return None
+
+    _user_cache.put(user)
+    logger.info(f"Задание генерации {job_id} ({provider}, {resolution}) создано, с user_id={user_id} списано {cost} AGMcoin.")
+    return job_id
+
+async def start_image_job(job_id: int) -> Optional[Dict]:
+    """
+    Переводит задание из queued в running и увеличивает счетчик попыток.
+    :return: Строка задания или None, если задание уже не в очереди (его взял другой воркер или оно завершено).
+    """
+    query = """
+        UPDATE image_jobs SET status = ?, attempts = attempts + 1, updated_at = CURRENT_TIMESTAMP
+        WHERE id = ? AND status = ? RETURNING *
+    """
+    return await db_request(query, (constants.IMAGE_JOB_RUNNING, job_id, constants.IMAGE_JOB_QUEUED), fetch_one=True)
+
+async def set_image_job_status(job_id: int, status: str, error: Optional[str] = None) -> None:
+    """Записывает новое состояние задания (constants.IMAGE_JOB_*) и текст ошибки, если он есть."""
+    query = "UPDATE image_jobs SET status = ?, error = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?"
+    await db_request(query, (status, error, job_id))
+
+async def get_unfinished_image_jobs() -> List[Dict]:
+    """Задания в состояниях queued, running и failed (по порядку создания) с возрастом в секундах."""
+    query = """
+        SELECT *, CAST((julianday('now') - julianday(created_at)) * 86400 AS INTEGER) AS age_seconds
+        FROM image_jobs WHERE status IN (?, ?, ?) ORDER BY id
+    """
+    params = (constants.IMAGE_JOB_QUEUED, constants.IMAGE_JOB_RUNNING, constants.IMAGE_JOB_FAILED)
+    return await db_request(query, params, fetch_all=True) or []
+
+async def refund_image_job(job_id: int, reason: Optional[str] = None) -> bool:
+    """
+    Возвращает пользователю стоимость задания и переводит его в refunded.
+    Доставленные и уже возвращенные задания не меняются.
+    :param reason: Текст ошибки для задания (None - оставить записанный ранее).
+    :return: True, если возврат проведен сейчас, False - если задание уже завершено или произошла ошибка БД.
+    """
+    user = None
+    try:
+        pool = await _get_pool()
+        async with pool.transaction() as con:
+            async with con.execute(
+                """
+                UPDATE image_jobs SET status = ?, error = COALESCE(?, error), updated_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND status NOT IN (?, ?) RETURNING user_id, cost, provider, resolution
+                """,
+                (constants.IMAGE_JOB_REFUNDED, reason, job_id, constants.IMAGE_JOB_DELIVERED, constants.IMAGE_JOB_REFUNDED)
+            ) as cursor:
+                job = await cursor.fetchone()
+            if not job:
+                return False
+            user = await _apply_ledger_entry(
+                con, job['user_id'], job['cost'], constants.TRANSACTION_TYPE_IMAGE_GEN_REFUND,
+                f"Возврат за генерацию {job['provider']}: {job['resolution']} ({job['cost']} AGMcoin)",
+                f"image_job:{job_id}:refund", allow_negative=True
+            )
+    except aiosqlite.Error as e:
+        logger.error(f"Ошибка при возврате средств за задание генерации {job_id}: {e}", exc_info=True)
+        return False
+
+    if user:
+        _user_cache.put(user)
+    logger.info(f"Задание генерации {job_id} завершено возвратом средств.")
+    return True
+
 # --- Персонажи и История ---
+# [Dev-Ассистент]: dialog_id пары (user_id, character_name) не меняется, пока жива строка dialogs,
+# [Dev-Ассистент]: поэтому держим соответствие в памяти и не ищем его по текстовому ключу на каждый запрос.
+_dialog_ids = LRUCache(maxsize=config.DIALOG_CACHE_MAX_SIZE)
+# [Dev-Ассистент]: Пока фоновое дозаполнение не перенесло старую chat_history (db_migrations.LEGACY_CHAT_HISTORY),
+# [Dev-Ассистент]: диалог переносится при первом обращении. Флаг сбрасывается, как только старой таблицы не стало.
+_legacy_history_pending = True
+
+async def _move_legacy_dialog(user_id: int, character_name: str) -> None:
+    global _legacy_history_pending
+    if not _legacy_history_pending:
+        return
+    pool = await _get_pool()
+    # [Dev-Ассистент]: Под блокировкой писателя: фоновый перенос того же диалога и удаление старой таблицы идут через нее же.
+    async with pool.transaction() as con:
+        if not await db_migrations.table_exists(con, db_migrations.LEGACY_CHAT_HISTORY):
+            _legacy_history_pending = False
+            return
+        moved = await db_migrations.move_legacy_dialog(con, user_id, character_name)
+    if moved:
+        logger.info(f"История диалога user_id={user_id}, char='{character_name}' перенесена из старой таблицы: {moved} сообщений.")
+
+async def _get_dialog_id(user_id: int, character_name: str, create: bool = False) -> Optional[int]:
+    """
+    Возвращает id диалога (пользователь + персонаж).
+    При create=True создает диалог, если его еще нет; иначе для несуществующего диалога вернет None.
+    """
+    key = (user_id, character_name)
+    dialog_id = _dialog_ids.get(key)
+    if dialog_id is not None:
+        return dialog_id
+    await _move_legacy_dialog(user_id, character_name)
+    row = await db_request("SELECT id FROM dialogs WHERE user_id = ? AND character_name = ?", key, fetch_one=True)
+    if not row and create:
+        # [Dev-Ассистент]: DO UPDATE (а не DO NOTHING), чтобы RETURNING вернул id и при гонке двух вставок.
+        row = await db_request(
+            "INSERT INTO dialogs (user_id, character_name) VALUES (?, ?) "
+            "ON CONFLICT (user_id, character_name) DO UPDATE SET user_id = excluded.user_id RETURNING id",
+            key, fetch_one=True
+        )
+    if not row:
+        return None
+    _dialog_ids[key] = row['id']
+    return row['id']
+
 # [Dev-Ассистент]: Модифицированная функция: теперь принимает token_count и is_summary
 async def add_message_to_history(user_id: int, character_name: str, role: str, content: str, token_count: int, is_summary: bool = False) -> None:
     """
     Добавляет сообщение в историю чата с подсчитанным количеством токенов.
+    Запись идет через очередь группового коммита: функция не ждет сохранения,
+    для чтения своей записи используйте flush_pending_writes().
     :param user_id: ID пользователя.
     :param character_name: Имя персонажа.
     :param role: Роль ('user' или 'model').
@@ -352,51 +890,123 @@ async def add_message_to_history(user_id: int, character_name: str, role: str, c
     :param token_count: Количество токенов в сообщении.
     :param is_summary: Флаг, указывающий, является ли сообщение резюме.
     """
-    query = "INSERT INTO chat_history (user_id, character_name, role, content, token_count, is_summary) VALUES (?, ?, ?, ?, ?, ?)"
-    await db_request(query, (user_id, character_name, role, content, token_count, is_summary))
+    dialog_id = await _get_dialog_id(user_id, character_name, create=True)
+    if dialog_id is None:
+        logger.error(f"Не удалось получить диалог для user_id={user_id}, char='{character_name}'. Сообщение не сохранено.")
+        return
+    query = "INSERT INTO chat_history (dialog_id, role, content, token_count, is_summary) VALUES (?, ?, ?, ?, ?)"
+    enqueue_write(query, (dialog_id, role, content, token_count, is_summary))
 
 # [Dev-Ассистент]: НОВАЯ ФУНКЦИЯ: Получает историю для формирования контекста LLM (резюме + активный буфер)
-async def get_history_for_context(user_id: int, character_name: str, active_buffer_count: int) -> List[Dict]:
+async def get_history_for_context(user_id: int, character_name: str, active_buffer_count: int, block_size: int = 1) -> List[Dict]:
     """
     Извлекает историю чата для формирования контекста LLM:
     - Последнее глобальное резюме (если есть)
     - Последние N оригинальных сообщений (активный буфер)
+    Оба куска берутся ОДНИМ запросом (UNION ALL): резюме - по dialogs.summary_id,
+    буфер - по индексу idx_chat_history_dialog.
+
+    При block_size > 1 начало буфера сдвигается не на каждое сообщение, а блоками по block_size:
+    буфер растет от N до N + block_size - 1 сообщений, и все это время начало контекста
+    (системный промпт, резюме, старые сообщения буфера) не меняется - его кэширует провайдер.
     
     :param user_id: ID пользователя.
     :param character_name: Имя персонажа.
     :param active_buffer_count: Количество сообщений в активном буфере.
+    :param block_size: Шаг сдвига начала буфера (1 - обычное скользящее окно).
     :return: Список сообщений в формате для LLM (роль, контент).
     """
-    messages = []
+    dialog_id = await _get_dialog_id(user_id, character_name)
+    if dialog_id is None:
+        return []
+    await flush_pending_writes()
 
-    # 1. Получаем последнее глобальное резюме
-    summary_query = """
-        SELECT role, content FROM chat_history
-        WHERE user_id = ? AND character_name = ? AND is_summary = 1
-        ORDER BY id DESC LIMIT 1
-    """
-    latest_summary = await db_request(summary_query, (user_id, character_name), fetch_one=True)
-    if latest_summary:
-        messages.append({"role": latest_summary['role'], "parts": [latest_summary['content']]})
-        logger.debug(f"Получено последнее резюме для user_id={user_id}, char='{character_name}'.")
+    if block_size > 1:
+        # [Dev-Ассистент]: Размер буфера = все сообщения после границы блока, на которую приходится N-е с конца.
+        # [Dev-Ассистент]: COUNT идет по тому же индексу (dialog_id, is_summary, id), что и выборка буфера.
+        buffer_limit_sql = """(
+                    SELECT CASE WHEN total <= ? THEN total ELSE total - (total - ?) / ? * ? END
+                    FROM (SELECT COUNT(*) AS total FROM chat_history WHERE dialog_id = ? AND is_summary = 0)
+                )"""
+        buffer_limit_params = (active_buffer_count, active_buffer_count, block_size, block_size, dialog_id)
+    else:
+        buffer_limit_sql = "?"
+        buffer_limit_params = (active_buffer_count,)
 
-    # 2. Получаем сообщения для активного буфера
-    # Здесь мы выбираем active_buffer_count *последних* сообщений, которые НЕ ЯВЛЯЮТСЯ резюме
-    active_buffer_query = """
-        SELECT role, content FROM chat_history
-        WHERE user_id = ? AND character_name = ? AND is_summary = 0
-        ORDER BY id DESC LIMIT ?
+    # [Dev-Ассистент]: Резюме - поиск по rowid через dialogs.summary_id, буфер - range scan по (dialog_id, is_summary, id)
+    # [Dev-Ассистент]: с LIMIT. Внешняя сортировка ставит резюме первым, а буфер - в хронологическом порядке (старые первыми).
+    context_query = f"""
+        SELECT role, content, is_summary FROM (
+            SELECT id, role, content, is_summary FROM chat_history
+            WHERE id = (SELECT summary_id FROM dialogs WHERE id = ?)
+            UNION ALL
+            SELECT * FROM (
+                SELECT id, role, content, is_summary FROM chat_history
+                WHERE dialog_id = ? AND is_summary = 0
+                ORDER BY id DESC LIMIT {buffer_limit_sql}
+            )
+        )
+        ORDER BY is_summary DESC, id ASC
     """
-    active_buffer_messages = await db_request(active_buffer_query, (user_id, character_name, active_buffer_count), fetch_all=True)
-    
-    # Сообщения из активного буфера должны быть в хронологическом порядке (старые первыми)
-    if active_buffer_messages:
-        # [Dev-Ассистент]: Преобразуем формат, так как AI клиенты ожидают список словарей с 'parts'
-        messages.extend([{"role": msg['role'], "parts": [msg['content']]} for msg in reversed(active_buffer_messages)])
-        logger.debug(f"Получен активный буфер ({len(active_buffer_messages)} сообщений) для user_id={user_id}, char='{character_name}'.")
+    rows = await db_request(context_query, (dialog_id, dialog_id) + buffer_limit_params, fetch_all=True)
+    if not rows:
+        return []
 
+    # [Dev-Ассистент]: Преобразуем формат, так как AI клиенты ожидают список словарей с 'parts'
+    messages = [{"role": row['role'], "parts": [row['content']]} for row in rows]
+    has_summary = bool(rows[0]['is_summary'])
+    logger.debug(
+        f"Получен контекст для user_id={user_id}, char='{character_name}': "
+        f"резюме={'да' if has_summary else 'нет'}, активный буфер={len(rows) - int(has_summary)} сообщений."
+    )
     return messages
 
+# [Dev-Ассистент]: Любое изменение цепочки увеличивает dialogs.response_chain_generation (см. save_dialog_response_chain).
+_RESET_RESPONSE_CHAIN_QUERY = (
+    "UPDATE dialogs SET last_response_id = NULL, last_response_model = NULL, "
+    "response_chain_generation = response_chain_generation + 1 WHERE id = ?"
+)
+
+async def get_dialog_response_chain(user_id: int, character_name: str) -> Tuple[Optional[str], Optional[str], int]:
+    """
+    Возвращает последний ответ OpenAI Responses API в диалоге: (last_response_id, last_response_model, поколение).
+    (None, None, ...) - цепочки нет, модели нужна полная история. Поколение передается в save_dialog_response_chain.
+    """
+    dialog_id = await _get_dialog_id(user_id, character_name)
+    if dialog_id is None:
+        return None, None, 0
+    await flush_pending_writes()
+    row = await db_request(
+        "SELECT last_response_id, last_response_model, response_chain_generation FROM dialogs WHERE id = ?",
+        (dialog_id,), fetch_one=True
+    )
+    if not row:
+        return None, None, 0
+    return row['last_response_id'], row['last_response_model'], row['response_chain_generation']
+
+async def save_dialog_response_chain(user_id: int, character_name: str, response_id: Optional[str], model: Optional[str], generation: Optional[int]) -> None:
+    """
+    Запоминает ответ, которым закончился ход диалога (None - ход прошел без цепочки, и она больше не
+    соответствует истории). Запись идет через очередь группового коммита вместе с сообщениями хода.
+
+    :param generation: Поколение цепочки из get_dialog_response_chain в начале хода. Если за время хода цепочку
+                       сбросили (суммаризация, /reset) или записал другой ход, ответ не сохраняется, а цепочка
+                       сбрасывается: иначе следующий ход продолжил бы историю, которую уже заменили.
+    """
+    dialog_id = await _get_dialog_id(user_id, character_name, create=True)
+    if dialog_id is None:
+        return
+    enqueue_write(
+        """
+        UPDATE dialogs SET
+            last_response_id = CASE WHEN response_chain_generation IS ? THEN ? END,
+            last_response_model = CASE WHEN response_chain_generation IS ? THEN ? END,
+            response_chain_generation = response_chain_generation + 1
+        WHERE id = ?
+        """,
+        (generation, response_id, generation, model, dialog_id)
+    )
+
 # [Dev-Ассистент]: НОВАЯ ФУНКЦИЯ: Получает сообщения для суммаризации
 async def get_messages_for_summarization(user_id: int, character_name: str, active_buffer_count: int) -> List[Dict]:
     """
@@ -409,26 +1019,19 @@ async def get_messages_for_summarization(user_id: int, character_name: str, acti
     :param active_buffer_count: Количество сообщений в активном буфере.
     :return: Список словарей с ключами 'id', 'role', 'content' для суммаризации.
     """
-    # Определяем ID N последних несжатых сообщений (активный буфер)
-    latest_non_summary_ids_query = """
-        SELECT id FROM chat_history
-        WHERE user_id = ? AND character_name = ? AND is_summary = 0
-        ORDER BY id DESC LIMIT ?
-    """
-    latest_non_summary_ids_rows = await db_request(latest_non_summary_ids_query, (user_id, character_name, active_buffer_count), fetch_all=True)
-    latest_non_summary_ids = [row['id'] for row in latest_non_summary_ids_rows]
-
-    # Извлекаем все остальные несжатые сообщения (те, что нужно суммировать)
-    summarizable_messages_query = f"""
+    dialog_id = await _get_dialog_id(user_id, character_name)
+    if dialog_id is None:
+        return []
+    await flush_pending_writes()
+    # [Dev-Ассистент]: Пропускаем N последних несжатых сообщений (активный буфер) через OFFSET
+    # [Dev-Ассистент]: вместо списка их ID в NOT IN (...). Идем по индексу от новых к старым, потом разворачиваем.
+    summarizable_messages_query = """
         SELECT id, role, content FROM chat_history
-        WHERE user_id = ? AND character_name = ? AND is_summary = 0
-        {'AND id NOT IN ({})'.format(','.join(map(str, latest_non_summary_ids))) if latest_non_summary_ids else ''}
-        ORDER BY id ASC
+        WHERE dialog_id = ? AND is_summary = 0
+        ORDER BY id DESC LIMIT -1 OFFSET ?
     """
-    # [Dev-Ассистент]: Важно: если нет ID для исключения, не добавлять подзапрос с IN ()
-    params = (user_id, character_name)
-    
-    messages_to_summarize = await db_request(summarizable_messages_query, params, fetch_all=True)
+    rows = await db_request(summarizable_messages_query, (dialog_id, active_buffer_count), fetch_all=True)
+    messages_to_summarize = list(reversed(rows)) if rows else []
     
     if messages_to_summarize:
         logger.debug(f"Получено {len(messages_to_summarize)} сообщений для суммаризации для user_id={user_id}, char='{character_name}'.")
@@ -448,26 +1051,28 @@ async def get_total_tokens_in_summarizable_history(user_id: int, character_name:
     :param active_buffer_count: Количество сообщений в активном буфере.
     :return: Общее количество токенов.
     """
-    # Определяем ID N последних несжатых сообщений (активный буфер)
-    latest_non_summary_ids_query = """
-        SELECT id FROM chat_history
-        WHERE user_id = ? AND character_name = ? AND is_summary = 0
-        ORDER BY id DESC LIMIT ?
-    """
-    latest_non_summary_ids_rows = await db_request(latest_non_summary_ids_query, (user_id, character_name, active_buffer_count), fetch_all=True)
-    latest_non_summary_ids = [row['id'] for row in latest_non_summary_ids_rows]
-
-    # Суммируем токены всех остальных несжатых сообщений
-    total_tokens_query = f"""
-        SELECT SUM(token_count) AS total_tokens FROM chat_history
-        WHERE user_id = ? AND character_name = ? AND is_summary = 0
-        {'AND id NOT IN ({})'.format(','.join(map(str, latest_non_summary_ids))) if latest_non_summary_ids else ''}
+    dialog_id = await _get_dialog_id(user_id, character_name)
+    if dialog_id is None:
+        return 0
+    await flush_pending_writes()
+    # [Dev-Ассистент]: Больше не суммируем всю историю диалога: берем готовый счетчик dialogs.token_total
+    # [Dev-Ассистент]: и вычитаем токены активного буфера (не больше active_buffer_count строк по индексу).
+    total_tokens_query = """
+        SELECT
+            COALESCE((SELECT token_total FROM dialogs WHERE id = ?), 0)
+            - COALESCE((
+                SELECT SUM(token_count) FROM (
+                    SELECT token_count FROM chat_history
+                    WHERE dialog_id = ? AND is_summary = 0
+                    ORDER BY id DESC LIMIT ?
+                )
+            ), 0) AS total_tokens
     """
-    params = (user_id, character_name)
+    params = (dialog_id, dialog_id, active_buffer_count)
 
     result = await db_request(total_tokens_query, params, fetch_one=True)
-    total_tokens = result['total_tokens'] if result and result['total_tokens'] is not None else 0
-    
+    total_tokens = max(0, result['total_tokens']) if result and result['total_tokens'] is not None else 0
+
     logger.debug(f"Сумма токенов для суммаризации для user_id={user_id}, char='{character_name}': {total_tokens}.")
     return total_tokens
 
@@ -484,6 +1089,7 @@ async def save_summary_and_clean_old_messages(
     1. Удаляет все сообщения с указанными ID.
     2. Удаляет предыдущее глобальное резюме для данного диалога.
     3. Вставляет новое сообщение-резюме.
+    dialogs.token_total и dialogs.summary_id обновляются триггерами в этой же транзакции.
     
     :param user_id: ID пользователя.
     :param character_name: Имя персонажа.
@@ -492,40 +1098,46 @@ async def save_summary_and_clean_old_messages(
     :param old_messages_to_delete_ids: Список ID оригинальных сообщений, которые нужно удалить.
     """
     try:
-        async with aiosqlite.connect(DB_FILE, timeout=10) as con:
-            await con.execute("PRAGMA foreign_keys = ON")
-            
+        dialog_id = await _get_dialog_id(user_id, character_name, create=True)
+        if dialog_id is None:
+            logger.error(f"Не удалось получить диалог для user_id={user_id}, char='{character_name}'. Резюме не сохранено.")
+            return
+        await flush_pending_writes()
+        pool = await _get_pool()
+        async with pool.transaction() as con:
             # 1. Удаляем сообщения, которые только что были суммированы
             if old_messages_to_delete_ids:
                 placeholders = ','.join('?' * len(old_messages_to_delete_ids))
                 delete_old_query = f"""
-                    DELETE FROM chat_history WHERE user_id = ? AND character_name = ? AND id IN ({placeholders})
+                    DELETE FROM chat_history WHERE dialog_id = ? AND id IN ({placeholders})
                 """
-                await con.execute(delete_old_query, (user_id, character_name, *old_messages_to_delete_ids))
+                await con.execute(delete_old_query, (dialog_id, *old_messages_to_delete_ids))
                 logger.debug(f"Удалено {len(old_messages_to_delete_ids)} старых сообщений для user_id={user_id}, char='{character_name}'.")
 
             # 2. Удаляем предыдущее глобальное резюме (если оно было)
             delete_prev_summary_query = """
                 DELETE FROM chat_history
-                WHERE user_id = ? AND character_name = ? AND is_summary = 1
+                WHERE dialog_id = ? AND is_summary = 1
             """
-            await con.execute(delete_prev_summary_query, (user_id, character_name))
+            await con.execute(delete_prev_summary_query, (dialog_id,))
             logger.debug(f"Удалено предыдущее резюме для user_id={user_id}, char='{character_name}'.")
 
             # 3. Вставляем новое резюме
             insert_summary_query = """
-                INSERT INTO chat_history (user_id, character_name, role, content, token_count, is_summary)
-                VALUES (?, ?, ?, ?, ?, ?)
+                INSERT INTO chat_history (dialog_id, role, content, token_count, is_summary)
+                VALUES (?, ?, ?, ?, ?)
             """
-            await con.execute(insert_summary_query, (user_id, character_name, 'model', summary_text, summary_token_count, True))
+            await con.execute(insert_summary_query, (dialog_id, 'model', summary_text, summary_token_count, True))
+
+            # 4. Сбрасываем цепочку Responses API: она помнит несжатую историю, а не новое резюме
+            await con.execute(_RESET_RESPONSE_CHAIN_QUERY, (dialog_id,))
             logger.info(f"Сохранено новое резюме ({summary_token_count} токенов) для user_id={user_id}, char='{character_name}'.")
 
-            await con.commit()
-            logger.info(f"Атомарная операция суммаризации для user_id={user_id}, char='{character_name}' успешно завершена.")
+        logger.info(f"Атомарная операция суммаризации для user_id={user_id}, char='{character_name}' успешно завершена.")
 
     except aiosqlite.Error as e:
         logger.error(f"Ошибка при атомарной операции сохранения резюме и очистки: {e}", exc_info=True)
-        # Rollback будет выполнен автоматически aiosqlite.connect как контекстным менеджером
+        # Rollback будет выполнен автоматически в pool.transaction()
 
 # [Dev-Ассистент]: get_chat_history, trim_chat_history, get_history_length, set_current_character
 # [Dev-Ассистент]: Эти функции больше не нужны для формирования контекста LLM, но остаются для других целей.
@@ -544,24 +1156,36 @@ async def update_character(character_id: int, new_name: str, new_prompt: str) ->
 async def delete_character(character_id: int) -> None:
     await db_request("DELETE FROM characters WHERE id = ?", (character_id,))
 async def set_current_character(user_id: int, character_name: str) -> None:
-    await db_request("UPDATE users SET current_character_name = ? WHERE id = ?", (character_name, user_id))
+    await _update_user_row("UPDATE users SET current_character_name = ? WHERE id = ?", (character_name, user_id), user_id=user_id)
 async def get_character_by_id(character_id: int) -> Optional[Dict]:
     return await db_request("SELECT id, name, prompt FROM characters WHERE id = ?", (character_id,), fetch_one=True)
 # [Dev-Ассистент]: Эта функция теперь используется для отображения истории в интерфейсе, а не для LLM-контекста.
 async def get_chat_history(user_id: int, character_name: str, limit: int = 30) -> List[Dict]:
-    query = "SELECT role, content FROM chat_history WHERE user_id = ? AND character_name = ? ORDER BY id DESC LIMIT ?"
-    rows = await db_request(query, (user_id, character_name, limit), fetch_all=True)
+    dialog_id = await _get_dialog_id(user_id, character_name)
+    if dialog_id is None: return []
+    await flush_pending_writes()
+    query = "SELECT role, content FROM chat_history WHERE dialog_id = ? ORDER BY id DESC LIMIT ?"
+    rows = await db_request(query, (dialog_id, limit), fetch_all=True)
     if not rows: return []
     # [Dev-Ассистент]: Возвращаем в универсальном формате, который ожидает LLM-клиент
     return [{"role": row['role'], "parts": [row['content']]} for row in reversed(rows)]
 async def clear_chat_history(user_id: int, character_name: str) -> None:
     # [Dev-Ассистент]: Эта функция теперь будет удалять все записи (и обычные, и резюме)
-    query = "DELETE FROM chat_history WHERE user_id = ? AND character_name = ?"
-    await db_request(query, (user_id, character_name))
+    # [Dev-Ассистент]: Сначала дописываем очередь, иначе отложенные INSERT лягут уже после очистки.
+    dialog_id = await _get_dialog_id(user_id, character_name)
+    if dialog_id is None: return
+    await flush_pending_writes()
+    query = "DELETE FROM chat_history WHERE dialog_id = ?"
+    await db_request(query, (dialog_id,))
+    # [Dev-Ассистент]: После /reset следующий ответ не должен продолжать старую цепочку Responses API.
+    await db_request(_RESET_RESPONSE_CHAIN_QUERY, (dialog_id,))
 # [Dev-Ассистент]: Эта функция теперь для общих целей, не для контекста LLM.
 async def get_history_length(user_id: int, character_name: str) -> int:
-    query = "SELECT COUNT(id) FROM chat_history WHERE user_id = ? AND character_name = ?"
-    result = await db_request(query, (user_id, character_name), fetch_one=True)
+    dialog_id = await _get_dialog_id(user_id, character_name)
+    if dialog_id is None: return 0
+    await flush_pending_writes()
+    query = "SELECT COUNT(id) FROM chat_history WHERE dialog_id = ?"
+    result = await db_request(query, (dialog_id,), fetch_one=True)
     return result['COUNT(id)'] if result else 0
 # [Dev-Ассистент]: trim_chat_history больше не актуальна в контексте новой логики суммаризации
 # async def trim_chat_history(user_id: int, character_name: str, keep_last_n: int) -> None:
@@ -569,15 +1193,20 @@ async def get_history_length(user_id: int, character_name: str) -> int:
 #     await db_request(query, (user_id, character_name, user_id, character_name, keep_last_n))
 
 async def get_user_by_telegram_id(telegram_id: int) -> Optional[Dict]:
-    return await db_request("SELECT * FROM users WHERE telegram_id = ?", (telegram_id,), fetch_one=True)
+    cached = _user_cache.get_by_telegram_id(telegram_id)
+    if cached is not None:
+        return cached
+    row = await db_request("SELECT * FROM users WHERE telegram_id = ?", (telegram_id,), fetch_one=True)
+    _user_cache.put(row)
+    return row
 
 async def verify_user(telegram_id: int) -> None:
-    await db_request("UPDATE users SET is_verified = 1 WHERE telegram_id = ?", (telegram_id,))
+    await _update_user_row("UPDATE users SET is_verified = 1 WHERE telegram_id = ?", (telegram_id,), telegram_id=telegram_id)
 
 async def set_user_output_format(user_id: int, output_format: str) -> None:
     """Устанавливает предпочтительный формат вывода для пользователя."""
     query = "UPDATE users SET output_format = ? WHERE id = ?"
-    await db_request(query, (output_format, user_id))
+    await _update_user_row(query, (output_format, user_id), user_id=user_id)
     logger.info(f"Для пользователя user_id={user_id} установлен формат вывода '{output_format}'.")
 
 async def set_user_default_image_resolution(user_id: int, provider_type: str, resolution: str) -> None:
@@ -597,8 +1226,13 @@ async def set_user_default_image_resolution(user_id: int, provider_type: str, re
         return
 
     query = f"UPDATE users SET {column_name} = ? WHERE id = ?"
-    await db_request(query, (resolution, user_id))
+    await _update_user_row(query, (resolution, user_id), user_id=user_id)
     logger.info(f"Для user_id={user_id} установлено дефолтное разрешение {resolution} для {provider_type}.")
 
-# Вызов _init_db() остается здесь
-_init_db()
\ No newline at end of file
+async def set_user_ai_provider(user_id: int, provider_name: Optional[str]) -> None:
+    """Устанавливает (или сбрасывает на NULL) выбранного AI-провайдера по ID пользователя в БД."""
+    await _update_user_row("UPDATE users SET current_ai_provider = ? WHERE id = ?", (provider_name, user_id), user_id=user_id)
+
+async def set_user_ai_provider_by_telegram_id(telegram_id: int, provider_name: Optional[str]) -> None:
+    """Устанавливает (или сбрасывает на NULL) выбранного AI-провайдера по Telegram ID."""
+    await _update_user_row("UPDATE users SET current_ai_provider = ? WHERE telegram_id = ?", (provider_name, telegram_id), telegram_id=telegram_id)
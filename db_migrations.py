@@ -0,0 +1,398 @@
+# db_migrations.py
+# [Dev-Ассистент]: Версионированные миграции схемы SQLite (PRAGMA user_version) и фоновые дозаполнения данных.
+#
+# Правила:
+# - MIGRATIONS выполняются по порядку; шаг N переводит базу с user_version = N-1 на N.
+#   Запускает их database.init_db_pool(), каждый шаг - в своей транзакции вместе с записью user_version.
+# - Шаги идемпотентны (IF NOT EXISTS, проверка столбцов): старые базы с user_version = 0 уже содержат часть схемы.
+# - Уже выпущенные шаги не меняем: новое изменение схемы = новая функция в конце MIGRATIONS.
+# - Долгие дозаполнения данных не делаем в шаге миграции - для них есть BACKFILLS (маленькие пачки в фоне).
+
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+import aiosqlite
+import tiktoken
+
+logger = logging.getLogger(__name__)
+
+
+async def _table_columns(con: aiosqlite.Connection, table: str) -> List[str]:
+    async with con.execute(f"SELECT name FROM pragma_table_info('{table}')") as cursor:
+        return [row[0] for row in await cursor.fetchall()]
+
+async def _add_missing_columns(con: aiosqlite.Connection, table: str, columns: Dict[str, str]) -> None:
+    """Добавляет в таблицу столбцы, которых в ней еще нет (для баз, созданных старыми версиями бота)."""
+    existing = await _table_columns(con, table)
+    for name, definition in columns.items():
+        if name not in existing:
+            await con.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+            logger.info(f"Миграция: в таблицу {table} добавлен столбец {name}.")
+
+
+# --- Шаг 1: пользователи, транзакции, персонажи ---
+
+async def _001_base_schema(con: aiosqlite.Connection) -> None:
+    await con.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY,
+            telegram_id INTEGER UNIQUE NOT NULL,
+            full_name TEXT,
+            username TEXT,
+            current_character_name TEXT DEFAULT 'Базовый AI',
+            current_ai_provider TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            daily_requests_count INTEGER DEFAULT 0,
+            last_request_date TEXT,
+            subscription_tier TEXT DEFAULT 'free' NOT NULL,
+            is_verified BOOLEAN NOT NULL DEFAULT 0,
+            subscription_expiry_date DATETIME,
+            output_format TEXT DEFAULT 'text' NOT NULL,
+            balance INTEGER DEFAULT 0 NOT NULL,
+            referred_by_user_id INTEGER DEFAULT NULL,
+            default_dalle3_resolution TEXT DEFAULT NULL,
+            default_yandexart_resolution TEXT DEFAULT NULL,
+            FOREIGN KEY (referred_by_user_id) REFERENCES users (id) ON DELETE SET NULL
+        )
+    """)
+    # [Dev-Ассистент]: Столбцы, которые появлялись в users по ходу развития бота.
+    await _add_missing_columns(con, "users", {
+        "current_ai_provider": "TEXT",
+        "daily_requests_count": "INTEGER DEFAULT 0",
+        "last_request_date": "TEXT",
+        "subscription_tier": "TEXT DEFAULT 'free' NOT NULL",
+        "is_verified": "BOOLEAN NOT NULL DEFAULT 0",
+        "subscription_expiry_date": "DATETIME",
+        "output_format": "TEXT DEFAULT 'text' NOT NULL",
+        "balance": "INTEGER DEFAULT 0 NOT NULL",
+        "referred_by_user_id": "INTEGER DEFAULT NULL REFERENCES users (id) ON DELETE SET NULL",
+        "default_dalle3_resolution": "TEXT DEFAULT NULL",
+        "default_yandexart_resolution": "TEXT DEFAULT NULL",
+    })
+    # [Dev-Ассистент]: Индекс для быстрого поиска рефералов
+    await con.execute("CREATE INDEX IF NOT EXISTS idx_users_referred_by ON users (referred_by_user_id)")
+
+    await con.execute("""
+        CREATE TABLE IF NOT EXISTS transactions (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            amount INTEGER NOT NULL,
+            type TEXT NOT NULL,
+            description TEXT,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            external_id TEXT,
+            balance_before INTEGER,
+            balance_after INTEGER,
+            FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+        )
+    """)
+    await _add_missing_columns(con, "transactions", {
+        "external_id": "TEXT",
+        "balance_before": "INTEGER",
+        "balance_after": "INTEGER",
+    })
+    await con.execute("CREATE INDEX IF NOT EXISTS idx_transactions_user_id ON transactions (user_id)")
+
+    await con.execute("""
+        CREATE TABLE IF NOT EXISTS characters (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            prompt TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE,
+            UNIQUE (user_id, name)
+        )
+    """)
+
+
+# --- Шаг 2: диалоги и история чата на целочисленном dialog_id ---
+
+_CHAT_HISTORY_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS chat_history (
+        id INTEGER PRIMARY KEY,
+        dialog_id INTEGER NOT NULL,
+        role TEXT NOT NULL CHECK(role IN ('user', 'model')),
+        content TEXT NOT NULL,
+        token_count INTEGER NOT NULL DEFAULT 0,
+        is_summary BOOLEAN NOT NULL DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (dialog_id) REFERENCES dialogs (id) ON DELETE CASCADE
+    )
+"""
+
+async def _create_chat_history_triggers(con: aiosqlite.Connection) -> None:
+    """
+    Триггеры держат dialogs.token_total и dialogs.summary_id в согласии с chat_history.
+    Они срабатывают в той же транзакции, что и изменение истории (в т.ч. в групповом коммите).
+    """
+    await con.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_chat_history_insert
+        AFTER INSERT ON chat_history
+        BEGIN
+            UPDATE dialogs SET
+                token_total = token_total + CASE WHEN NEW.is_summary = 0 THEN NEW.token_count ELSE 0 END,
+                summary_id = CASE WHEN NEW.is_summary = 1 THEN NEW.id ELSE summary_id END
+            WHERE id = NEW.dialog_id;
+        END
+    """)
+    await con.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_chat_history_delete
+        AFTER DELETE ON chat_history
+        BEGIN
+            UPDATE dialogs SET
+                token_total = token_total - CASE WHEN OLD.is_summary = 0 THEN OLD.token_count ELSE 0 END,
+                summary_id = CASE WHEN summary_id = OLD.id THEN NULL ELSE summary_id END
+            WHERE id = OLD.dialog_id;
+        END
+    """)
+    await con.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_chat_history_update_tokens
+        AFTER UPDATE OF token_count, is_summary ON chat_history
+        BEGIN
+            UPDATE dialogs SET
+                token_total = token_total
+                    - CASE WHEN OLD.is_summary = 0 THEN OLD.token_count ELSE 0 END
+                    + CASE WHEN NEW.is_summary = 0 THEN NEW.token_count ELSE 0 END
+            WHERE id = NEW.dialog_id;
+        END
+    """)
+
+# [Dev-Ассистент]: Старая chat_history (user_id + character_name в каждой строке) на время переноса.
+LEGACY_CHAT_HISTORY = "chat_history_legacy"
+
+async def table_exists(con: aiosqlite.Connection, table: str) -> bool:
+    async with con.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)) as cursor:
+        return await cursor.fetchone() is not None
+
+async def _detach_legacy_chat_history(con: aiosqlite.Connection) -> None:
+    """
+    Откладывает старую chat_history под именем LEGACY_CHAT_HISTORY. Строки не копируются: их по диалогам
+    переносит фоновое дозаполнение (BACKFILLS), а диалог, к которому обратились раньше, - move_legacy_dialog.
+    """
+    logger.info(f"Миграция: старая chat_history переименована в {LEGACY_CHAT_HISTORY}, история будет перенесена в фоне.")
+    # [Dev-Ассистент]: Совсем старые базы создавались без token_count/is_summary (ADD COLUMN не переписывает таблицу).
+    await _add_missing_columns(con, "chat_history", {
+        "token_count": "INTEGER NOT NULL DEFAULT 0",
+        "is_summary": "BOOLEAN NOT NULL DEFAULT 0",
+    })
+    # [Dev-Ассистент]: Триггеры старого счетчика chat_history_stats переехали бы вместе с таблицей.
+    async with con.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' AND tbl_name = 'chat_history'") as cursor:
+        triggers = [row[0] for row in await cursor.fetchall()]
+    for trigger in triggers:
+        await con.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+    await con.execute("DROP TABLE IF EXISTS chat_history_stats")
+    # [Dev-Ассистент]: Индекс (user_id, character_name) остается у отложенной таблицы - по нему ищется история диалога.
+    await con.execute(f"ALTER TABLE chat_history RENAME TO {LEGACY_CHAT_HISTORY}")
+
+def _count_missing_tokens(rows: List[Tuple]) -> List[Tuple]:
+    # [Dev-Ассистент]: Как в дозаполнении chat_history_token_count: перенесенные строки получают новые id и в него не попадут.
+    encoding = tiktoken.get_encoding("cl100k_base")
+    return [
+        (role, content, len(encoding.encode(content)) if token_count == 0 and not is_summary else token_count, is_summary, created_at)
+        for role, content, token_count, is_summary, created_at in rows
+    ]
+
+async def move_legacy_dialog(con: aiosqlite.Connection, user_id: int, character_name: str) -> int:
+    """
+    Переносит историю одного диалога из LEGACY_CHAT_HISTORY в chat_history (con - писатель в транзакции).
+    Диалог переносится целиком и до того, как в него пишет бот, поэтому новые id сохраняют порядок сообщений.
+    Счетчики dialogs обновляют триггеры chat_history, пропущенные token_count досчитываются здесь же.
+    :return: Количество перенесенных сообщений (0, если в старой таблице их нет).
+    """
+    async with con.execute(
+        f"SELECT role, content, token_count, is_summary, created_at FROM {LEGACY_CHAT_HISTORY} "
+        "WHERE user_id = ? AND character_name = ? ORDER BY id",
+        (user_id, character_name)
+    ) as cursor:
+        rows = [tuple(row) for row in await cursor.fetchall()]
+    if not rows:
+        return 0
+    rows = await asyncio.to_thread(_count_missing_tokens, rows)
+    async with con.execute(
+        "INSERT INTO dialogs (user_id, character_name) VALUES (?, ?) "
+        "ON CONFLICT (user_id, character_name) DO UPDATE SET user_id = excluded.user_id RETURNING id",
+        (user_id, character_name)
+    ) as cursor:
+        dialog_id = (await cursor.fetchone())[0]
+    await con.executemany(
+        "INSERT INTO chat_history (dialog_id, role, content, token_count, is_summary, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+        [(dialog_id, *row) for row in rows]
+    )
+    await con.execute(f"DELETE FROM {LEGACY_CHAT_HISTORY} WHERE user_id = ? AND character_name = ?", (user_id, character_name))
+    return len(rows)
+
+async def _002_dialogs(con: aiosqlite.Connection) -> None:
+    # [Dev-Ассистент]: Диалог = пара (пользователь, персонаж). История ссылается на него целым dialog_id,
+    # [Dev-Ассистент]: а не повторяет в каждой строке user_id и длинное имя персонажа.
+    await con.execute("""
+        CREATE TABLE IF NOT EXISTS dialogs (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            character_name TEXT NOT NULL,
+            summary_id INTEGER DEFAULT NULL,            -- [Dev-Ассистент]: id текущего резюме в chat_history
+            token_total INTEGER NOT NULL DEFAULT 0,     -- [Dev-Ассистент]: токены в несжатых сообщениях
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE,
+            UNIQUE (user_id, character_name)
+        )
+    """)
+    if 'character_name' in await _table_columns(con, "chat_history"):
+        await _detach_legacy_chat_history(con)
+
+    await con.execute(_CHAT_HISTORY_SCHEMA)
+    await con.execute("CREATE INDEX IF NOT EXISTS idx_chat_history_dialog ON chat_history (dialog_id, is_summary, id)")
+    await _create_chat_history_triggers(con)
+
+
+# --- Шаг 3: учет фоновых дозаполнений ---
+
+async def _003_backfill_progress(con: aiosqlite.Connection) -> None:
+    await con.execute("""
+        CREATE TABLE IF NOT EXISTS schema_backfills (
+            name TEXT PRIMARY KEY,
+            last_id INTEGER NOT NULL DEFAULT 0,
+            completed_at TIMESTAMP DEFAULT NULL
+        )
+    """)
+
+
+# --- Шаг 4: ключ идемпотентности для транзакций ---
+
+async def _004_transactions_external_id_unique(con: aiosqlite.Connection) -> None:
+    # [Dev-Ассистент]: Повтор операции с тем же external_id (ретрай платежа, повторный колбэк) не должен
+    # [Dev-Ассистент]: второй раз менять баланс. Частичный индекс - записи без external_id не ограничены.
+    await con.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_transactions_external_id
+        ON transactions (external_id) WHERE external_id IS NOT NULL
+    """)
+
+
+
+# --- Шаг 5: цепочка ответов OpenAI Responses API в диалоге ---
+
+async def _005_dialog_response_chain(con: aiosqlite.Connection) -> None:
+    # [Dev-Ассистент]: id последнего сохраненного у OpenAI ответа и модель, которая его дала (ai_clients.gpt_client.ResponseChain).
+    await _add_missing_columns(con, "dialogs", {
+        "last_response_id": "TEXT DEFAULT NULL",
+        "last_response_model": "TEXT DEFAULT NULL",
+    })
+
+
+
+# --- Шаг 6: задания генерации изображений ---
+
+async def _006_image_jobs(con: aiosqlite.Connection) -> None:
+    # [Dev-Ассистент]: Оплаченная генерация живет в БД, пока картинка не доставлена или деньги не возвращены:
+    # [Dev-Ассистент]: после перезапуска image_jobs.resume_image_jobs продолжает или возвращает такие задания.
+    await con.execute("""
+        CREATE TABLE IF NOT EXISTS image_jobs (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            provider TEXT NOT NULL,                     -- [Dev-Ассистент]: IMAGE_GEN_DALL_E_3 / IMAGE_GEN_YANDEXART
+            prompt TEXT NOT NULL,
+            resolution TEXT NOT NULL,
+            cost INTEGER NOT NULL,                      -- [Dev-Ассистент]: Списано AGMcoin (столько же возвращается)
+            status TEXT NOT NULL DEFAULT 'queued',      -- [Dev-Ассистент]: constants.IMAGE_JOB_*
+            attempts INTEGER NOT NULL DEFAULT 0,
+            error TEXT DEFAULT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+        )
+    """)
+    # [Dev-Ассистент]: Частичный индекс: при запуске ищутся только незавершенные задания, завершенных - большинство.
+    await con.execute("""
+        CREATE INDEX IF NOT EXISTS idx_image_jobs_unfinished
+        ON image_jobs (status, id) WHERE status IN ('queued', 'running', 'failed')
+    """)
+
+
+# --- Шаг 7: поколение цепочки ответов ---
+
+async def _007_dialog_response_chain_generation(con: aiosqlite.Connection) -> None:
+    # [Dev-Ассистент]: Растет при каждой записи и сбросе цепочки. Ход сохраняет свой ответ, только если поколение
+    # [Dev-Ассистент]: не изменилось с начала хода (database.save_dialog_response_chain).
+    await _add_missing_columns(con, "dialogs", {
+        "response_chain_generation": "INTEGER NOT NULL DEFAULT 0",
+    })
+
+
+MIGRATIONS: List[Callable[[aiosqlite.Connection], Awaitable[None]]] = [
+    _001_base_schema,
+    _002_dialogs,
+    _003_backfill_progress,
+    _004_transactions_external_id_unique,
+    _005_dialog_response_chain,
+    _006_image_jobs,
+    _007_dialog_response_chain_generation,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+# --- Фоновые дозаполнения ---
+
+class Backfill(NamedTuple):
+    """
+    Дозаполнение данных пачками по возрастанию id.
+    fetch_query получает (last_id, batch_size) и возвращает строки с первым столбцом id;
+    compute (синхронная, выполняется в отдельном потоке) превращает строки в параметры для update_query.
+    Вместо update_query можно задать apply(con, строки) - корутину, которая сама пишет пачку в транзакции писателя.
+    source_table - таблица, которую читает fetch_query: если ее нет, дозаполнять нечего.
+    on_complete(con) выполняется в транзакции последней пачки.
+    """
+    name: str
+    fetch_query: str
+    compute: Optional[Callable[[List[Tuple]], List[Tuple]]] = None
+    update_query: str = ""
+    apply: Optional[Callable[[aiosqlite.Connection, List[Tuple]], Awaitable[None]]] = None
+    source_table: Optional[str] = None
+    on_complete: Optional[Callable[[aiosqlite.Connection], Awaitable[None]]] = None
+
+
+def _count_legacy_message_tokens(rows: List[Tuple]) -> List[Tuple]:
+    # [Dev-Ассистент]: Тот же токенайзер, что и utils.count_gpt_tokens по умолчанию (gpt-4 -> cl100k_base).
+    encoding = tiktoken.get_encoding("cl100k_base")
+    return [(len(encoding.encode(content)), message_id) for message_id, content in rows]
+
+
+async def _move_legacy_dialogs(con: aiosqlite.Connection, rows: List[Tuple]) -> None:
+    # [Dev-Ассистент]: Пачка строк определяет диалоги, а переносится каждый диалог целиком.
+    for user_id, character_name in dict.fromkeys((user_id, character_name) for _, user_id, character_name in rows):
+        await move_legacy_dialog(con, user_id, character_name)
+
+
+async def _drop_legacy_chat_history(con: aiosqlite.Connection) -> None:
+    # [Dev-Ассистент]: В старую таблицу никто не пишет, а строки удаляются по мере переноса: после последней пачки она пуста.
+    async with con.execute(f"SELECT 1 FROM {LEGACY_CHAT_HISTORY} LIMIT 1") as cursor:
+        if await cursor.fetchone() is not None:
+            raise RuntimeError(f"В {LEGACY_CHAT_HISTORY} остались неперенесенные строки.")
+    await con.execute(f"DROP TABLE {LEGACY_CHAT_HISTORY}")
+    logger.info(f"Перенос истории завершен, таблица {LEGACY_CHAT_HISTORY} удалена.")
+
+
+BACKFILLS: List[Backfill] = [
+    # [Dev-Ассистент]: Перенос старой chat_history на dialog_id (см. _002_dialogs). Пока он идет, database._get_dialog_id
+    # [Dev-Ассистент]: переносит диалог при первом обращении, так что бот видит всю историю с первой минуты.
+    Backfill(
+        name="chat_history_legacy_dialogs",
+        fetch_query=f"SELECT id, user_id, character_name FROM {LEGACY_CHAT_HISTORY} WHERE id > ? ORDER BY id LIMIT ?",
+        apply=_move_legacy_dialogs,
+        source_table=LEGACY_CHAT_HISTORY,
+        on_complete=_drop_legacy_chat_history,
+    ),
+    # [Dev-Ассистент]: Сообщения, сохраненные до появления token_count, лежат с token_count = 0 и не учитываются
+    # [Dev-Ассистент]: в пороге суммаризации. Пересчитываем их (триггер сам поправит dialogs.token_total).
+    Backfill(
+        name="chat_history_token_count",
+        fetch_query="""
+            SELECT id, content FROM chat_history
+            WHERE id > ? AND token_count = 0 AND is_summary = 0
+            ORDER BY id LIMIT ?
+        """,
+        compute=_count_legacy_message_tokens,
+        update_query="UPDATE chat_history SET token_count = ? WHERE id = ? AND token_count = 0",
+    ),
+]
@@ -0,0 +1,190 @@
+# file_cache.py
+# [Dev-Ассистент]: Кэш файлов Telegram и того, что из них получено (расшифровки, текст документов, JPEG для vision).
+#
+# Ключ - file_unique_id (одинаков у всех пересылок одного и того же файла) и имя артефакта. Значения лежат
+# на диске в FILE_CACHE_DIR, в памяти - только индекс размеров в порядке использования: при превышении
+# FILE_CACHE_MAX_BYTES удаляются давно не использованные записи. Время последнего использования - mtime файла,
+# поэтому порядок вытеснения переживает перезапуск. Файловые операции идут в пуле потоков.
+# Пока кэш не открыт (open_file_cache из post_init), get_artifact ничего не находит, а put_artifact ничего не пишет.
+
+import asyncio
+import hashlib
+import logging
+import os
+from collections import OrderedDict
+from typing import List, Optional
+
+from telegram import Bot
+
+import config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+ARTIFACT_RAW = "raw"                    # Байты файла как их отдал Telegram
+ARTIFACT_TRANSCRIPT = "transcript"      # Расшифровка голосового (UTF-8)
+ARTIFACT_DOCUMENT_TEXT = "text"         # Декодированный текст документа (UTF-8)
+ARTIFACT_VISION = "vision-{detail}"     # Изображение после ai_clients.images.prepare_image с этим detail
+
+_TMP_SUFFIX = ".tmp"
+
+
+class FileCache:
+    """Дисковый кэш с ограничением по суммарному размеру (LRU) и индексом в памяти."""
+
+    def __init__(self, directory: str, max_bytes: int, max_item_bytes: int):
+        self._directory = directory
+        self._max_bytes = max_bytes
+        self._max_item_bytes = max_item_bytes
+        # [Dev-Ассистент]: имя файла -> размер, от давно использованных к недавним.
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+        self._total_bytes = 0
+
+    def load_index(self) -> None:
+        """Строит индекс по содержимому каталога (синхронно - вызывать в пуле потоков)."""
+        os.makedirs(self._directory, exist_ok=True)
+        found = []
+        with os.scandir(self._directory) as entries:
+            for entry in entries:
+                if not entry.is_file():
+                    continue
+                if entry.name.endswith(_TMP_SUFFIX):
+                    # [Dev-Ассистент]: Недописанный файл от прерванной записи.
+                    os.unlink(entry.path)
+                    continue
+                stat = entry.stat()
+                found.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, name, size in sorted(found):
+            self._entries[name] = size
+            self._total_bytes += size
+        self._unlink(self._pop_least_recent())
+        logger.info(f"Кэш файлов: {len(self._entries)} записей, {self._total_bytes / 1024 / 1024:.1f} МБ в {self._directory}.")
+
+    @staticmethod
+    def _name(key: str) -> str:
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self._directory, name)
+
+    def _read(self, name: str) -> bytes:
+        path = self._path(name)
+        with open(path, "rb") as file:
+            data = file.read()
+        os.utime(path)
+        return data
+
+    def _write(self, name: str, data: bytes) -> None:
+        path = self._path(name)
+        tmp_path = path + _TMP_SUFFIX
+        with open(tmp_path, "wb") as file:
+            file.write(data)
+        os.replace(tmp_path, path)
+
+    def _unlink(self, names: List[str]) -> None:
+        for name in names:
+            try:
+                os.unlink(self._path(name))
+            except FileNotFoundError:
+                pass
+
+    def _pop_least_recent(self) -> List[str]:
+        evicted = []
+        while self._total_bytes > self._max_bytes and self._entries:
+            name, size = self._entries.popitem(last=False)
+            self._total_bytes -= size
+            evicted.append(name)
+        if evicted:
+            metrics.increment("file_cache_evictions_total", value=len(evicted))
+        return evicted
+
+    def _forget(self, name: str) -> None:
+        self._total_bytes -= self._entries.pop(name, 0)
+
+    async def get(self, key: str) -> Optional[bytes]:
+        name = self._name(key)
+        if name not in self._entries:
+            return None
+        self._entries.move_to_end(name)
+        try:
+            return await asyncio.to_thread(self._read, name)
+        except OSError as e:
+            logger.warning(f"Кэш файлов: запись {key} не читается, удаляем из индекса: {e}")
+            self._forget(name)
+            return None
+
+    async def put(self, key: str, data: bytes) -> None:
+        if len(data) > self._max_item_bytes:
+            return
+        name = self._name(key)
+        try:
+            await asyncio.to_thread(self._write, name, data)
+        except OSError as e:
+            logger.warning(f"Кэш файлов: не удалось записать {key}: {e}")
+            return
+        self._forget(name)
+        self._entries[name] = len(data)
+        self._total_bytes += len(data)
+        evicted = self._pop_least_recent()
+        if evicted:
+            await asyncio.to_thread(self._unlink, evicted)
+
+
+_cache: Optional[FileCache] = None
+
+
+async def open_file_cache() -> None:
+    """Открывает кэш и читает индекс с диска (вызывается из post_init)."""
+    global _cache
+    if _cache is not None or not config.FILE_CACHE_MAX_BYTES:
+        return
+    cache = FileCache(config.FILE_CACHE_DIR, config.FILE_CACHE_MAX_BYTES, config.FILE_CACHE_MAX_ITEM_BYTES)
+    try:
+        await asyncio.to_thread(cache.load_index)
+    except OSError as e:
+        logger.error(f"Кэш файлов отключен: не удалось открыть {config.FILE_CACHE_DIR}: {e}")
+        return
+    _cache = cache
+
+
+def _key(file_unique_id: str, artifact: str) -> str:
+    return f"{file_unique_id}:{artifact}"
+
+
+def _kind(artifact: str) -> str:
+    # [Dev-Ассистент]: Для метрик vision-low/vision-high сводим к одному виду.
+    return artifact.split("-", 1)[0]
+
+
+async def get_artifact(file_unique_id: str, artifact: str) -> Optional[bytes]:
+    """
+    Возвращает сохраненный артефакт файла или None.
+
+    :param file_unique_id: Telegram file_unique_id (у Voice, Document, PhotoSize).
+    :param artifact: ARTIFACT_* (для изображения - ARTIFACT_VISION.format(detail=...)).
+    """
+    if _cache is None:
+        return None
+    data = await _cache.get(_key(file_unique_id, artifact))
+    metrics.increment("file_cache_total", kind=_kind(artifact), outcome="miss" if data is None else "hit")
+    return data
+
+
+async def put_artifact(file_unique_id: str, artifact: str, data: bytes) -> None:
+    """Сохраняет артефакт файла (записи больше FILE_CACHE_MAX_ITEM_BYTES не сохраняются)."""
+    if _cache is not None:
+        await _cache.put(_key(file_unique_id, artifact), data)
+
+
+async def download_file(bot: Bot, file_id: str, file_unique_id: str) -> bytes:
+    """
+    Байты файла Telegram: из кэша (ARTIFACT_RAW), а если их там нет - скачивает и сохраняет.
+
+    :param file_id: file_id для get_file (у пересланных копий свой).
+    :param file_unique_id: Ключ кэша (одинаков у всех копий файла).
+    """
+    data = await get_artifact(file_unique_id, ARTIFACT_RAW)
+    if data is None:
+        data = bytes(await (await bot.get_file(file_id)).download_as_bytearray())
+        await put_artifact(file_unique_id, ARTIFACT_RAW, data)
+    return data
@@ -17,13 +17,10 @@ from constants import (
     CURRENT_DALL_E_3_RESOLUTION_KEY, CURRENT_YANDEXART_RESOLUTION_KEY,
     TRANSACTION_TYPE_IMAGE_GEN_COST, TRANSACTION_TYPE_YANDEXART_GEN_COST # [Dev-Ассистент]: Импорт нового типа транзакции
 )
-from ai_clients.yandexart_client import YandexArtClient
-from ai_clients.factory import get_ai_client_with_caps
-from telegram.constants import ChatAction
-import os
 
 # [Dev-Ассистент]: Импортируем billing_manager
 import billing_manager
+import image_jobs
 
 logger = logging.getLogger(__name__)
 
@@ -112,8 +109,7 @@ async def prompt_for_image_text(update: Update, context: ContextTypes.DEFAULT_TY
     image_gen_provider = context.user_data.get(CURRENT_IMAGE_GEN_PROVIDER_KEY)
 
     # [Dev-Ассистент]: Получаем user_data для доступа к персональным дефолтам из БД
-    user_id = await db.add_or_update_user(update.effective_user.id, update.effective_user.full_name, update.effective_user.username)
-    user_data = await db.get_user_by_id(user_id) # [Dev-Ассистент]: Перезагружаем user_data из БД
+    user_data = await db.resolve_user(update.effective_user.id, update.effective_user.full_name, update.effective_user.username)
     
     # [Dev-Ассистент]: Основной текст сообщения
     text = "🖼️ <b>Режим генерации изображений</b>\n\nЧто нарисовать? Отправьте мне подробное текстовое описание."
@@ -188,7 +184,7 @@ async def prompt_for_image_text(update: Update, context: ContextTypes.DEFAULT_TY
         )
 
 async def set_ai_provider(telegram_id: int, provider: str):
-    await db.db_request("UPDATE users SET current_ai_provider = ? WHERE telegram_id = ?", (provider, telegram_id))
+    await db.set_user_ai_provider_by_telegram_id(telegram_id, provider)
 
 async def handle_ai_selection_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
     query = update.callback_query
@@ -262,84 +258,22 @@ async def handle_ai_selection_callback(update: Update, context: ContextTypes.DEF
             return True
 
         image_gen_provider = context.user_data.get(CURRENT_IMAGE_GEN_PROVIDER_KEY)
-        
-        # [Dev-Ассистент]: Клавиатура для перерисовки/нового изображения (после генерации)
-        reply_keyboard = [[
-            InlineKeyboardButton("🔄 Перерисовать", callback_data="image_redraw"),
-            InlineKeyboardButton("✨ Создать новое", callback_data="image_create_new")
-        ],
-        [InlineKeyboardButton("⬅️ Назад", callback_data="back_to_image_gen_ai_selection")] 
-        ]
-        reply_markup = InlineKeyboardMarkup(reply_keyboard)
-        
-        safe_prompt = html.escape(prompt_text)
-        caption_text = f"✨ Ваше изображение по запросу:\n\n<code>{safe_prompt}</code>"
-
-        user_id_db = await db.add_or_update_user(update.effective_user.id, update.effective_user.full_name, update.effective_user.username)
-
         if image_gen_provider == IMAGE_GEN_YANDEXART:
             # [Dev-Ассистент]: Используем выбранное YandexArt разрешение для перерисовки
-            current_yandexart_resolution = context.user_data.get(CURRENT_YANDEXART_RESOLUTION_KEY, config.YANDEXART_DEFAULT_RESOLUTION)
-            
-            await query.message.reply_text(f"🎨 Повторяю запрос в YandexArt (размер: {config.YANDEXART_PRICING[current_yandexart_resolution]['display_name']}):\n\n<code>{safe_prompt}</code>", parse_mode='HTML')
-            
-            # [Dev-Ассистент]: Используем billing_manager для проверки и списания средств
-            deduction_successful = await billing_manager.perform_deduction(
-                user_id_db, 
-                'yandexart_image_gen', 
-                current_yandexart_resolution, 
-                update, 
-                context
-            )
-            
-            if not deduction_successful: return True
-
-            await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.UPLOAD_PHOTO)
-            try:
-                yandex_client = YandexArtClient(folder_id=os.getenv("YANDEX_FOLDER_ID"), api_key=os.getenv("YANDEX_API_KEY"))
-                # [Dev-Ассистент]: Передаем разрешение в generate_image
-                image_bytes, error_message = await yandex_client.generate_image(prompt_text, size=current_yandexart_resolution)
-                if error_message: await query.message.reply_text(f"😔 Ошибка при перерисовке: {error_message}")
-                elif image_bytes: await query.message.reply_photo(photo=image_bytes, caption=caption_text, parse_mode='HTML', reply_markup=reply_markup)
-                else: await query.message.reply_text("Произошла неизвестная ошибка, картинка не была получена.")
-            except Exception as e:
-                logging.error(f"Критическая ошибка при перерисовке YandexArt: {e}", exc_info=True)
-                await query.message.reply_text(f"Произошла критическая ошибка: {e}")
-
+            resolution = context.user_data.get(CURRENT_YANDEXART_RESOLUTION_KEY, config.YANDEXART_DEFAULT_RESOLUTION)
+            display_name = f"YandexArt (размер: {config.YANDEXART_PRICING[resolution]['display_name']})"
         elif image_gen_provider == IMAGE_GEN_DALL_E_3:
-            current_dalle3_resolution = context.user_data.get(CURRENT_DALL_E_3_RESOLUTION_KEY, config.DALL_E_3_DEFAULT_RESOLUTION)
-            
-            await query.message.reply_text(f"🎨 Повторяю запрос в DALL-E 3 (размер: {config.DALL_E_3_PRICING[current_dalle3_resolution]['display_name']}):\n\n<code>{safe_prompt}</code>", parse_mode='HTML')
-            
-            # [Dev-Ассистент]: Используем billing_manager для проверки и списания средств
-            deduction_successful = await billing_manager.perform_deduction(
-                user_id_db, 
-                'dalle3_image_gen', 
-                current_dalle3_resolution, 
-                update, 
-                context
-            )
-            
-            if not deduction_successful: return True
-
-            await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.UPLOAD_PHOTO)
-            try:
-                caps = get_ai_client_with_caps(GPT_1, system_instruction="You are an image generation assistant.")
-                image_url, error_message = await caps.client.generate_image(prompt_text, size=current_dalle3_resolution)
-                
-                if error_message: 
-                    await query.message.reply_text(f"😔 Ошибка при перерисовке: {error_message}")
-                elif image_url: 
-                    await query.message.reply_photo(photo=image_url, caption=caption_text, parse_mode='HTML', reply_markup=reply_markup)
-                else: 
-                    await query.message.reply_text("Произошла неизвестная ошибка, картинка не была получена.")
-            except Exception as e:
-                logging.error(f"Критическая ошибка при перерисовке DALL-E 3: {e}", exc_info=True)
-                await query.message.reply_text(f"Произошла критическая ошибка: {e}")
-        
+            resolution = context.user_data.get(CURRENT_DALL_E_3_RESOLUTION_KEY, config.DALL_E_3_DEFAULT_RESOLUTION)
+            display_name = f"DALL-E 3 (размер: {config.DALL_E_3_PRICING[resolution]['display_name']})"
         else:
             await query.message.reply_text("😔 Ошибка: не удалось определить, какой генератор использовать для перерисовки.")
+            return True
+
+        user_id_db = await db.add_or_update_user(update.effective_user.id, update.effective_user.full_name, update.effective_user.username)
+        await query.message.reply_text(f"🎨 Повторяю запрос в {display_name}:\n\n<code>{html.escape(prompt_text)}</code>", parse_mode='HTML')
 
+        # [Dev-Ассистент]: Как и первая генерация, перерисовка оплачивается и выполняется в фоне (image_jobs).
+        await image_jobs.submit_image_job(update, context, user_id_db, image_gen_provider, prompt_text, resolution, announce=False)
         return True
 
     if query.data == "image_gen_cancel":
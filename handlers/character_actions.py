@@ -47,8 +47,7 @@ async def show_character_card(update: Update, context: ContextTypes.DEFAULT_TYPE
             return await query.edit_message_text("Ошибка: персонаж не найден.")
 
         # [Dev-Ассистент]: !!! НОВАЯ ЛОГИКА ПРОВЕРКИ !!!
-        user_id = await get_user_id(update)
-        user_data = await db.get_user_by_id(user_id)
+        user_data = await db.resolve_user(update.effective_user.id, update.effective_user.full_name, update.effective_user.username)
         user_tier_name = await get_actual_user_tier(user_data)
         user_tier_level = TIER_HIERARCHY.get(user_tier_name, 0)
         
@@ -15,8 +15,7 @@ logger = logging.getLogger(__name__)
 
 @require_verification
 async def show_profile_hub(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user_id = await db.add_or_update_user(telegram_id=update.effective_user.id, full_name=update.effective_user.full_name, username=update.effective_user.username)
-    user_data = await db.get_user_by_id(user_id)
+    user_data = await db.resolve_user(telegram_id=update.effective_user.id, full_name=update.effective_user.full_name, username=update.effective_user.username)
     if not user_data:
         return
 
@@ -78,8 +77,7 @@ async def show_wallet_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     query = update.callback_query
     await query.answer()
 
-    user_id = await db.add_or_update_user(telegram_id=update.effective_user.id, full_name=update.effective_user.full_name, username=update.effective_user.username)
-    user_data = await db.get_user_by_id(user_id)
+    user_data = await db.resolve_user(telegram_id=update.effective_user.id, full_name=update.effective_user.full_name, username=update.effective_user.username)
     if not user_data:
         await query.edit_message_text("Ошибка: не удалось загрузить данные пользователя.")
         return
@@ -113,12 +111,12 @@ async def show_referral_program_menu(update: Update, context: ContextTypes.DEFAU
     query = update.callback_query
     await query.answer()
 
-    user_id = await db.add_or_update_user(telegram_id=update.effective_user.id, full_name=update.effective_user.full_name, username=update.effective_user.username)
-    user_data = await db.get_user_by_id(user_id)
+    user_data = await db.resolve_user(telegram_id=update.effective_user.id, full_name=update.effective_user.full_name, username=update.effective_user.username)
     if not user_data:
         await query.edit_message_text("Ошибка: не удалось загрузить данные пользователя.")
         return
     
+    user_id = user_data['id']
     user_telegram_id = user_data['telegram_id'] # Нужен для генерации ссылки
     
     # [Dev-Ассистент]: Получаем данные о рефералах
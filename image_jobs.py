@@ -0,0 +1,262 @@
+# image_jobs.py
+# [Dev-Ассистент]: Очередь оплаченных генераций изображений (DALL-E 3, YandexArt).
+#
+# Обработчик сообщения только списывает деньги и создает задание (billing_manager.create_paid_image_job -
+# одна транзакция БД), после чего сразу освобождается. Задание выполняет один из воркеров его провайдера
+# (не больше IMAGE_JOB_WORKERS генераций одновременно), картинка приходит в чат отдельным сообщением.
+# Состояния задания: queued -> running -> delivered, а при ошибке failed -> refunded.
+# При запуске бота (start_image_jobs) незавершенные задания продолжаются, если у них остались попытки и они
+# не устарели, иначе деньги возвращаются. Очередь провайдера ограничена IMAGE_JOB_MAX_QUEUED: сверх нее
+# новые задания не принимаются, и деньги за них не списываются.
+
+import asyncio
+import html
+import logging
+import os
+import time
+from typing import Dict, List, Optional, Tuple, Union
+
+from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram.constants import ChatAction
+from telegram.error import TelegramError
+from telegram.ext import ContextTypes
+
+import billing_manager
+import config
+import database as db
+import metrics
+from constants import (
+    GPT_1, IMAGE_GEN_DALL_E_3, IMAGE_GEN_YANDEXART,
+    IMAGE_JOB_DELIVERED, IMAGE_JOB_FAILED, IMAGE_JOB_QUEUED, IMAGE_JOB_RUNNING
+)
+from ai_clients.factory import get_ai_client_with_caps
+from ai_clients.yandexart_client import YandexArtClient
+
+logger = logging.getLogger(__name__)
+
+# [Dev-Ассистент]: Для каждого генератора: (название, тип услуги для billing_manager, цены, сколько ждать).
+_PROVIDERS = {
+    IMAGE_GEN_DALL_E_3: ("DALL-E 3", "dalle3_image_gen", config.DALL_E_3_PRICING, "время ожидания до 1 минуты"),
+    IMAGE_GEN_YANDEXART: ("YandexArt", "yandexart_image_gen", config.YANDEXART_PRICING, "это может занять до 2 минут"),
+}
+# [Dev-Ассистент]: Подпись к фото в Telegram - до 1024 символов, длинный промпт в нее целиком не влезет.
+_CAPTION_PROMPT_LIMIT = 900
+
+
+def image_result_keyboard() -> InlineKeyboardMarkup:
+    """Кнопки под готовым изображением."""
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("🔄 Перерисовать", callback_data="image_redraw"),
+         InlineKeyboardButton("✨ Создать новое", callback_data="image_create_new")],
+        [InlineKeyboardButton("⬅️ Назад", callback_data="back_to_image_gen_ai_selection")]
+    ])
+
+
+async def _generate(job: Dict) -> Tuple[Union[str, bytes, None], Optional[str]]:
+    """Генерация по заданию: (URL или байты изображения, текст ошибки)."""
+    if job['provider'] == IMAGE_GEN_DALL_E_3:
+        caps = get_ai_client_with_caps(GPT_1)  # Используем GPT_1 для DALL-E 3
+        return await caps.client.generate_image(job['prompt'], size=job['resolution'])
+    if job['provider'] == IMAGE_GEN_YANDEXART:
+        yandex_client = YandexArtClient(folder_id=os.getenv("YANDEX_FOLDER_ID"), api_key=os.getenv("YANDEX_API_KEY"))
+        return await yandex_client.generate_image(job['prompt'], size=job['resolution'])
+    return None, f"Неизвестный генератор изображений: {job['provider']}"
+
+
+async def _keep_upload_indicator(bot: Bot, chat_id: int) -> None:
+    try:
+        while True:
+            await bot.send_chat_action(chat_id=chat_id, action=ChatAction.UPLOAD_PHOTO)
+            await asyncio.sleep(4)
+    except TelegramError as e:
+        logger.warning(f"Ошибка в задаче индикатора для чата {chat_id}: {e}")
+
+
+class ImageJobQueue:
+    """Очереди заданий по провайдерам и их воркеры. Один экземпляр на процесс (start_image_jobs)."""
+
+    def __init__(self, bot: Bot):
+        self._bot = bot
+        self._queues: Dict[str, asyncio.Queue] = {provider: asyncio.Queue() for provider in config.IMAGE_JOB_WORKERS}
+        self._workers: List[asyncio.Task] = []
+
+    def start(self) -> None:
+        for provider, worker_count in config.IMAGE_JOB_WORKERS.items():
+            for _ in range(worker_count):
+                self._workers.append(asyncio.create_task(self._work(provider)))
+
+    async def stop(self) -> None:
+        """
+        Останавливает воркеры. Прерванные задания остаются в БД в состоянии running
+        и при следующем запуске продолжаются (или возвращаются, если попытки исчерпаны).
+        """
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers.clear()
+
+    def queued_count(self, provider: str) -> int:
+        """Сколько заданий провайдера ждут свободного воркера."""
+        queue = self._queues.get(provider)
+        return queue.qsize() if queue is not None else 0
+
+    def has_capacity(self, provider: str) -> bool:
+        return provider in self._queues and self.queued_count(provider) < config.IMAGE_JOB_MAX_QUEUED
+
+    def submit(self, job_id: int, provider: str) -> None:
+        self._queues[provider].put_nowait(job_id)
+        metrics.increment("image_jobs_total", provider=provider, outcome="queued")
+
+    async def resume(self) -> None:
+        """Продолжает или возвращает задания, которые не завершились до перезапуска."""
+        for job in await db.get_unfinished_image_jobs():
+            reason = None
+            if job['status'] == IMAGE_JOB_FAILED:
+                reason = job['error']
+            elif job['provider'] not in self._queues:
+                reason = "Генератор изображений больше недоступен."
+            elif job['age_seconds'] > config.IMAGE_JOB_RESUME_MAX_AGE_SECONDS or job['attempts'] >= config.IMAGE_JOB_MAX_ATTEMPTS:
+                reason = "Генерация была прервана перезапуском бота."
+
+            if reason is not None:
+                await self._refund(job, reason)
+                continue
+            if job['status'] == IMAGE_JOB_RUNNING:
+                await db.set_image_job_status(job['id'], IMAGE_JOB_QUEUED, job['error'])
+            logger.info(f"Задание генерации {job['id']} ({job['status']}, попыток: {job['attempts']}) возвращено в очередь после перезапуска.")
+            self.submit(job['id'], job['provider'])
+
+    async def _work(self, provider: str) -> None:
+        queue = self._queues[provider]
+        while True:
+            job_id = await queue.get()
+            try:
+                await self._run(job_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # [Dev-Ассистент]: Задание остается в БД (running) и будет разобрано при следующем запуске.
+                logger.error(f"Ошибка воркера {provider} на задании генерации {job_id}: {e}", exc_info=True)
+            finally:
+                queue.task_done()
+
+    async def _run(self, job_id: int) -> None:
+        job = await db.start_image_job(job_id)
+        if not job:
+            return  # [Dev-Ассистент]: Задание уже завершено или его взял другой воркер.
+        name = _PROVIDERS[job['provider']][0]
+        indicator_task = asyncio.create_task(_keep_upload_indicator(self._bot, job['chat_id']))
+        started_at = time.monotonic()
+        try:
+            image, error_message = await _generate(job)
+        except Exception as e:
+            logger.error(f"Неизвестная ошибка генерации {name} в задании {job_id}: {e}", exc_info=True)
+            image, error_message = None, f"Неизвестная ошибка: {e}"
+        finally:
+            indicator_task.cancel()
+        metrics.observe("image_job_seconds", time.monotonic() - started_at, provider=job['provider'])
+
+        if error_message or not image:
+            await self._fail(job, error_message or "Картинка не была получена.")
+            return
+
+        # [Dev-Ассистент]: Если бот упадет между отправкой и записью delivered, задание повторится:
+        # [Dev-Ассистент]: пользователь получит картинку дважды, но заплатит один раз.
+        prompt = job['prompt']
+        if len(prompt) > _CAPTION_PROMPT_LIMIT:
+            prompt = prompt[:_CAPTION_PROMPT_LIMIT] + "…"
+        from_name = f" от {name}" if job['provider'] == IMAGE_GEN_YANDEXART else ""
+        try:
+            await self._bot.send_photo(
+                chat_id=job['chat_id'],
+                photo=image,
+                caption=f"✨ Ваше изображение{from_name} по запросу:\n\n<code>{html.escape(prompt)}</code>",
+                parse_mode='HTML',
+                reply_markup=image_result_keyboard()
+            )
+        except TelegramError as e:
+            logger.error(f"Не удалось доставить изображение задания {job_id} в чат {job['chat_id']}: {e}")
+            await self._fail(job, f"Не удалось отправить изображение: {e}")
+            return
+        await db.set_image_job_status(job_id, IMAGE_JOB_DELIVERED)
+        metrics.increment("image_jobs_total", provider=job['provider'], outcome="delivered")
+
+    async def _fail(self, job: Dict, error_message: str) -> None:
+        # [Dev-Ассистент]: failed фиксируется до возврата: если возврат не пройдет, его доделает resume.
+        await db.set_image_job_status(job['id'], IMAGE_JOB_FAILED, error_message)
+        await self._refund(job, error_message)
+
+    async def _refund(self, job: Dict, reason: str) -> None:
+        refunded = await db.refund_image_job(job['id'], reason)
+        metrics.increment("image_jobs_total", provider=job['provider'], outcome="refunded" if refunded else "failed")
+        text = f"😔 Ошибка: {reason}"
+        if refunded:
+            text += f"\n\n{job['cost']} AGMcoin за генерацию возвращены на баланс."
+        try:
+            await self._bot.send_message(chat_id=job['chat_id'], text=text)
+        except TelegramError as e:
+            logger.warning(f"Не удалось сообщить о неудаче задания генерации {job['id']} в чат {job['chat_id']}: {e}")
+
+
+_job_queue: Optional[ImageJobQueue] = None
+
+
+async def start_image_jobs(bot: Bot) -> None:
+    """Запускает воркеры и разбирает задания, оставшиеся от прошлого запуска (вызывается из post_init)."""
+    global _job_queue
+    if _job_queue is None:
+        _job_queue = ImageJobQueue(bot)
+        _job_queue.start()
+        await _job_queue.resume()
+
+
+async def stop_image_jobs() -> None:
+    """Останавливает воркеры (вызывается из post_shutdown до закрытия пула БД)."""
+    global _job_queue
+    if _job_queue is not None:
+        await _job_queue.stop()
+        _job_queue = None
+
+
+async def submit_image_job(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    user_id: int,
+    provider: str,
+    prompt: str,
+    resolution: str,
+    announce: bool = True
+) -> bool:
+    """
+    Оплачивает и ставит в очередь генерацию изображения. Картинка (или сообщение об ошибке
+    с возвратом средств) придет в чат позже.
+
+    :param provider: Генератор (IMAGE_GEN_DALL_E_3 / IMAGE_GEN_YANDEXART).
+    :param resolution: Разрешение (ключ DALL_E_3_PRICING / YANDEXART_PRICING).
+    :param announce: Сообщить пользователю, что запрос принят (и сколько заданий перед ним).
+    :return: True, если задание принято; иначе пользователю уже отправлено сообщение о причине.
+    """
+    chat_id = update.effective_chat.id
+    if provider not in _PROVIDERS:
+        await context.bot.send_message(chat_id=chat_id, text="😔 Ошибка: не удалось определить генератор изображений.")
+        return False
+    name, item_type, pricing, wait_hint = _PROVIDERS[provider]
+
+    # [Dev-Ассистент]: Проверяем очередь до списания: за задание, которое не примем, платить не нужно.
+    if _job_queue is None or not _job_queue.has_capacity(provider):
+        metrics.increment("image_jobs_total", provider=provider, outcome="rejected")
+        await context.bot.send_message(chat_id=chat_id, text=f"😔 {name} сейчас перегружен. Попробуйте через пару минут, средства не списаны.")
+        return False
+
+    job_id = await billing_manager.create_paid_image_job(user_id, item_type, resolution, provider, prompt, update, context)
+    if job_id is None:
+        return False  # [Dev-Ассистент]: Сообщение (например, о нехватке средств) уже отправлено billing_manager.
+
+    queued_ahead = _job_queue.queued_count(provider)
+    _job_queue.submit(job_id, provider)
+    if announce:
+        text = f"🎨 Принято! Отправляю запрос в {name} (размер: {pricing[resolution]['display_name']}), {wait_hint}..."
+        if queued_ahead:
+            text += f"\nЗапросов в очереди перед вашим: {queued_ahead}."
+        await context.bot.send_message(chat_id=chat_id, text=text)
+    return True
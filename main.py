@@ -4,7 +4,7 @@ import os
 import logging
 import asyncio
 from dotenv import load_dotenv
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 # [Dev-Ассистент]: Импортируем Dict
 from typing import Dict
 
@@ -27,9 +27,7 @@ admin_ids_from_env = os.getenv("ADMIN_IDS", "")
 ADMIN_IDS = parse_admin_ids(admin_ids_from_env)
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
-from io import BytesIO
-from PIL import Image
-from telegram import Update, BotCommand, InlineKeyboardButton, InlineKeyboardMarkup, Bot
+from telegram import Update, BotCommand, Bot
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler
 from telegram.constants import ChatAction
 from constants import GPT_1
@@ -51,12 +49,18 @@ from characters import DEFAULT_CHARACTER_NAME, ALL_PROMPTS
 from handlers import character_menus, characters_handler, profile_handler, captcha_handler, ai_selection_handler, onboarding_handler, post_processing_handler
 import utils
 from utils import get_main_keyboard, get_actual_user_tier, require_verification, get_text_content_from_document, FileSizeError, inject_user_data, count_gpt_tokens
-from ai_clients.factory import get_ai_client_with_caps
-from ai_clients.gpt_client import GPTClient
-from ai_clients.yandexart_client import YandexArtClient
-
-# [Dev-Ассистент]: Импортируем billing_manager
-import billing_manager
+from ai_clients.factory import get_ai_client_with_caps, init_ai_clients, close_ai_clients, route_ai_client, hedge_ai_client
+from ai_clients.hedging import HedgedClient
+from ai_clients.gpt_client import ResponseChain, use_response_chain
+from ai_clients.images import PreparedImage, VISION_DETAIL_AUTO, prepare_image, select_photo_size
+from ai_clients.base_client import AIClientError
+from ai_clients.audio import AudioConversionError, transcribe_voice
+from ai_clients.rate_limiter import set_request_priority
+
+import file_cache
+import image_jobs
+import metrics
+import summarizer
 
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 
@@ -115,13 +119,14 @@ async def _perform_summarization(user_id: int, character_name: str, active_buffe
 
     try:
         # [Dev-Ассистент]: 4. Вызываем LLM-суммаризатор
-        summarization_llm_client_caps = get_ai_client_with_caps(
-            config.SUMMARIZATION_MODEL_NAME, 
-            system_instruction=config.SUMMARIZATION_PROMPT
-        )
+        summarization_llm_client_caps = get_ai_client_with_caps(config.SUMMARIZATION_MODEL_NAME)
         summarization_ai_client = summarization_llm_client_caps.client
         
-        summary_text, _ = await summarization_ai_client.get_text_response(chat_history=[], user_prompt=full_text_to_summarize)
+        summary_text, _ = await summarization_ai_client.get_text_response(
+            chat_history=[],
+            user_prompt=full_text_to_summarize,
+            system_instruction=config.SUMMARIZATION_PROMPT
+        )
         
         # [Dev-Ассистент]: 5. Подсчитываем токены полученного резюме
         summary_token_count = count_gpt_tokens(summary_text, model_name=config.SUMMARIZATION_MODEL_NAME)
@@ -141,18 +146,21 @@ async def _perform_summarization(user_id: int, character_name: str, active_buffe
         # [Dev-Ассистент]: Важно: если суммаризация не удалась, старые сообщения НЕ УДАЛЯЕМ,
         # [Dev-Ассистент]: чтобы не потерять контекст. Они будут суммированы в следующий раз.
 
-async def process_ai_request(update: Update, context: ContextTypes.DEFAULT_TYPE, user_data: dict, user_content: str, is_photo: bool = False, image_obj: Image = None, is_document: bool = False, document_char_count: int = 0):
+async def process_ai_request(update: Update, context: ContextTypes.DEFAULT_TYPE, user_data: dict, user_content: str, is_photo: bool = False, image_obj: Optional[PreparedImage] = None, is_document: bool = False, document_char_count: int = 0):
     user_id = user_data['id']
     chat_id = update.effective_chat.id
     
     user_tier_name = await utils.get_actual_user_tier(user_data)
     user_tier_level = utils.TIER_HIERARCHY.get(user_tier_name, 0)
+    # [Dev-Ассистент]: В очереди лимитера (ai_clients.rate_limiter) старшие тарифы обслуживаются раньше.
+    set_request_priority(user_tier_level)
     
     # [Dev-Ассистент]: A. Получение Тарифных Настроек
     tier_config = config.SUBSCRIPTION_TIERS[user_tier_name]
     active_buffer_message_count = tier_config.get("active_buffer_message_count", config.DEFAULT_HISTORY_LIMIT) # [Dev-Ассистент]: используем DEFAULT_HISTORY_LIMIT как запасной вариант
     summarization_token_trigger = tier_config.get("summarization_token_trigger")
     max_llm_input_tokens = tier_config.get("max_llm_input_tokens")
+    context_block_size = tier_config.get("context_block_size", 1)
 
     personal_ai_choice = user_data.get('current_ai_provider')
     available_providers = config.SUBSCRIPTION_TIERS[user_tier_name]['available_providers']
@@ -232,121 +240,32 @@ async def process_ai_request(update: Update, context: ContextTypes.DEFAULT_TYPE,
     processed_html_text = None
     reply_markup = None
     current_llm_input_tokens = 0  # [Dev-Ассистент]: Переменная для хранения токенов текущего запроса, отправленных в LLM
+    stream_placeholder = None  # [Dev-Ассистент]: Сообщение с потоковым превью ответа (если ответ шел потоком)
+    fallback_note = ""  # [Dev-Ассистент]: Пометка для пользователя, если ответила запасная модель
 
     try:
         if is_image_gen_request_state:
             image_gen_provider = context.user_data.get(CURRENT_IMAGE_GEN_PROVIDER_KEY)
-            deduction_successful = False
-            image_url = None # Для DALL-E 3
-            image_bytes = None # Для YandexArt
-            error_message = None # Общая переменная для сообщения об ошибке
-
             if image_gen_provider == IMAGE_GEN_DALL_E_3:
                 current_resolution = context.user_data.get(CURRENT_DALL_E_3_RESOLUTION_KEY, config.DALL_E_3_DEFAULT_RESOLUTION)
-                
-                # [Dev-Ассистент]: Используем billing_manager для проверки и списания средств
-                deduction_successful = await billing_manager.perform_deduction(
-                    user_id, 
-                    'dalle3_image_gen', # Тип услуги
-                    current_resolution, # Идентификатор услуги (размер)
-                    update, 
-                    context
-                )
-                
-                if not deduction_successful: 
-                    # [Dev-Ассистент]: Сбрасываем состояние, даже если списание не удалось
-                    context.user_data['state'] = STATE_NONE
-                    return # Прерываем, если списание не удалось (сообщение уже отправлено perform_deduction)
-
-                # [Dev-Ассистент]: Отменяем индикатор TYPING и включаем UPLOAD_PHOTO
-                indicator_task.cancel()
-                indicator_task = asyncio.create_task(_keep_indicator_alive(context.bot, chat_id, ChatAction.UPLOAD_PHOTO))
-                # [Dev-Ассистент]: НОВАЯ СТРОКА: Уведомление для DALL-E 3
-
-                await context.bot.send_message(chat_id=chat_id, text=f"🎨 Принято! Отправляю запрос в DALL-E 3 (размер: {config.DALL_E_3_PRICING[current_resolution]['display_name']}) время ожидания до 1 минуты...")
-
-                caps = get_ai_client_with_caps(GPT_1, system_instruction="You are an image generation assistant.") # Используем GPT_1 для DALL-E 3
-                image_url, error_message = await caps.client.generate_image(user_content, size=current_resolution) 
-                
-                if error_message: # [Dev-Ассистент]: Если ошибка, сообщение сразу
-                     await context.bot.send_message(chat_id=chat_id, text=f"😔 Ошибка: {error_message}")
-                     # [Dev-Ассистент]: Сбрасываем состояние при ошибке генерации
-                     context.user_data['state'] = STATE_NONE
-                     return # Выходим
-
-            elif image_gen_provider == IMAGE_GEN_YANDEXART: # [Dev-Ассистент]: Логика для YandexArt
+            else: # [Dev-Ассистент]: IMAGE_GEN_YANDEXART
                 current_resolution = context.user_data.get(CURRENT_YANDEXART_RESOLUTION_KEY, config.YANDEXART_DEFAULT_RESOLUTION)
-                
-                # [Dev-Ассистент]: Используем billing_manager для проверки и списания средств
-                deduction_successful = await billing_manager.perform_deduction(
-                    user_id, 
-                    'yandexart_image_gen', # Тип услуги
-                    current_resolution, # Идентификатор услуги (размер)
-                    update, 
-                    context
-                )
-                
-                if not deduction_successful: 
-                    # [Dev-Ассистент]: Сбрасываем состояние, даже если списание не удалось
-                    context.user_data['state'] = STATE_NONE
-                    return # Прерываем, если списание не удалось (сообщение уже отправлено perform_deduction)
-
-                # [Dev-Ассистент]: Отменяем индикатор TYPING и включаем UPLOAD_PHOTO
-                indicator_task.cancel()
-                indicator_task = asyncio.create_task(_keep_indicator_alive(context.bot, chat_id, ChatAction.UPLOAD_PHOTO))
-                
-                await context.bot.send_message(chat_id=chat_id, text=f"🎨 Принято! Отправляю запрос в YandexArt (размер: {config.YANDEXART_PRICING[current_resolution]['display_name']}), это может занять до 2 минут...") # [Dev-Ассистент]: Уведомление для YandexArt
-                
-                yandex_client = YandexArtClient(folder_id=os.getenv("YANDEX_FOLDER_ID"), api_key=os.getenv("YANDEX_API_KEY"))
-                # [Dev-Ассистент]: Передаем разрешение в generate_image YandexArt
-                image_bytes, error_message = await yandex_client.generate_image(user_content, size=current_resolution) 
-                
-                if error_message: # [Dev-Ассистент]: Если ошибка, сообщение сразу
-                     await context.bot.send_message(chat_id=chat_id, text=f"😔 Ошибка: {error_message}")
-                     # [Dev-Ассистент]: Сбрасываем состояние при ошибке генерации
-                     context.user_data['state'] = STATE_NONE
-                     return # Выходим
-
-            # [Dev-Ассистент]: Общий блок для отправки изображения, если оно было успешно получено
-            if image_url or image_bytes: 
-            # [Dev-Ассистент]: Логика списания перенесена в billing_manager.perform_deduction
-            
-                reply_markup_for_image = InlineKeyboardMarkup([
-                [InlineKeyboardButton("🔄 Перерисовать", callback_data="image_redraw"),
-                 InlineKeyboardButton("✨ Создать новое", callback_data="image_create_new")],
-                [InlineKeyboardButton("⬅️ Назад", callback_data="back_to_image_gen_ai_selection")] # [Dev-Ассистент]: НОВАЯ КНОПКА НАЗАД
-            ])
-            
-            if image_url:
-                await context.bot.send_photo(
-                    chat_id=chat_id, 
-                    photo=image_url, 
-                    caption=f"✨ Ваше изображение по запросу:\n\n`{user_content}`", 
-                    parse_mode='Markdown',
-                    reply_markup=reply_markup_for_image
-                )
-            elif image_bytes:
-                await context.bot.send_photo(
-                    chat_id=chat_id, 
-                    photo=image_bytes, 
-                    caption=f"✨ Ваше изображение от YandexArt по запросу:\n\n`{user_content}`", 
-                    parse_mode='Markdown',
-                    reply_markup=reply_markup_for_image
-                )
-            else:
-                # Этот else сработает, если error_message был None, но image_url/image_bytes тоже None (очень редкий случай)
-                await context.bot.send_message(chat_id=chat_id, text="Произошла неизвестная ошибка, картинка не была получена.")
-            
+
+            # [Dev-Ассистент]: Генерация идет в фоне (image_jobs): здесь задание только оплачивается и ставится в очередь,
+            # [Dev-Ассистент]: а картинка (или ошибка с возвратом средств) придет в чат отдельным сообщением.
+            submitted = await image_jobs.submit_image_job(update, context, user_id, image_gen_provider, user_content, current_resolution)
+
             # [Dev-Ассистент]: СБРОС СОСТОЯНИЯ ВСЕГДА ПОСЛЕ ПОПЫТКИ ГЕНЕРАЦИИ ИЗОБРАЖЕНИЯ.
             # [Dev-Ассистент]: Это гарантирует, что бот выйдет из режима ожидания промпта для картинки.
-            context.user_data['state'] = STATE_NONE 
-            # [Dev-Ассистент]: Сохраняем промпт для перерисовки (даже если не было картинки, чтобы можно было перерисовать)
-            context.user_data[LAST_IMAGE_PROMPT_KEY] = user_content 
+            context.user_data['state'] = STATE_NONE
+            if submitted:
+                # [Dev-Ассистент]: Сохраняем промпт для перерисовки
+                context.user_data[LAST_IMAGE_PROMPT_KEY] = user_content
             return # Выходим, т.к. это была генерация изображения, а не текст.
 
         # --- Начало старой логики обработки сообщений (текст, фото, документы) ---
         try:
-            caps = get_ai_client_with_caps(ai_provider, system_instruction)
+            caps = get_ai_client_with_caps(ai_provider)
             ai_client = caps.client
         except ValueError as e:
             logger.error(f"Ошибка создания AI клиента: {e}")
@@ -363,9 +282,28 @@ async def process_ai_request(update: Update, context: ContextTypes.DEFAULT_TYPE,
             await context.bot.send_message(chat_id=chat_id, text=f"Файл слишком большой. Максимум: {caps.file_char_limit} символов, в вашем файле: {document_char_count}.")
             return
 
+        # [Dev-Ассистент]: Если автомат выбранной модели открыт (провайдер сбоит), запрос сразу уходит на здоровую
+        # [Dev-Ассистент]: запасную модель тарифа, а не ждет таймаутов. Без подходящей замены - AIClientError.
+        answered_provider, caps = route_ai_client(
+            ai_provider, available_providers,
+            require_vision=is_photo,
+            min_file_chars=document_char_count if is_document else 0
+        )
+        ai_client = caps.client
+        # [Dev-Ассистент]: Короткие текстовые реплики платных тарифов хеджируются: если модель отвечает дольше своего
+        # [Dev-Ассистент]: обычного p90, тот же запрос уходит во вторую модель тарифа (ai_clients.hedging).
+        if (tier_config.get("hedge_requests") and not is_photo and not is_document
+                and len(user_content) <= config.AI_HEDGE_MAX_PROMPT_CHARS):
+            ai_client = hedge_ai_client(answered_provider, caps, available_providers)
+
         # [Dev-Ассистент]: E. Формирование Контекста для LLM (замена старой логики chat_history)
         # [Dev-Ассистент]: Получаем историю, которая уже включает резюме и активный буфер
-        full_chat_history_for_llm = await db.get_history_for_context(user_id, char_name, active_buffer_message_count)
+        full_chat_history_for_llm = await db.get_history_for_context(user_id, char_name, active_buffer_message_count, context_block_size)
+        response_chain = None
+        if config.OPENAI_RESPONSES_CHAINING and not is_photo:
+            # [Dev-Ассистент]: GPT продолжит сохраненную цепочку ответов вместо отправки всей истории (ai_clients.gpt_client).
+            response_chain = ResponseChain(*await db.get_dialog_response_chain(user_id, char_name))
+            use_response_chain(response_chain)
 
         # [Dev-Ассистент]: Если до этого был индикатор UPLOAD_PHOTO, теперь его нужно сбросить и поставить TYPING
         indicator_task.cancel() # Отменяем любой предыдущий индикатор
@@ -375,18 +313,49 @@ async def process_ai_request(update: Update, context: ContextTypes.DEFAULT_TYPE,
         ai_response_tokens = 0 # [Dev-Ассистент]: Инициализация для ai_response_tokens
         
         if is_photo and image_obj:
-            raw_response_text, ai_response_tokens = await ai_client.get_image_response(full_chat_history_for_llm, user_content, image_obj) # [Dev-Ассистент]: Передаем новую историю
+            raw_response_text, ai_response_tokens = await ai_client.get_image_response(full_chat_history_for_llm, user_content, image_obj, system_instruction=system_instruction) # [Dev-Ассистент]: Передаем новую историю
             db_user_content = f"[Изображение] {user_content}"
             user_message_tokens = count_gpt_tokens(db_user_content, model_name=ai_provider) # [Dev-Ассистент]: Подсчет токенов для пользовательского сообщения
+        elif output_format == OUTPUT_FORMAT_TEXT:
+            # [Dev-Ассистент]: Текстовый ответ идет потоком: пользователь видит первые слова через секунду-две,
+            # [Dev-Ассистент]: а не после генерации всего ответа. Файловые форматы (txt/pdf) ждут полный текст.
+            raw_response_text, ai_response_tokens, stream_placeholder = await utils.stream_response_preview(
+                context, chat_id,
+                ai_client.stream_text_response(full_chat_history_for_llm, user_content, system_instruction=system_instruction)
+            )
+            db_user_content = user_content
+            user_message_tokens = count_gpt_tokens(db_user_content, model_name=ai_provider) # [Dev-Ассистент]: Подсчет токенов для пользовательского сообщения
         else:
-            raw_response_text, ai_response_tokens = await ai_client.get_text_response(full_chat_history_for_llm, user_content) # [Dev-Ассистент]: Передаем новую историю
+            raw_response_text, ai_response_tokens = await ai_client.get_text_response(full_chat_history_for_llm, user_content, system_instruction=system_instruction) # [Dev-Ассистент]: Передаем новую историю
             db_user_content = user_content
             user_message_tokens = count_gpt_tokens(db_user_content, model_name=ai_provider) # [Dev-Ассистент]: Подсчет токенов для пользовательского сообщения
             
+        # [Dev-Ассистент]: Цепочка относится только к этому запросу: задачи ниже (суммаризация) не должны ее унаследовать.
+        use_response_chain(None)
+        if isinstance(ai_client, HedgedClient) and ai_client.answered_provider != answered_provider:
+            fallback_note = f"\n\n<i>⚡ Быстрее ответила {html.escape(utils.get_model_display_name(ai_client.answered_provider))}.</i>"
+        elif answered_provider != ai_provider:
+            fallback_note = (
+                f"\n\n<i>⚠️ {html.escape(utils.get_model_display_name(ai_provider))} сейчас недоступна, "
+                f"ответила {html.escape(utils.get_model_display_name(answered_provider))}.</i>"
+            )
+
         # [Dev-Ассистент]: B. Подсчет Токенов и Сохранение в Историю
         # [Dev-Ассистент]: Теперь передаем подсчитанные токены в add_message_to_history
+        # [Dev-Ассистент]: Обе записи не ждут диска - они уходят в один групповой коммит (database.enqueue_write).
         await db.add_message_to_history(user_id, char_name, 'user', db_user_content, user_message_tokens)
         await db.add_message_to_history(user_id, char_name, 'model', raw_response_text, ai_response_tokens)
+        # [Dev-Ассистент]: Каждый ход обновляет цепочку: если ответ дала не она (другая модель, vision) - сбрасываем,
+        # [Dev-Ассистент]: чтобы следующий запрос к GPT ушел с полной историей, включающей этот ход.
+        if config.OPENAI_RESPONSES_CHAINING:
+            chained_response_id, chained_model = None, None
+            if response_chain and not (isinstance(ai_client, HedgedClient) and ai_client.answered_provider != answered_provider):
+                chained_model = getattr(caps.client, "model_name", None)
+                chained_response_id = response_chain.responses.get(chained_model)
+            await db.save_dialog_response_chain(
+                user_id, char_name, chained_response_id, chained_model if chained_response_id else None,
+                response_chain.generation if response_chain else None
+            )
 
         # [Dev-Ассистент]: current_llm_input_tokens = токены_входа + токены_выхода
         # [Dev-Ассистент]: LLM-клиенты возвращают уже общее количество токенов запроса,
@@ -399,20 +368,27 @@ async def process_ai_request(update: Update, context: ContextTypes.DEFAULT_TYPE,
         processed_html_text = utils.markdown_to_html(raw_response_text)
 
         # [Dev-Ассистент]: C. Проверка Токен-ориентированного Триггера Суммаризации
-        if summarization_token_trigger is not None and summarization_token_trigger > 0: # [Dev-Ассистент]: Убеждаемся, что суммаризация включена
+        # [Dev-Ассистент]: Если суммаризация диалога уже ждет или идет, триггер (и запрос к БД) не нужен.
+        if summarization_token_trigger is not None and summarization_token_trigger > 0 and not summarizer.is_summarization_scheduled(user_id, char_name): # [Dev-Ассистент]: Убеждаемся, что суммаризация включена
             total_tokens_in_summarizable_history = await db.get_total_tokens_in_summarizable_history(user_id, char_name, active_buffer_message_count)
             logger.info(f"Токены в истории для суммаризации: {total_tokens_in_summarizable_history}. Триггер: {summarization_token_trigger}.")
             if total_tokens_in_summarizable_history >= summarization_token_trigger:
-                # [Dev-Ассистент]: D. Выполнение Суммаризации (вызов новой функции)
-                # [Dev-Ассистент]: Запускаем суммаризацию как фоновую задачу, чтобы не блокировать ответ пользователю
-                asyncio.create_task(_perform_summarization(user_id, char_name, active_buffer_message_count))
-                logger.info(f"Триггер суммаризации сработал для user_id={user_id}, char='{char_name}'.")
-
+                # [Dev-Ассистент]: D. Выполнение Суммаризации в фоне, чтобы не блокировать ответ пользователю.
+                # [Dev-Ассистент]: Планировщик (summarizer) держит не больше одного задания на диалог.
+                if summarizer.schedule_summarization(user_id, char_name, active_buffer_message_count):
+                    logger.info(f"Триггер суммаризации сработал для user_id={user_id}, char='{char_name}'.")
+
+    except AIClientError as e:
+        # [Dev-Ассистент]: Провайдер не ответил и после повторов (ai_clients.retry) - показываем его сообщение.
+        # [Dev-Ассистент]: В историю ничего не пишем: текст ошибки не должен попадать в контекст диалога.
+        logger.error(f"Ошибка AI запроса для user_id={user_id}: {e}")
+        processed_html_text = f"<b>{html.escape(str(e))}</b>"
     except Exception as e:
         logger.error(f"Ошибка AI запроса для user_id={user_id}: {e}", exc_info=True)
         processed_html_text = "<b>Произошла ошибка при обращении к AI.</b>"
     
     finally:
+        use_response_chain(None)
         indicator_task.cancel()
         try:
             await indicator_task
@@ -426,13 +402,14 @@ async def process_ai_request(update: Update, context: ContextTypes.DEFAULT_TYPE,
             # [Dev-Ассистент]: F. Отображение Токенов Пользователю
             token_info = f"\n\n<i>(Токены LLM: {current_llm_input_tokens})</i>"
             # [Dev-Ассистент]: Добавляем информацию о токенах к тексту ответа
-            final_text_to_send = processed_html_text + token_info
+            final_text_to_send = processed_html_text + fallback_note + token_info
 
             await utils.send_long_message(
                 update, context, 
                 text=final_text_to_send, # [Dev-Ассистент]: Отправляем текст с информацией о токенах
                 reply_markup=final_reply_markup, 
-                output_format=output_format
+                output_format=output_format,
+                placeholder_message=stream_placeholder # [Dev-Ассистент]: Финальный HTML заменяет потоковое превью
             )
 
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -462,9 +439,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # [Dev-Ассистент]: Передаем referrer_id в add_or_update_user
     # [Dev-Ассистент]: Если пользователь новый, referer_id будет записан сразу.
     # [Dev-Ассистент]: Если существующий, referer_id будет записан только если он еще не задан.
-    await db.add_or_update_user(user.id, user.full_name, user.username, referer_id=referrer_id)
-    
-    user_data = await db.get_user_by_telegram_id(user.id)
+    user_data = await db.resolve_user(user.id, user.full_name, user.username, referer_id=referrer_id)
     if not user_data or not user_data.get('is_verified'):
         await captcha_handler.send_captcha(update, context)
         return
@@ -540,7 +515,9 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, use
     if await characters_handler.handle_stateful_message(update, context):
         return
     
-    tier_params = config.SUBSCRIPTION_TIERS[await get_actual_user_tier(user_data)]
+    user_tier_name = await get_actual_user_tier(user_data)
+    set_request_priority(utils.TIER_HIERARCHY.get(user_tier_name, 0))
+    tier_params = config.SUBSCRIPTION_TIERS[user_tier_name]
     if tier_params['daily_limit'] is not None:
         usage = await db.get_and_update_user_usage(user_data['id'], tier_params['daily_limit'])
         if not usage["can_request"]:
@@ -549,8 +526,19 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, use
     user_content, image_obj, is_photo, is_document, document_char_count = None, None, False, False, 0
     if update.message.photo:
         is_photo = True
-        file_bytes = await (await context.bot.get_file(update.message.photo[-1].file_id)).download_as_bytearray()
-        image_obj = Image.open(BytesIO(file_bytes))
+        # [Dev-Ассистент]: Качаем не самый большой размер, а наименьший, которого хватает модели при detail тарифа;
+        # [Dev-Ассистент]: уменьшение и кодирование (если нужны) идут в пуле потоков (ai_clients.images).
+        vision_detail = tier_params.get("vision_detail", VISION_DETAIL_AUTO)
+        photo_size = select_photo_size(update.message.photo, vision_detail)
+        # [Dev-Ассистент]: Готовый JPEG этого фото (file_cache) подходит по размеру, и prepare_image вернет его как есть.
+        vision_artifact = file_cache.ARTIFACT_VISION.format(detail=vision_detail)
+        cached_image = await file_cache.get_artifact(photo_size.file_unique_id, vision_artifact)
+        if cached_image is not None:
+            image_obj = await prepare_image(cached_image, vision_detail)
+        else:
+            file_bytes = await (await context.bot.get_file(photo_size.file_id)).download_as_bytearray()
+            image_obj = await prepare_image(bytes(file_bytes), vision_detail)
+            await file_cache.put_artifact(photo_size.file_unique_id, vision_artifact, image_obj.data)
         user_content = update.message.caption or "Опиши это изображение."
     elif update.message.document:
         is_document = True
@@ -571,7 +559,10 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, use
 @require_verification
 @inject_user_data
 async def handle_voice_message(update: Update, context: ContextTypes.DEFAULT_TYPE, user_data: dict):
-    tier_params = config.SUBSCRIPTION_TIERS[await get_actual_user_tier(user_data)]
+    user_tier_name = await get_actual_user_tier(user_data)
+    # [Dev-Ассистент]: Приоритет и для Whisper (лимитер openai_audio), и для ответа в process_ai_request.
+    set_request_priority(utils.TIER_HIERARCHY.get(user_tier_name, 0))
+    tier_params = config.SUBSCRIPTION_TIERS[user_tier_name]
     if tier_params['daily_limit'] is not None:
         usage = await db.get_and_update_user_usage(user_data['id'], tier_params['daily_limit'])
         if not usage["can_request"]:
@@ -580,17 +571,23 @@ async def handle_voice_message(update: Update, context: ContextTypes.DEFAULT_TYP
     status_message = await update.message.reply_text("🎙️ Получил голосовое, расшифровываю...")
     
     try:
-        voice_file = await context.bot.get_file(update.message.voice.file_id)
-        oga_bytes = await voice_file.download_as_bytearray()
-        
-        loop = asyncio.get_running_loop()
-        mp3_bytes = await loop.run_in_executor(None, utils.convert_oga_to_mp3_in_memory, oga_bytes)
-        
-        if not OPENAI_API_KEY:
-            raise ValueError("API ключ для OpenAI (необходим для Whisper) не найден в .env")
+        voice = update.message.voice
+        # [Dev-Ассистент]: Пересланное еще раз голосовое (тот же file_unique_id) не скачивается и не распознается заново.
+        cached_transcript = await file_cache.get_artifact(voice.file_unique_id, file_cache.ARTIFACT_TRANSCRIPT)
+        if cached_transcript is not None:
+            recognized_text = cached_transcript.decode("utf-8")
+        else:
+            oga_bytes = await file_cache.download_file(context.bot, voice.file_id, voice.file_unique_id)
 
-        gpt_client_for_whisper = GPTClient(api_key=OPENAI_API_KEY, system_instruction="", model_name="")
-        recognized_text = await gpt_client_for_whisper.transcribe_audio(mp3_bytes)
+            if not OPENAI_API_KEY:
+                raise ValueError("API ключ для OpenAI (необходим для Whisper) не найден в .env")
+
+            # [Dev-Ассистент]: Whisper идет через общий SDK-клиент OpenAI (тот же пул соединений, что у GPT/DALL-E).
+            # [Dev-Ассистент]: Голосовое уходит как есть (OGG); переупаковка - только если Whisper его не принял.
+            gpt_client_for_whisper = get_ai_client_with_caps(GPT_1).client
+            recognized_text = await transcribe_voice(gpt_client_for_whisper, oga_bytes)
+            if recognized_text:
+                await file_cache.put_artifact(voice.file_unique_id, file_cache.ARTIFACT_TRANSCRIPT, recognized_text.encode("utf-8"))
         
         if recognized_text:
             await status_message.edit_text(f"<i>Распознанный текст:</i>\n\n«{recognized_text}»\n\n🧠 Отправляю на обработку...", parse_mode='HTML')
@@ -600,12 +597,11 @@ async def handle_voice_message(update: Update, context: ContextTypes.DEFAULT_TYP
 
     except ValueError as e:
         await status_message.edit_text(f"Ошибка конфигурации: {e}")
+    except AudioConversionError as e:
+        await status_message.edit_text(f"Ошибка: {e}")
     except Exception as e:
         logger.error(f"Критическая ошибка при обработке голосового сообщения: {e}", exc_info=True)
-        if "No such file or directory: 'ffmpeg'" in str(e) or "Cannot find specified file" in str(e):
-             await status_message.edit_text("Ошибка: для распознавания голоса на сервере должна быть установлена утилита `ffmpeg`.")
-        else:
-            await status_message.edit_text("Произошла неизвестная ошибка при обработке вашего голосового сообщения.")
+        await status_message.edit_text("Произошла неизвестная ошибка при обработке вашего голосового сообщения.")
 
 @require_verification
 @inject_user_data
@@ -637,14 +633,14 @@ async def summarize_command(update: Update, context: ContextTypes.DEFAULT_TYPE,
 
     try:
         # [Dev-Ассистент]: Получаем клиент AI (используем модель из конфига)
-        caps = get_ai_client_with_caps(summarization_model, system_instruction=summarization_prompt)
+        caps = get_ai_client_with_caps(summarization_model)
         ai_client = caps.client
         
         # [Dev-Ассистент]: Подсчитываем токены исходного текста
         original_tokens = await ai_client.count_tokens(input_text, model_name=summarization_model) # [Dev-Ассистент]: Используем метод count_tokens клиента
 
         # [Dev-Ассистент]: Вызываем суммаризацию (chat_history пустая, т.к. это разовый запрос на сжатие)
-        summary_text, _ = await ai_client.get_text_response(chat_history=[], user_prompt=input_text)
+        summary_text, _ = await ai_client.get_text_response(chat_history=[], user_prompt=input_text, system_instruction=summarization_prompt)
         
         # [Dev-Ассистент]: Подсчитываем токены полученного резюме
         summary_tokens = await ai_client.count_tokens(summary_text, model_name=summarization_model) # [Dev-Ассистент]: Используем метод count_tokens клиента
@@ -682,13 +678,31 @@ async def button_callback_handler(update: Update, context: ContextTypes.DEFAULT_
     await update.callback_query.answer("Это действие больше не актуально.")
 
 async def post_init(application: Application):
+    # [Dev-Ассистент]: Пул соединений SQLite открывается один раз на всё время работы бота,
+    # [Dev-Ассистент]: заодно применяются недостающие миграции схемы (см. db_migrations.py).
+    await db.init_db_pool()
+    db.start_backfills()
+    init_ai_clients()
+    await file_cache.open_file_cache()
+    # [Dev-Ассистент]: Задания генерации, прерванные прошлым перезапуском, продолжаются или возвращаются здесь.
+    await image_jobs.start_image_jobs(application.bot)
+    summarizer.start_summarizer(_perform_summarization)
+    metrics.start_reporter()
     await application.bot.set_my_commands([BotCommand("start", "Начать/перезапустить"), BotCommand("reset", "Сбросить диалог")])
 
+async def post_shutdown(application: Application):
+    await image_jobs.stop_image_jobs()
+    await summarizer.stop_summarizer()
+    await close_ai_clients()
+    await metrics.stop_reporter()
+    await db.close_db_pool()
+
 def main():
     app = (
         Application.builder()
         .token(TELEGRAM_BOT_TOKEN)
         .post_init(post_init)
+        .post_shutdown(post_shutdown)
         .read_timeout(120)
         .write_timeout(120)
         .build()
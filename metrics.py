@@ -0,0 +1,104 @@
+# metrics.py
+# [Dev-Ассистент]: Простые метрики внутри процесса: счетчики и скользящие выборки значений (например, латентность).
+#
+# Внешней системы метрик у бота нет, поэтому сводка периодически пишется в лог (start_reporter/stop_reporter
+# из post_init/post_shutdown), а выборки доступны коду напрямую (percentile) - например, для решений о повторах.
+
+import asyncio
+import logging
+from collections import defaultdict, deque
+from typing import Deque, Dict, Optional, Tuple
+
+import config
+
+logger = logging.getLogger(__name__)
+
+_MetricKey = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+_counters: Dict[_MetricKey, float] = defaultdict(float)
+_samples: Dict[_MetricKey, Deque[float]] = {}
+_reporter_task: Optional[asyncio.Task] = None
+
+
+def _key(name: str, labels: Dict[str, object]) -> _MetricKey:
+    return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+
+def _format(key: _MetricKey) -> str:
+    name, labels = key
+    if not labels:
+        return name
+    return name + "{" + ",".join(f"{label}={value}" for label, value in labels) + "}"
+
+
+def increment(name: str, value: float = 1, **labels) -> None:
+    """Увеличивает счетчик name с метками labels (например, provider='openai', reason='429')."""
+    _counters[_key(name, labels)] += value
+
+
+def observe(name: str, value: float, **labels) -> None:
+    """Добавляет значение в скользящую выборку name (хранятся последние config.METRICS_SAMPLE_SIZE значений)."""
+    key = _key(name, labels)
+    samples = _samples.get(key)
+    if samples is None:
+        samples = deque(maxlen=config.METRICS_SAMPLE_SIZE)
+        _samples[key] = samples
+    samples.append(value)
+
+
+def get_counter(name: str, **labels) -> float:
+    return _counters.get(_key(name, labels), 0)
+
+
+def percentile(name: str, q: float, min_samples: int = 1, **labels) -> Optional[float]:
+    """
+    Возвращает q-квантиль (0..1) скользящей выборки или None, если значений меньше min_samples.
+    """
+    samples = _samples.get(_key(name, labels))
+    if not samples or len(samples) < min_samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+def snapshot() -> Dict[str, float]:
+    """Текущие значения всех счетчиков и p50/p95 выборок в виде плоского словаря."""
+    result = {_format(key): value for key, value in _counters.items()}
+    for key, samples in _samples.items():
+        if samples:
+            ordered = sorted(samples)
+            result[_format(key) + ":p50"] = ordered[len(ordered) // 2]
+            result[_format(key) + ":p95"] = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+    return result
+
+
+def _log_snapshot() -> None:
+    values = snapshot()
+    if values:
+        logger.info("Метрики: " + "; ".join(f"{name}={value:g}" for name, value in sorted(values.items())))
+
+
+async def _report_periodically() -> None:
+    while True:
+        await asyncio.sleep(config.METRICS_LOG_INTERVAL_SECONDS)
+        _log_snapshot()
+
+
+def start_reporter() -> None:
+    """Запускает фоновую запись сводки метрик в лог (вызывается из post_init)."""
+    global _reporter_task
+    if _reporter_task is None and config.METRICS_LOG_INTERVAL_SECONDS:
+        _reporter_task = asyncio.create_task(_report_periodically())
+
+
+async def stop_reporter() -> None:
+    """Останавливает фоновую запись и пишет последнюю сводку (вызывается из post_shutdown)."""
+    global _reporter_task
+    if _reporter_task is not None:
+        _reporter_task.cancel()
+        try:
+            await _reporter_task
+        except asyncio.CancelledError:
+            pass
+        _reporter_task = None
+    _log_snapshot()
@@ -0,0 +1,145 @@
+# summarizer.py
+# [Dev-Ассистент]: Планировщик фоновой суммаризации диалогов.
+#
+# Триггер суммаризации проверяется после каждого ответа, и раньше каждое срабатывание запускало свою задачу:
+# пока первая ждала LLM, вторая и третья читали те же сообщения, платили за тот же текст и гонялись
+# в save_summary_and_clean_old_messages. Теперь на диалог (пользователь, персонаж) не больше одного задания:
+# повторный запрос к уже ждущему заданию сливается с ним, а к выполняющемуся - отбрасывается (следующий
+# ответ снова проверит триггер уже по сохраненному резюме). Задания выполняют SUMMARIZATION_WORKERS воркеров,
+# в очереди - не больше SUMMARIZATION_MAX_QUEUED. Запросы к LLM идут с фоновым приоритетом лимитера
+# (ai_clients.rate_limiter.BACKGROUND_PRIORITY), а не с приоритетом тарифа пользователя.
+
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+import config
+import metrics
+from ai_clients.rate_limiter import BACKGROUND_PRIORITY, set_request_priority
+
+logger = logging.getLogger(__name__)
+
+_DialogKey = Tuple[int, str]
+SummarizeFunc = Callable[[int, str, int], Awaitable[None]]
+
+
+class _PendingSummarization:
+    def __init__(self, active_buffer_count: int):
+        self.active_buffer_count = active_buffer_count
+        self.queued_at = time.monotonic()
+
+
+class SummarizationScheduler:
+    """Очередь заданий суммаризации с дедупликацией по диалогу и ограниченным числом воркеров."""
+
+    def __init__(self, summarize: SummarizeFunc):
+        self._summarize = summarize
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._pending: Dict[_DialogKey, _PendingSummarization] = {}
+        self._running: set = set()
+        self._workers: List[asyncio.Task] = []
+
+    def start(self) -> None:
+        for _ in range(config.SUMMARIZATION_WORKERS):
+            self._workers.append(asyncio.create_task(self._work()))
+
+    async def stop(self) -> None:
+        """Останавливает воркеры. Невыполненные задания пропадают: их снова запустит триггер после следующего ответа."""
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers.clear()
+        self._pending.clear()
+
+    def is_scheduled(self, user_id: int, character_name: str) -> bool:
+        key = (user_id, character_name)
+        return key in self._pending or key in self._running
+
+    def schedule(self, user_id: int, character_name: str, active_buffer_count: int) -> bool:
+        """
+        Ставит суммаризацию диалога в очередь.
+        :return: True, если создано новое задание; False - слито с уже запланированным или отброшено.
+        """
+        key = (user_id, character_name)
+        pending = self._pending.get(key)
+        if pending is not None:
+            # [Dev-Ассистент]: Буфер берем из последнего запроса (тариф мог измениться), очередь - прежняя.
+            pending.active_buffer_count = active_buffer_count
+            metrics.increment("summarization_jobs_total", outcome="coalesced")
+            return False
+        if key in self._running:
+            metrics.increment("summarization_jobs_total", outcome="coalesced")
+            return False
+        if len(self._pending) >= config.SUMMARIZATION_MAX_QUEUED:
+            logger.warning(f"Очередь суммаризации заполнена ({len(self._pending)}), задание для user_id={user_id}, char='{character_name}' отложено до следующего ответа.")
+            metrics.increment("summarization_jobs_total", outcome="rejected")
+            return False
+
+        self._pending[key] = _PendingSummarization(active_buffer_count)
+        self._queue.put_nowait(key)
+        metrics.increment("summarization_jobs_total", outcome="queued")
+        metrics.observe("summarization_queue_depth", len(self._pending))
+        return True
+
+    async def _work(self) -> None:
+        set_request_priority(BACKGROUND_PRIORITY)
+        while True:
+            key = await self._queue.get()
+            job = self._pending.pop(key, None)
+            if job is None:
+                continue
+            user_id, character_name = key
+            self._running.add(key)
+            started_at = time.monotonic()
+            metrics.observe("summarization_wait_seconds", started_at - job.queued_at)
+            try:
+                await self._summarize(user_id, character_name, job.active_buffer_count)
+                metrics.increment("summarization_jobs_total", outcome="done")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                metrics.increment("summarization_jobs_total", outcome="failed")
+                logger.error(f"Ошибка суммаризации для user_id={user_id}, char='{character_name}': {e}", exc_info=True)
+            finally:
+                self._running.discard(key)
+                metrics.observe("summarization_seconds", time.monotonic() - started_at)
+
+
+_scheduler: Optional[SummarizationScheduler] = None
+
+
+def start_summarizer(summarize: SummarizeFunc) -> None:
+    """
+    Запускает воркеры суммаризации (вызывается из post_init).
+
+    :param summarize: Корутина summarize(user_id, character_name, active_buffer_count), сжимающая историю диалога.
+    """
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = SummarizationScheduler(summarize)
+        _scheduler.start()
+
+
+async def stop_summarizer() -> None:
+    """Останавливает воркеры (вызывается из post_shutdown до закрытия пула БД)."""
+    global _scheduler
+    if _scheduler is not None:
+        await _scheduler.stop()
+        _scheduler = None
+
+
+def is_summarization_scheduled(user_id: int, character_name: str) -> bool:
+    """Ждет или выполняется ли уже суммаризация диалога (тогда триггер можно не проверять)."""
+    return _scheduler is not None and _scheduler.is_scheduled(user_id, character_name)
+
+
+def schedule_summarization(user_id: int, character_name: str, active_buffer_count: int) -> bool:
+    """
+    Ставит суммаризацию диалога в очередь (см. SummarizationScheduler.schedule).
+    :return: True, если создано новое задание.
+    """
+    if _scheduler is None:
+        logger.warning("Планировщик суммаризации не запущен, суммаризация пропущена.")
+        return False
+    return _scheduler.schedule(user_id, character_name, active_buffer_count)
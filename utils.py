@@ -4,25 +4,32 @@ import logging
 import re
 import html
 from datetime import datetime 
-from telegram import ReplyKeyboardMarkup, KeyboardButton, Update, InlineKeyboardMarkup
+from telegram import ReplyKeyboardMarkup, KeyboardButton, Update, InlineKeyboardMarkup, Message
+from telegram.error import TelegramError, RetryAfter
 from functools import wraps
 from telegram.ext import ContextTypes
 import config
 from io import BytesIO
-from pydub import AudioSegment
 from fpdf import FPDF
 import asyncio
 import constants
 import database as db
+import file_cache
 from constants import TIER_FREE, OUTPUT_FORMAT_TEXT, OUTPUT_FORMAT_TXT, OUTPUT_FORMAT_PDF
 import tiktoken
-from typing import Dict
+from typing import Dict, AsyncIterator, Optional, Tuple
+from ai_clients.base_client import StreamDelta
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
 logging.getLogger('utils').setLevel(logging.ERROR)
 
 # [Dev-Ассистент]: Это позволит нам легко сравнивать, "выше" или "ниже" тариф пользователя.
+# [Dev-Ассистент]: Лимит Telegram на длину текста одного сообщения.
+TELEGRAM_MESSAGE_MAX_LENGTH = 4096
+# [Dev-Ассистент]: Курсор в конце превью показывает, что ответ еще печатается.
+STREAM_PREVIEW_CURSOR = " ▌"
+
 TIER_HIERARCHY = {constants.TIER_FREE: 0, constants.TIER_LITE: 1, constants.TIER_PRO: 2,constants.TIER_GOLD: 3,constants.TIER_VIP: 4}
 
 # --- БЛОК ОБРАБОТКИ ТЕКСТА ---
@@ -157,16 +164,22 @@ async def send_long_message(
     context: ContextTypes.DEFAULT_TYPE,
     text: str,
     reply_markup: InlineKeyboardMarkup = None,
-    output_format: str = OUTPUT_FORMAT_TEXT
+    output_format: str = OUTPUT_FORMAT_TEXT,
+    placeholder_message: Optional[Message] = None
 ):
-    """Отправляет ответ пользователю в заданном формате (HTML, txt или PDF)."""
+    """
+    Отправляет ответ пользователю в заданном формате (HTML, txt или PDF).
+
+    placeholder_message - сообщение с потоковым превью ответа (см. stream_response_preview).
+    В текстовом формате первая часть ответа заменяет его текст, остальные части уходят новыми сообщениями.
+    """
     message_to_interact = update.message or (update.callback_query and update.callback_query.message)
     chat_id = message_to_interact.chat_id
 
     if output_format == OUTPUT_FORMAT_TEXT:
-        max_length = 4096
+        max_length = TELEGRAM_MESSAGE_MAX_LENGTH
         if len(text) <= max_length:
-            await context.bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup, parse_mode='HTML')
+            parts = [text]
         else:
             # [Dev-Ассистент]: !!! РЕШЕНИЕ: "УМНЫЕ НОЖНИЦЫ" !!!
             # [Dev-Ассистент]: Вместо простого разделения, мы будем аккуратно
@@ -189,16 +202,27 @@ async def send_long_message(
             if remaining_text:
                 parts.append(remaining_text)
 
-            for i, part in enumerate(parts):
-                # Клавиатуру прикрепляем только к последнему сообщению
-                current_reply_markup = reply_markup if i == len(parts) - 1 else None
-                if part: # Отправляем, только если часть не пустая
-                    await context.bot.send_message(
-                        chat_id=chat_id, text=part, reply_markup=current_reply_markup, parse_mode='HTML'
-                    )
+        for i, part in enumerate(parts):
+            # Клавиатуру прикрепляем только к последнему сообщению
+            current_reply_markup = reply_markup if i == len(parts) - 1 else None
+            if not part: # Отправляем, только если часть не пустая
+                continue
+            if i == 0 and placeholder_message:
+                # [Dev-Ассистент]: Финальный HTML заменяет превью на месте, без нового уведомления и "прыжка" чата.
+                try:
+                    await placeholder_message.edit_text(text=part, reply_markup=current_reply_markup, parse_mode='HTML')
+                    continue
+                except TelegramError as e:
+                    logger.warning(f"Не удалось заменить превью финальным ответом, отправляем новым сообщением: {e}")
+                    try:
+                        await placeholder_message.delete()
+                    except TelegramError:
+                        pass
+            await context.bot.send_message(
+                chat_id=chat_id, text=part, reply_markup=current_reply_markup, parse_mode='HTML'
+            )
 
     elif output_format == OUTPUT_FORMAT_TXT:
-        # ... (этот блок без изменений)
         try:
             clean_text = strip_html_tags(text)
             text_bytes = clean_text.encode('utf-8')
@@ -211,7 +235,6 @@ async def send_long_message(
             await context.bot.send_message(chat_id=chat_id, text="Не удалось сформировать .txt файл.")
 
     elif output_format == OUTPUT_FORMAT_PDF:
-        # ... (этот блок без изменений)
         try:
             loop = asyncio.get_running_loop()
             pdf_bytes = await loop.run_in_executor(None, create_pdf_from_html, text)
@@ -224,7 +247,79 @@ async def send_long_message(
             logger.error(f"Ошибка при создании .pdf файла: {e}", exc_info=True)
             await context.bot.send_message(chat_id=chat_id, text="Не удалось сформировать .pdf файл.")
 
+def _stream_preview_text(text: str) -> str:
+    """Превью для потокового сообщения: простой текст с курсором, длинный ответ - его последние символы."""
+    limit = TELEGRAM_MESSAGE_MAX_LENGTH - len(STREAM_PREVIEW_CURSOR) - 1
+    if len(text) > limit:
+        text = "…" + text[-limit:]
+    return text + STREAM_PREVIEW_CURSOR
+
+async def stream_response_preview(
+    context: ContextTypes.DEFAULT_TYPE,
+    chat_id: int,
+    deltas: AsyncIterator[StreamDelta]
+) -> Tuple[str, int, Optional[Message]]:
+    """
+    Читает потоковый ответ AI и показывает его по мере генерации в одном сообщении.
+
+    Сообщение отправляется с первым непустым фрагментом и затем редактируется не чаще,
+    чем раз в config.STREAM_EDIT_INTERVAL_SECONDS (лимиты Telegram на редактирование).
+    Превью - простой текст без parse_mode: незакрытая разметка посреди потока ломала бы HTML.
+    Финальный HTML выставляет send_long_message(placeholder_message=...).
+
+    :return: Кортеж (полный текст ответа, потрачено токенов, сообщение-превью или None).
+    """
+    loop = asyncio.get_running_loop()
+    chunks = []
+    tokens_spent = 0
+    placeholder = None
+    shown_text = ""
+    next_edit_at = 0.0
+
+    try:
+        async for delta in deltas:
+            if delta.text:
+                chunks.append(delta.text)
+            if delta.total_tokens:
+                tokens_spent = delta.total_tokens
+            if not delta.text or loop.time() < next_edit_at:
+                continue
+
+            full_text = "".join(chunks)
+            if not full_text.strip():
+                continue
+            preview = _stream_preview_text(full_text)
+            if preview == shown_text:
+                continue
+            try:
+                if placeholder is None:
+                    placeholder = await context.bot.send_message(chat_id=chat_id, text=preview)
+                else:
+                    await placeholder.edit_text(text=preview)
+                shown_text = preview
+                next_edit_at = loop.time() + config.STREAM_EDIT_INTERVAL_SECONDS
+            except RetryAfter as e:
+                # [Dev-Ассистент]: Превью не критично: при флуд-контроле просто молчим, пока Telegram не разрешит.
+                retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else e.retry_after
+                next_edit_at = loop.time() + retry_after
+            except TelegramError as e:
+                logger.warning(f"Не удалось обновить потоковое превью ответа: {e}")
+                next_edit_at = loop.time() + config.STREAM_EDIT_INTERVAL_SECONDS
+    except BaseException:
+        # [Dev-Ассистент]: Поток оборвался ошибкой - убираем недописанное превью, об ошибке сообщит вызывающий код.
+        if placeholder is not None:
+            try:
+                await placeholder.delete()
+            except TelegramError:
+                pass
+        raise
+
+    return "".join(chunks), tokens_spent, placeholder
+
 async def get_actual_user_tier(user_data: dict) -> str:
+    """
+    Возвращает действующий тариф пользователя (истекшая подписка сбрасывается до 'free').
+    """
     current_tier = user_data.get('subscription_tier', TIER_FREE)
     expiry_date_str = user_data.get('subscription_expiry_date')
     if current_tier != TIER_FREE and expiry_date_str:
@@ -232,7 +327,7 @@ async def get_actual_user_tier(user_data: dict) -> str:
         if expiry_date and expiry_date < datetime.now():
             logger.info(f"Подписка для user_id={user_data['id']} истекла. Сбрасываем до 'free'.")
             await db.set_user_tier_to_free(user_data['id'])
-            return TIER_FREE
+            current_tier = TIER_FREE
     return current_tier
 
 
@@ -255,15 +350,11 @@ def require_verification(func):
 def inject_user_data(func):
     @wraps(func)
     async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
-        user_id = await db.add_or_update_user(update.effective_user.id, update.effective_user.full_name, update.effective_user.username)
-        if not user_id:
-            message = update.message or update.callback_query.message
-            await message.reply_text("Произошла ошибка с вашим профилем. Попробуйте позже.")
-            return
-        user_data = await db.get_user_by_id(user_id)
+        # [Dev-Ассистент]: Один вызов вместо add_or_update_user + get_user_by_id; без записи, если профиль не менялся.
+        user_data = await db.resolve_user(update.effective_user.id, update.effective_user.full_name, update.effective_user.username)
         if not user_data:
             message = update.message or update.callback_query.message
-            await message.reply_text("Не удалось загрузить данные вашего профиля.")
+            await message.reply_text("Произошла ошибка с вашим профилем. Попробуйте позже.")
             return
         return await func(update, context, user_data=user_data, *args, **kwargs)
     return wrapper
@@ -278,23 +369,31 @@ async def get_text_content_from_document(document_file, context: ContextTypes.DE
         raise ValueError("Неподдерживаемый тип файла. Разрешены только текстовые файлы (.txt).")
     if document_file.file_size and document_file.file_size > config.ABSOLUTE_MAX_FILE_CHARS * 4: 
         raise FileSizeError(f"Файл слишком большой (>{config.ABSOLUTE_MAX_FILE_CHARS * 4} байт).")
-    file = await context.bot.get_file(document_file.file_id)
-    downloaded_bytes = await file.download_as_bytearray()
-    try:
-        text_content = downloaded_bytes.decode('utf-8')
-    except UnicodeDecodeError:
-        text_content = downloaded_bytes.decode('windows-1251', errors='ignore')
+    # [Dev-Ассистент]: Текст того же файла (file_unique_id), уже присланного раньше, берем из file_cache.
+    cached_text = await file_cache.get_artifact(document_file.file_unique_id, file_cache.ARTIFACT_DOCUMENT_TEXT)
+    if cached_text is not None:
+        text_content = cached_text.decode('utf-8')
+    else:
+        file = await context.bot.get_file(document_file.file_id)
+        downloaded_bytes = await file.download_as_bytearray()
+        try:
+            text_content = downloaded_bytes.decode('utf-8')
+        except UnicodeDecodeError:
+            text_content = downloaded_bytes.decode('windows-1251', errors='ignore')
     if len(text_content) > config.ABSOLUTE_MAX_FILE_CHARS:
         raise FileSizeError(f"Файл слишком большой ({len(text_content)} символов). Максимум: {config.ABSOLUTE_MAX_FILE_CHARS}.")
+    if cached_text is None:
+        await file_cache.put_artifact(document_file.file_unique_id, file_cache.ARTIFACT_DOCUMENT_TEXT, text_content.encode('utf-8'))
     return text_content
 
 
-def convert_oga_to_mp3_in_memory(oga_bytearray: bytearray) -> bytes:
-    oga_audio_stream = BytesIO(oga_bytearray)
-    audio = AudioSegment.from_file(oga_audio_stream, format="ogg")
-    mp3_buffer = BytesIO()
-    audio.export(mp3_buffer, format="mp3")
-    return mp3_buffer.getvalue()
+def get_model_display_name(provider_id: str) -> str:
+    """Название модели для пользователя из config.ALL_TEXT_MODELS_FOR_SELECTION (или сам идентификатор)."""
+    for model_info in config.ALL_TEXT_MODELS_FOR_SELECTION:
+        if model_info["provider_id"] == provider_id:
+            return model_info["display_name"]
+    return provider_id
+
 async def get_user_ai_provider(user_data: dict) -> str:
     """
     [Dev-Ассистент]: Определяет AI-провайдера для пользователя по четким правилам.
@@ -329,7 +428,7 @@ async def set_user_ai_provider(user_id: int, provider_name: str | None) -> None:
     [Dev-Ассистент]: Устанавливает или сбрасывает выбранный AI-провайдер для пользователя.
     [Dev-Ассистент]: Если provider_name равен None, сбрасывает на NULL в БД.
     """
-    await db.db_request("UPDATE users SET current_ai_provider = ? WHERE id = ?", (provider_name, user_id))
+    await db.set_user_ai_provider(user_id, provider_name)
     logger.info(f"Для пользователя user_id={user_id} установлен AI-провайдер: {provider_name or 'по умолчанию'}")
 
 def count_gpt_tokens(text: str, model_name: str = "gpt-4") -> int: